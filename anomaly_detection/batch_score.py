@@ -0,0 +1,240 @@
+# Imports
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from models             import load_model
+from utils              import embedding_matrix, iter_embeddings, load_embedding_cache, save_embedding_cache
+import argformat
+import argparse
+import csv
+import numpy as np
+import os
+import sys
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+
+################################################################################
+#                                   Sources                                    #
+################################################################################
+
+def find_caches(root):
+    """Find embedding caches stored as <root>/<account>/<snapshot>/.
+
+        Parameters
+        ----------
+        root : string
+            Root directory of embedding caches.
+
+        Returns
+        -------
+        caches : list of tuple
+            Sorted list of (account, snapshot, directory) tuples.
+        """
+    caches = list()
+    for account in sorted(os.listdir(root)):
+        if not os.path.isdir(os.path.join(root, account)):
+            continue
+        for snapshot in sorted(os.listdir(os.path.join(root, account))):
+            directory = os.path.join(root, account, snapshot)
+            if os.path.isfile(os.path.join(directory, 'embeddings.npy')):
+                caches.append((account, snapshot, directory))
+    return caches
+
+
+def cache_tasks(caches, chunk_size):
+    """Generate chunk tasks for embedding caches.
+
+        Tasks only contain the policy names and location of a chunk, workers
+        read the embeddings themselves from the memory mapped cache.
+
+        Yields
+        ------
+        task : tuple
+            Tuple of ('cache', account, snapshot, policies, directory, start).
+        """
+    for account, snapshot, directory in caches:
+        policies, _ = load_embedding_cache(directory)
+        for start in range(0, len(policies), chunk_size):
+            yield ('cache', account, snapshot, policies[start:start+chunk_size], directory, start)
+
+
+def graph_tasks(driver, account, snapshot, chunk_size):
+    """Generate chunk tasks streamed from the graph database.
+
+        Yields
+        ------
+        task : tuple
+            Tuple of ('rows', account, snapshot, policies, embeddings).
+        """
+    for chunk in iter_embeddings(driver, chunk_size):
+        yield ('rows', account, snapshot, chunk['policy'].tolist(), embedding_matrix(chunk))
+
+################################################################################
+#                                Worker process                                #
+################################################################################
+
+# Model of a worker process, set by _init_worker()
+_worker = dict()
+
+
+def _init_worker(path):
+    """Load the persisted model once per worker process."""
+    _worker['model'] = load_model(path)['model']
+
+
+def _score(task):
+    """Score a single chunk.
+
+        Returns
+        -------
+        rows : list of tuple
+            (account, snapshot, policy, score, label) for each policy in chunk.
+        """
+    # Read chunk
+    if task[0] == 'cache':
+        _, account, snapshot, policies, directory, start = task
+        embeddings = np.load(os.path.join(directory, 'embeddings.npy'), mmap_mode='r')
+        X = np.asarray(embeddings[start:start+len(policies)], dtype=np.float64)
+    else:
+        _, account, snapshot, policies, X = task
+
+    # Score chunk
+    scores = _worker['model'].decision_function(X)
+    labels = np.where(scores < 0, -1, 1)
+
+    # Return rows
+    return [
+        (account, snapshot, policy, float(score), int(label))
+        for policy, score, label in zip(policies, scores, labels)
+    ]
+
+################################################################################
+#                                Batch scoring                                 #
+################################################################################
+
+def batch_score(model, tasks, output, n_workers=None, max_pending=None):
+    """Score chunks in worker processes and write rows incrementally.
+
+        Memory is bounded by submitting at most max_pending chunks at once,
+        each result is written to disk as soon as it is available.
+
+        Parameters
+        ----------
+        model : string
+            Path of model stored by models.save_model().
+
+        tasks : iterable
+            Chunk tasks, see cache_tasks() and graph_tasks().
+
+        output : file
+            Opened file to write CSV rows to.
+
+        n_workers : int, optional
+            Number of worker processes, by default the number of CPUs.
+
+        max_pending : int, optional
+            Maximum number of chunks in flight, by default twice the number of
+            workers.
+
+        Returns
+        -------
+        n_scored : int
+            Number of scored policies.
+        """
+    # Chunks contain embeddings, so the model must be fitted on the embedding
+    features = load_model(model)['features']
+    if features != 'node2vec':
+        raise ValueError("Model {} was fitted on {} features, not on embeddings".format(model, features))
+
+    n_workers   = n_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * n_workers
+    writer      = csv.writer(output)
+    writer.writerow(['account', 'snapshot', 'policy', 'score', 'label'])
+    n_scored    = 0
+
+    with ProcessPoolExecutor(
+            max_workers = n_workers,
+            initializer = _init_worker,
+            initargs    = (model,),
+        ) as executor:
+        pending = set()
+        tasks   = iter(tasks)
+
+        while True:
+            # Keep a bounded number of chunks in flight
+            for task in tasks:
+                pending.add(executor.submit(_score, task))
+                if len(pending) >= max_pending:
+                    break
+
+            if not pending:
+                break
+
+            # Write finished chunks
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows = future.result()
+                writer.writerows(rows)
+                n_scored += len(rows)
+            output.flush()
+
+    # Return number of scored policies
+    return n_scored
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Score all policies of many accounts and snapshots",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("model"        , help="model stored by run_detectors.py --save")
+    parser.add_argument("--caches"     , help="root directory of embedding caches <root>/<account>/<snapshot>/")
+    parser.add_argument("--graph"      , nargs=2, metavar=('ACCOUNT', 'SNAPSHOT'), help="score the graph database as given account and snapshot")
+    parser.add_argument("--export"     , help="store embeddings of the graph database as cache in given directory, instead of scoring")
+    parser.add_argument("--output"     , default="scores.csv", help="CSV file to write rows to ('-' for stdout)")
+    parser.add_argument("--chunk-size" , type=int, default=10000, help="number of policies per chunk")
+    parser.add_argument("--workers"    , type=int, help="number of worker processes")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Connect to database if required
+    driver = None
+    if args.graph or args.export:
+        driver = get_driver(args.uri, args.user, args.password, args.pool_size)
+
+    ########################################################################
+    #                            Export cache                              #
+    ########################################################################
+
+    if args.export:
+        n = save_embedding_cache(driver, args.export, chunk_size=args.chunk_size)
+        print("Stored {} embeddings in {}".format(n, args.export))
+        sys.exit(0)
+
+    ########################################################################
+    #                           Score policies                             #
+    ########################################################################
+
+    def tasks():
+        """Generate tasks of all sources."""
+        if args.caches:
+            yield from cache_tasks(find_caches(args.caches), args.chunk_size)
+        if args.graph:
+            yield from graph_tasks(driver, *args.graph, args.chunk_size)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    try:
+        n = batch_score(args.model, tasks(), output, n_workers=args.workers)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print("Scored {} policies".format(n), file=sys.stderr)
@@ -0,0 +1,409 @@
+# Imports
+from detectors       import DETECTORS, create_detector
+from sklearn.metrics import precision_recall_fscore_support, roc_auc_score
+import argformat
+import argparse
+import itertools
+import json
+import multiprocessing
+import numpy  as np
+import os
+import platform
+import queue as queues
+import resource
+import sklearn
+import subprocess
+import sys
+import time
+
+################################################################################
+#                                Synthetic data                                #
+################################################################################
+
+def generate_data(n_samples, n_dimensions, outlier_fraction=0.01, test_size=0.1,
+                  n_clusters=10, random_state=0):
+    """Generate a synthetic embedding set split like utils.split_data().
+
+        Inliers are drawn from a mixture of Gaussian clusters, outliers are
+        drawn uniformly from the bounding box of the inliers. The train set
+        contains only inliers, the test set contains the remaining inliers and
+        all outliers.
+
+        Parameters
+        ----------
+        n_samples : int
+            Total number of samples (policies).
+
+        n_dimensions : int
+            Dimension of each sample.
+
+        outlier_fraction : float, default=0.01
+            Fraction of samples that are outliers.
+
+        test_size : float, default=0.1
+            Fraction of inliers in the test set.
+
+        n_clusters : int, default=10
+            Number of Gaussian clusters of inliers.
+
+        random_state : int, default=0
+            Seed for generating the data.
+
+        Returns
+        -------
+        X_train : np.array of shape=(n_train, n_dimensions)
+            Train data.
+
+        X_test : np.array of shape=(n_test, n_dimensions)
+            Test data.
+
+        y_test : np.array of shape=(n_test,)
+            Test labels, 1 for inliers and -1 for outliers.
+        """
+    rng = np.random.default_rng(random_state)
+    n_outliers = max(1, int(round(n_samples * outlier_fraction)))
+    n_inliers  = n_samples - n_outliers
+    n_test     = max(1, int(round(n_inliers * test_size)))
+
+    # Generate inliers around cluster centers
+    centers = rng.normal(scale=5, size=(n_clusters, n_dimensions))
+    inliers = centers[rng.integers(n_clusters, size=n_inliers)]
+    inliers += rng.normal(size=inliers.shape)
+
+    # Generate outliers in bounding box of inliers
+    low, high = inliers.min(axis=0), inliers.max(axis=0)
+    outliers  = rng.uniform(low, high, size=(n_outliers, n_dimensions))
+
+    # Return split
+    X_train = inliers[n_test:]
+    X_test  = np.concatenate((inliers[:n_test], outliers))
+    y_test  = np.concatenate((np.ones(n_test, dtype=int), -np.ones(n_outliers, dtype=int)))
+    return X_train, X_test, y_test
+
+################################################################################
+#                                 Single case                                  #
+################################################################################
+
+def _peak_rss():
+    """Return peak resident set size of the current process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in KiB otherwise
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def run_case(detector, n_samples, n_dimensions, outlier_fraction, random_state=0):
+    """Fit and predict a single detector on synthetic data.
+
+        Should be run in a fresh process, such that the peak RSS only includes
+        this case.
+
+        Returns
+        -------
+        result : dict()
+            Wall time, peak RSS and detection quality of the case.
+        """
+    X_train, X_test, y_test = generate_data(
+        n_samples, n_dimensions, outlier_fraction, random_state=random_state,
+    )
+    data_rss = _peak_rss()
+
+    # Fit detector
+    clf   = create_detector(detector)
+    start = time.perf_counter()
+    clf.fit(X_train)
+    fit_time = time.perf_counter() - start
+
+    # Predict test data
+    start  = time.perf_counter()
+    scores = clf.decision_function(X_test)
+    y_pred = np.where(scores < 0, -1, 1)
+    predict_time = time.perf_counter() - start
+
+    # Compute detection quality for outliers
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        y_test, y_pred, labels=[-1], zero_division=0,
+    )
+
+    # Return result
+    return {
+        'fit_time'    : fit_time,
+        'predict_time': predict_time,
+        'data_rss_mb' : data_rss,
+        'peak_rss_mb' : _peak_rss(),
+        'precision'   : float(precision[0]),
+        'recall'      : float(recall[0]),
+        'f1'          : float(f1[0]),
+        'roc_auc'     : float(roc_auc_score(y_test == -1, -scores)),
+    }
+
+
+def _run_case_process(queue, *args):
+    """Run a case and put its result (or error) on the queue."""
+    try:
+        queue.put(('ok', run_case(*args)))
+    except Exception as e:
+        queue.put(('error', repr(e)))
+
+
+def run_isolated(detector, n_samples, n_dimensions, outlier_fraction, random_state=0, timeout=None,
+                 poll_interval=1.0):
+    """Run a case in a fresh process with an optional timeout.
+
+        The process is polled while waiting, such that a process that dies
+        without a result, e.g., killed by the kernel when running out of
+        memory, is recorded as crashed instead of blocking the benchmark.
+
+        Returns
+        -------
+        status : string
+            'ok', 'error', 'crashed' or 'timeout'.
+
+        result : dict() or string
+            Result of run_case() if status is 'ok', else the error.
+        """
+    context = multiprocessing.get_context('spawn')
+    queue   = context.Queue()
+    process = context.Process(
+        target = _run_case_process,
+        args   = (queue, detector, n_samples, n_dimensions, outlier_fraction, random_state),
+    )
+    process.start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # Wait for result
+    try:
+        while True:
+            wait = poll_interval if deadline is None else min(poll_interval, deadline - time.monotonic())
+            try:
+                return queue.get(timeout=max(wait, 0))
+            except queues.Empty:
+                pass
+
+            # Process exited without result, a result put just before exiting is still read
+            if not process.is_alive():
+                try:
+                    return queue.get(timeout=poll_interval)
+                except queues.Empty:
+                    return 'crashed', "exit code {}".format(process.exitcode)
+
+            if deadline is not None and time.monotonic() >= deadline:
+                process.terminate()
+                return 'timeout', "exceeded {}s".format(timeout)
+    finally:
+        process.join()
+
+################################################################################
+#                                  Benchmark                                   #
+################################################################################
+
+# Largest number of samples for which each detector is run by default, larger
+# cases are recorded as skipped. t-SNE and the kernel SVM scale quadratically.
+MAX_SAMPLES = {
+    'isolation_forest'        : 1000000,
+    'local_outlier_factor'    :   10000,
+    'local_outlier_factor_raw': 1000000,
+    'local_outlier_factor_pca': 1000000,
+    'one_class_svm'           :  100000,
+    'robust_covariance'       : 1000000,
+}
+
+
+def environment():
+    """Describe the environment in which the benchmark runs."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd    = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        commit = None
+
+    return {
+        'commit'   : commit,
+        'python'   : platform.python_version(),
+        'numpy'    : np.__version__,
+        'sklearn'  : sklearn.__version__,
+        'platform' : platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def benchmark(output, detectors, sizes, dimensions, outlier_fraction=0.01,
+              max_samples=MAX_SAMPLES, timeout=None, random_state=0):
+    """Run all combinations of detectors, sizes and dimensions.
+
+        Parameters
+        ----------
+        output : string
+            Path of JSON lines file to write results to. The first line
+            describes the environment, each following line a single case.
+
+        detectors : iterable of string
+            Names of detectors to benchmark.
+
+        sizes : iterable of int
+            Numbers of samples to benchmark.
+
+        dimensions : iterable of int
+            Dimensions to benchmark.
+
+        outlier_fraction : float, default=0.01
+            Fraction of samples that are outliers.
+
+        max_samples : dict(), default=MAX_SAMPLES
+            Largest number of samples per detector, larger cases are skipped.
+
+        timeout : float, optional
+            Maximum time in seconds of a single case.
+
+        random_state : int, default=0
+            Seed for generating data.
+        """
+    with open(output, 'w') as outfile:
+        outfile.write(json.dumps({'environment': environment()}) + '\n')
+
+        for detector, n_samples, n_dimensions in itertools.product(detectors, sizes, dimensions):
+            case = {
+                'detector'        : detector,
+                'n_samples'       : n_samples,
+                'n_dimensions'    : n_dimensions,
+                'outlier_fraction': outlier_fraction,
+            }
+
+            # Skip cases that are not viable for detector
+            if n_samples > max_samples.get(detector, float('inf')):
+                status, result = 'skipped', "exceeds {} samples".format(max_samples[detector])
+            else:
+                status, result = run_isolated(
+                    detector, n_samples, n_dimensions, outlier_fraction,
+                    random_state = random_state,
+                    timeout      = timeout,
+                )
+
+            # Store result
+            case['status'] = status
+            if status == 'ok':
+                case.update(result)
+            else:
+                case['reason'] = result
+            outfile.write(json.dumps(case) + '\n')
+            outfile.flush()
+
+            print("{detector:<26} n={n_samples:<8} d={n_dimensions:<4} {status:<8} {timing}".format(
+                timing = "fit={fit_time:.3f}s predict={predict_time:.3f}s rss={peak_rss_mb:.0f}MiB f1={f1:.3f}".format(**case)
+                         if status == 'ok' else case['reason'],
+                **case,
+            ), file=sys.stderr)
+
+
+def load_results(path):
+    """Load results of benchmark() indexed by case.
+
+        Returns
+        -------
+        environment : dict()
+            Environment in which the benchmark ran.
+
+        cases : dict()
+            Dictionary of (detector, n_samples, n_dimensions) -> result.
+        """
+    environment = dict()
+    cases       = dict()
+    with open(path) as infile:
+        for line in infile:
+            record = json.loads(line)
+            if 'environment' in record:
+                environment = record['environment']
+            else:
+                cases[record['detector'], record['n_samples'], record['n_dimensions']] = record
+    return environment, cases
+
+
+def compare(baseline, current, threshold=1.2):
+    """Compare two benchmark results and report regressions.
+
+        Parameters
+        ----------
+        baseline : string
+            Path of results of baseline version.
+
+        current : string
+            Path of results of current version.
+
+        threshold : float, default=1.2
+            Ratio of current over baseline time or RSS considered a regression.
+
+        Returns
+        -------
+        regressions : list of string
+            Description of each regression.
+        """
+    _, old = load_results(baseline)
+    _, new = load_results(current)
+
+    regressions = list()
+    for case, result in sorted(new.items()):
+        previous = old.get(case)
+        if previous is None or previous['status'] != 'ok':
+            continue
+
+        # Cases that became infeasible are regressions
+        if result['status'] != 'ok':
+            regressions.append("{} n={} d={}: {} (was ok)".format(*case, result['status']))
+            continue
+
+        # Compare time and memory
+        for metric in ('fit_time', 'predict_time', 'peak_rss_mb'):
+            ratio = result[metric] / max(previous[metric], 1e-9)
+            if ratio > threshold:
+                regressions.append("{} n={} d={}: {} {:.3f} -> {:.3f} ({:.2f}x)".format(
+                    *case, metric, previous[metric], result[metric], ratio))
+
+    # Return regressions
+    return regressions
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Benchmark detectors on synthetic embeddings",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--output"    , default="benchmark.jsonl", help="file to write results to")
+    parser.add_argument("--detectors" , nargs='+', default=list(DETECTORS), choices=list(DETECTORS), help="detectors to benchmark")
+    parser.add_argument("--sizes"     , nargs='+', type=int, default=[1000, 10000, 100000, 1000000], help="numbers of policies")
+    parser.add_argument("--dimensions", nargs='+', type=int, default=[32, 64, 128, 256], help="embedding dimensions")
+    parser.add_argument("--outliers"  , type=float, default=0.01, help="fraction of outliers")
+    parser.add_argument("--timeout"   , type=float, help="maximum seconds per case")
+    parser.add_argument("--no-limits" , action='store_true', help="run all cases, ignoring MAX_SAMPLES")
+    parser.add_argument("--seed"      , type=int, default=0, help="seed for generating data")
+    parser.add_argument("--compare"   , nargs=2, metavar=('BASELINE', 'CURRENT'), help="compare two result files instead of running")
+    parser.add_argument("--threshold" , type=float, default=1.2, help="ratio considered a regression when comparing")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Compare results
+    if args.compare:
+        regressions = compare(*args.compare, threshold=args.threshold)
+        for regression in regressions:
+            print(regression)
+        sys.exit(1 if regressions else 0)
+
+    # Run benchmark
+    benchmark(
+        output           = args.output,
+        detectors        = args.detectors,
+        sizes            = args.sizes,
+        dimensions       = args.dimensions,
+        outlier_fraction = args.outliers,
+        max_samples      = dict() if args.no_limits else MAX_SAMPLES,
+        timeout          = args.timeout,
+        random_state     = args.seed,
+    )
@@ -0,0 +1,146 @@
+# Imports
+from detectors       import DETECTORS, SPARSE_DETECTORS, create_detector
+from features        import extract_features, load_policies, reduce_features
+from sklearn.metrics import precision_recall_fscore_support
+from utils           import embedding_matrix, repeated_split_data, retrieve_embeddings
+import argformat
+import argparse
+import os
+import pandas as pd
+import sys
+import time
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+
+def evaluate(matrices, X, detectors, n_repeats=5, random_state=0):
+    """Evaluate detectors on multiple feature matrices using the same splits.
+
+        Parameters
+        ----------
+        matrices : dict()
+            Dictionary of feature name -> matrix, row i describes policy i of X.
+
+        X : pd.DataFrame
+            Dataframe with a 'policy' column and a range index.
+
+        detectors : iterable of string
+            Names of detectors to evaluate.
+
+        n_repeats : int, default=5
+            Number of train-test splits.
+
+        random_state : int, default=0
+            Seed used for the splits.
+
+        Returns
+        -------
+        result : pd.DataFrame
+            Mean performance and timing per feature and detector.
+        """
+    results = list()
+
+    for seed, X_train, X_test, y_train, y_test in repeated_split_data(
+            X, n_repeats=n_repeats, random_state=random_state):
+        train = X_train.index.to_numpy()
+        test  = X_test .index.to_numpy()
+
+        for feature, matrix in matrices.items():
+            for detector in detectors:
+                # Sparse features only work with some detectors
+                if hasattr(matrix, 'tocsr') and detector not in SPARSE_DETECTORS:
+                    continue
+
+                # Fit and predict
+                start = time.perf_counter()
+                clf   = create_detector(detector).fit(matrix[train])
+                fit_time = time.perf_counter() - start
+
+                start  = time.perf_counter()
+                y_pred = clf.predict(matrix[test])
+                predict_time = time.perf_counter() - start
+
+                # Compute performance for misconfigurations
+                precision, recall, f1, _ = precision_recall_fscore_support(
+                    y_test, y_pred, labels=[-1], zero_division=0,
+                )
+                results.append({
+                    'feature'     : feature,
+                    'detector'    : detector,
+                    'precision'   : precision[0],
+                    'recall'      : recall[0],
+                    'f1'          : f1[0],
+                    'fit_time'    : fit_time,
+                    'predict_time': predict_time,
+                })
+
+    # Return mean over splits
+    return pd.DataFrame(results).groupby(['detector', 'feature']).mean().reset_index()
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Compare bag-of-permissions features with node2vec embeddings",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("snapshot"    , help="snapshot (.xlsx) that was loaded into the graph")
+    parser.add_argument("--detectors" , nargs='+', default=list(DETECTORS), choices=list(DETECTORS), help="detectors to compare")
+    parser.add_argument("--components", type=int, default=128, help="dimension of dense features")
+    parser.add_argument("--repeats"   , type=int, default=5  , help="number of train-test splits")
+    parser.add_argument("--seed"      , type=int, default=0  , help="seed used for splits")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                            Load features                             #
+    ########################################################################
+
+    # Load embeddings
+    start  = time.perf_counter()
+    embedded_nodes = retrieve_embeddings(get_driver(args.uri, args.user, args.password, args.pool_size))
+    embedded_nodes = embedded_nodes[embedded_nodes['embedding'].notna()]
+    embedding_time = time.perf_counter() - start
+
+    # Extract features
+    start = time.perf_counter()
+    X, sparse = extract_features(load_policies(args.snapshot))
+    sparse_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dense = reduce_features(sparse, n_components=args.components)
+    dense_time = sparse_time + time.perf_counter() - start
+
+    # Only compare policies present in both the graph and the snapshot
+    X = X.reset_index().merge(embedded_nodes.drop_duplicates('policy'), on='policy')
+    rows = X.pop('index').to_numpy()
+
+    ########################################################################
+    #                               Compare                                #
+    ########################################################################
+
+    result = evaluate(
+        matrices = {
+            'node2vec'   : embedding_matrix(X),
+            'bag-sparse' : sparse[rows],
+            'bag-dense'  : dense [rows],
+        },
+        X            = X[['policy']],
+        detectors    = args.detectors,
+        n_repeats    = args.repeats,
+        random_state = args.seed,
+    )
+
+    # Print result
+    print("Policies compared: {}".format(X.shape[0]))
+    print("Load time - node2vec (retrieval only): {:.4f}s, bag-sparse: {:.4f}s, bag-dense: {:.4f}s".format(
+        embedding_time, sparse_time, dense_time))
+    print(result.to_string(index=False, float_format='{:.4f}'.format))
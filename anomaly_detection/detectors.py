@@ -0,0 +1,196 @@
+from sklearn.base          import BaseEstimator, OutlierMixin
+from sklearn.covariance    import EllipticEnvelope
+from sklearn.decomposition import PCA
+from sklearn.ensemble      import IsolationForest
+from sklearn.manifold      import TSNE
+from sklearn.neighbors     import LocalOutlierFactor
+from sklearn.svm           import OneClassSVM
+from sklearn.utils         import check_array
+import numpy as np
+
+################################################################################
+#                              Detector variants                               #
+################################################################################
+
+class TSNELocalOutlierFactor(BaseEstimator, OutlierMixin):
+    """Local Outlier Factor on a t-SNE projection, as in local_outlier_factor.py.
+
+        Note
+        ----
+        t-SNE cannot transform unseen samples, therefore the samples given to
+        fit() and predict() are each projected separately.
+
+        Parameters
+        ----------
+        n_neighbors : int, default=5
+            Number of neighbors used by LocalOutlierFactor.
+
+        n_components : int, default=2
+            Dimension of the t-SNE projection.
+
+        random_state : int, default=6
+            Random state used for the t-SNE projection.
+        """
+
+    def __init__(self, n_neighbors=5, n_components=2, random_state=6):
+        self.n_neighbors  = n_neighbors
+        self.n_components = n_components
+        self.random_state = random_state
+
+    def _project(self, X):
+        """Project X using t-SNE."""
+        return TSNE(
+            n_components = self.n_components,
+            random_state = self.random_state,
+        ).fit_transform(X)
+
+    def fit(self, X, y=None):
+        """Fit LocalOutlierFactor on the t-SNE projection of X."""
+        self.lof_ = LocalOutlierFactor(n_neighbors=self.n_neighbors, novelty=True)
+        self.lof_.fit(self._project(X))
+        return self
+
+    def predict(self, X):
+        """Predict inliers (1) and outliers (-1) on the t-SNE projection of X."""
+        return self.lof_.predict(self._project(X))
+
+    def decision_function(self, X):
+        """Compute anomaly scores on the t-SNE projection of X, negative
+            scores are outliers."""
+        return self.lof_.decision_function(self._project(X))
+
+
+class ProjectedLocalOutlierFactor(BaseEstimator, OutlierMixin):
+    """Local Outlier Factor on the raw or linearly projected embedding space.
+
+        Unlike TSNELocalOutlierFactor, the projection is fitted on the train
+        data only and applied to the test data, such that both sets are in the
+        same coordinate system. Neighbors are retrieved from a tree (or brute
+        force) index, queried in batches using multiple threads.
+
+        Parameters
+        ----------
+        n_neighbors : int, default=5
+            Number of neighbors used by LocalOutlierFactor.
+
+        projection : 'pca' or None, default='pca'
+            If 'pca', project samples onto the first n_components principal
+            components of the train data. If None, use raw embeddings.
+
+        n_components : int, default=32
+            Dimension of the projection, ignored if projection is None.
+
+        algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, default='auto'
+            Index used to retrieve nearest neighbors.
+
+        batch_size : int, default=8192
+            Number of samples for which to query neighbors at once.
+
+        n_jobs : int, default=-1
+            Number of threads used for neighbor queries, -1 uses all cores.
+
+        random_state : int, default=6
+            Random state used for the projection.
+        """
+
+    def __init__(self, n_neighbors=5, projection='pca', n_components=32,
+                 algorithm='auto', batch_size=8192, n_jobs=-1, random_state=6):
+        self.n_neighbors  = n_neighbors
+        self.projection   = projection
+        self.n_components = n_components
+        self.algorithm    = algorithm
+        self.batch_size   = batch_size
+        self.n_jobs       = n_jobs
+        self.random_state = random_state
+
+    def _project(self, X):
+        """Apply fitted projection to X."""
+        if self.projection_ is None:
+            return X
+        return self.projection_.transform(X)
+
+    def fit(self, X, y=None):
+        """Fit projection and LocalOutlierFactor on X."""
+        X = check_array(X, accept_sparse='csr')
+
+        # Fit projection on train data only
+        if self.projection is None:
+            self.projection_ = None
+        elif self.projection == 'pca':
+            self.projection_ = PCA(
+                n_components = min(self.n_components, *np.shape(X)),
+                random_state = self.random_state,
+            ).fit(X)
+        else:
+            raise ValueError("Unknown projection '{}'".format(self.projection))
+
+        # Fit LocalOutlierFactor on projected data
+        self.lof_ = LocalOutlierFactor(
+            n_neighbors = self.n_neighbors,
+            algorithm   = self.algorithm,
+            n_jobs      = self.n_jobs,
+            novelty     = True,
+        ).fit(self._project(X))
+        return self
+
+    def decision_function(self, X):
+        """Compute anomaly scores of X, negative scores are outliers."""
+        X = check_array(X, accept_sparse='csr')
+        return np.concatenate([
+            self.lof_.decision_function(self._project(X[start:start+self.batch_size]))
+            for start in range(0, X.shape[0], self.batch_size)
+        ] or [np.zeros(0)])
+
+    def predict(self, X):
+        """Predict inliers (1) and outliers (-1) of X."""
+        return np.where(self.decision_function(X) < 0, -1, 1)
+
+################################################################################
+#                              Detector registry                               #
+################################################################################
+
+# Detectors and their default parameters, named after the corresponding scripts.
+# The local_outlier_factor_* variants are the t-SNE free modes of
+# local_outlier_factor.py. Note that isolation_forest.py fits 10 trees and warm
+# starts 10 more, which equals a forest of 20 trees fitted at once.
+DETECTORS = {
+    'isolation_forest'        : (IsolationForest            , {'n_estimators': 20}),
+    'local_outlier_factor'    : (TSNELocalOutlierFactor     , {'n_neighbors': 5, 'random_state': 6}),
+    'local_outlier_factor_raw': (ProjectedLocalOutlierFactor, {'n_neighbors': 5, 'projection': None}),
+    'local_outlier_factor_pca': (ProjectedLocalOutlierFactor, {'n_neighbors': 5, 'projection': 'pca'}),
+    'one_class_svm'           : (OneClassSVM                , {'gamma': 0.001, 'nu': 0.5}),
+    'robust_covariance'       : (EllipticEnvelope           , {'random_state': 1, 'contamination': 0.1}),
+}
+
+# Detectors that accept sparse input, e.g., features.extract_features()
+SPARSE_DETECTORS = {
+    'isolation_forest',
+    'local_outlier_factor_raw',
+    'one_class_svm',
+}
+
+
+def create_detector(name, **params):
+    """Create an unfitted anomaly detector.
+
+        Parameters
+        ----------
+        name : string
+            Name of detector, see DETECTORS.
+
+        **params : optional
+            Parameters overwriting the default parameters of the detector.
+
+        Returns
+        -------
+        detector : sklearn estimator
+            Unfitted detector predicting inliers (1) and outliers (-1).
+        """
+    # Check if detector exists
+    if name not in DETECTORS:
+        raise ValueError("Unknown detector '{}', choose one of {}".format(
+            name, sorted(DETECTORS)))
+
+    # Create detector
+    detector, defaults = DETECTORS[name]
+    return detector(**{**defaults, **params})
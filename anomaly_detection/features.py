@@ -0,0 +1,294 @@
+from sklearn.decomposition       import TruncatedSVD
+from sklearn.feature_extraction  import FeatureHasher
+from sklearn.preprocessing       import normalize
+import json
+import numpy  as np
+import pandas as pd
+import re
+import scipy.sparse as sp
+import warnings
+
+################################################################################
+#                              Policy documents                                #
+################################################################################
+
+def load_policies(file_path):
+    """Load policy documents from an Excel file created by the collector.
+
+        Parameters
+        ----------
+        file_path : string
+            File path from which to load data.
+
+        Returns
+        -------
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName' and 'PolicyObject' column.
+        """
+    # Read only the policies sheet
+    policies = pd.read_excel(file_path, sheet_name='policies', index_col=0)
+    policies = policies.fillna('')
+
+    # Check if extra space was needed for the policy object, if so merge it again
+    if 'ExtraPolicySpace' in policies.columns:
+        policies['PolicyObject'] = policies['PolicyObject'].astype(str) + policies['ExtraPolicySpace'].astype(str)
+
+    # Return result
+    return policies[['PolicyName', 'PolicyObject']].reset_index(drop=True)
+
+
+def parse_policy(policy_object):
+    """Parse the statements of a policy object as stored by the collector.
+
+        Parameters
+        ----------
+        policy_object : string
+            Policy object as stored in the PolicyObject column.
+
+        Returns
+        -------
+        statements : list of dict()
+            Statements of policy, empty if the policy could not be parsed.
+        """
+    # Replace python formatting for json parsing, as in load_data.py
+    policy_object = str(policy_object).replace("\'", "\"")
+    policy_object = policy_object.replace("True", "true")
+    policy_object = policy_object.replace("False", "false")
+
+    try:
+        statements = json.loads(policy_object)
+    except json.decoder.JSONDecodeError:
+        return list()
+
+    # Return statements as list
+    if not isinstance(statements, list):
+        statements = [statements]
+    return [statement for statement in statements if isinstance(statement, dict)]
+
+
+def _as_list(value):
+    """Return value as list, None is returned as empty list."""
+    if value is None:
+        return list()
+    if isinstance(value, list):
+        return value
+    return [value]
+
+################################################################################
+#                                   Tokens                                     #
+################################################################################
+
+# Account identifiers and other long numbers in resources
+NUMBER = re.compile(r'\d{6,}')
+
+
+def resource_pattern(resource):
+    """Generalize a resource to a pattern shared by similar resources.
+
+        Keeps the partition, service and resource type of an ARN, and whether
+        the region, account and resource name are given or wildcards.
+
+        Parameters
+        ----------
+        resource : string
+            Resource as given in a statement.
+
+        Returns
+        -------
+        pattern : string
+            Generalized resource pattern.
+        """
+    resource = str(resource)
+    if resource == '*':
+        return '*'
+
+    parts = resource.split(':', 5)
+    if len(parts) < 6 or parts[0] != 'arn':
+        return NUMBER.sub('#', resource)
+
+    # Generalize region, account and resource name
+    _, partition, service, region, account, name = parts
+    region  = '*' if '*' in region  else ('' if not region  else 'region' )
+    account = '*' if '*' in account else ('' if not account else 'account')
+    kind    = re.split(r'[/:]', name, maxsplit=1)[0] if re.search(r'[/:]', name) else ''
+    suffix  = '*' if name.endswith('*') else 'name'
+
+    # Return pattern
+    return ':'.join(('arn', partition, service, region, account, '{}/{}'.format(kind, suffix)))
+
+
+def statement_tokens(statement):
+    """Extract bag-of-permission tokens from a single statement.
+
+        Parameters
+        ----------
+        statement : dict()
+            Statement of a policy.
+
+        Returns
+        -------
+        tokens : list of string
+            Tokens describing the effect, actions, action prefixes, resource
+            patterns and wildcards of the statement.
+        """
+    effect = str(statement.get('Effect', 'Allow'))
+    tokens = ['effect=' + effect]
+
+    # Extract actions and resources, prefixing the negated variants
+    actions   = [('', a) for a in _as_list(statement.get('Action'     ))] + \
+                [('!', a) for a in _as_list(statement.get('NotAction'  ))]
+    resources = [('', r) for r in _as_list(statement.get('Resource'   ))] + \
+                [('!', r) for r in _as_list(statement.get('NotResource'))]
+
+    if 'Condition' in statement:
+        tokens.append('condition=' + effect)
+
+    # Action tokens
+    for negation, action in actions:
+        action  = str(action).lower()
+        service = action.split(':', 1)[0]
+        tokens.append('action={}:{}{}'.format(effect, negation, action))
+        tokens.append('prefix={}:{}{}'.format(effect, negation, service))
+        if action == '*':
+            tokens.append('wildcard={}:{}action:all'.format(effect, negation))
+        elif action.endswith(':*'):
+            tokens.append('wildcard={}:{}action:service'.format(effect, negation))
+        elif '*' in action:
+            tokens.append('wildcard={}:{}action:partial'.format(effect, negation))
+
+    # Resource tokens
+    for negation, resource in resources:
+        pattern = resource_pattern(resource)
+        tokens.append('resource={}:{}{}'.format(effect, negation, pattern))
+        if pattern == '*':
+            tokens.append('wildcard={}:{}resource:all'.format(effect, negation))
+        elif '*' in str(resource):
+            tokens.append('wildcard={}:{}resource:partial'.format(effect, negation))
+
+    # Services granted on all resources
+    if any(pattern == '*' for _, pattern in resources):
+        for negation, action in actions:
+            tokens.append('unrestricted={}:{}{}'.format(
+                effect, negation, str(action).lower().split(':', 1)[0]))
+
+    # Return tokens
+    return tokens
+
+
+def policy_tokens(policy_object):
+    """Extract bag-of-permission tokens from a policy object.
+
+        Parameters
+        ----------
+        policy_object : string
+            Policy object as stored in the PolicyObject column.
+
+        Returns
+        -------
+        tokens : list of string
+            Tokens of all statements in the policy.
+        """
+    tokens = list()
+    for statement in parse_policy(policy_object):
+        tokens.extend(statement_tokens(statement))
+    return tokens
+
+################################################################################
+#                              Feature extraction                              #
+################################################################################
+
+def extract_features(policies, n_features=2**18, chunk_size=4096):
+    """Extract a sparse bag-of-permissions matrix from policy documents.
+
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName' and 'PolicyObject' column, e.g., as
+            returned by load_policies().
+
+        n_features : int, default=2**18
+            Number of hashed features.
+
+        chunk_size : int, default=4096
+            Number of policies to hash at once.
+
+        Returns
+        -------
+        X : pd.DataFrame
+            Dataframe with a 'policy' column, row i describes row i of matrix.
+            Can be given to utils.split_data() as a drop-in for embeddings.
+
+        matrix : scipy.sparse.csr_matrix of shape=(n_policies, n_features)
+            L2-normalized counts of hashed tokens per policy.
+        """
+    hasher = FeatureHasher(
+        n_features     = n_features,
+        input_type     = 'string',
+        alternate_sign = False,
+    )
+
+    # Hash tokens in chunks to bound memory of intermediate token lists
+    objects = policies['PolicyObject'].tolist()
+    chunks  = list()
+    for start in range(0, len(objects), chunk_size):
+        tokens = [policy_tokens(policy) for policy in objects[start:start+chunk_size]]
+        chunks.append(hasher.transform(tokens))
+
+    # Combine chunks
+    if chunks:
+        matrix = sp.vstack(chunks, format='csr')
+    else:
+        matrix = sp.csr_matrix((0, n_features))
+
+    # Warn about policies that could not be parsed
+    empty = np.flatnonzero(matrix.getnnz(axis=1) == 0)
+    if empty.shape[0]:
+        warnings.warn("{} policies without features, e.g., '{}'".format(
+            empty.shape[0], policies['PolicyName'].iloc[empty[0]]))
+
+    # Return result
+    X = pd.DataFrame({'policy': policies['PolicyName'].to_numpy()})
+    return X, normalize(matrix, norm='l2', copy=False)
+
+
+def reduce_features(matrix, n_components=128, random_state=0, return_reducer=False):
+    """Reduce a sparse feature matrix to a dense matrix.
+
+        Required by detectors that do not support sparse input, e.g., the
+        EllipticEnvelope and t-SNE based detectors.
+
+        Parameters
+        ----------
+        matrix : scipy.sparse.csr_matrix of shape=(n_policies, n_features)
+            Matrix as returned by extract_features().
+
+        n_components : int, default=128
+            Dimension of dense output, by default equal to the node2vec
+            embedding dimension.
+
+        random_state : int, default=0
+            Random state of TruncatedSVD.
+
+        return_reducer : boolean, default=False
+            If True, also return the fitted TruncatedSVD, such that the same
+            reduction can be applied to the features of other policies.
+
+        Returns
+        -------
+        result : np.array of shape=(n_policies, n_components)
+            Dense features.
+
+        reducer : TruncatedSVD
+            Fitted reduction, only returned if return_reducer is True.
+        """
+    n_components = min(n_components, matrix.shape[0] - 1, matrix.shape[1] - 1)
+    reducer = TruncatedSVD(
+        n_components = n_components,
+        random_state = random_state,
+    )
+    result = reducer.fit_transform(matrix)
+
+    # Return result
+    if return_reducer:
+        return result, reducer
+    return result
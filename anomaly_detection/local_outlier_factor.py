@@ -1,28 +1,60 @@
-from neo4j             import GraphDatabase
-from sklearn.manifold  import TSNE
+from detectors         import ProjectedLocalOutlierFactor, TSNELocalOutlierFactor
 from sklearn.metrics   import classification_report
-from sklearn.neighbors import LocalOutlierFactor
-from utils             import retrieve_embeddings, split_data
+from utils             import embedding_matrix, retrieve_embeddings, split_data
+import argformat
+import argparse
+import os
+import sys
+import time
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import get_driver
 
 if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(
+        description     = "Local Outlier Factor",
+        formatter_class = argformat.StructuredFormatter,
+    )
+    parser.add_argument("--mode", nargs='+', default=['tsne'], choices=['tsne', 'raw', 'pca'],
+        help="space in which to run LOF, multiple modes are reported side by side")
+    parser.add_argument("--components", type=int, default=32, help="dimension of pca projection")
+    parser.add_argument("--jobs"      , type=int, default=-1, help="threads used for neighbor queries")
+    args = parser.parse_args()
+
     # Load data
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "password"))
-    embedded_nodes = retrieve_embeddings(driver)
+    embedded_nodes = retrieve_embeddings(get_driver())
 
     # Split into train and test sets
     X_train, X_test, y_train, y_test = split_data(embedded_nodes)
+    X_train = embedding_matrix(X_train)
+    X_test  = embedding_matrix(X_test)
+
+    # Perform anomaly detection for each mode
+    for mode in args.mode:
+        if mode == 'tsne':
+            clf = TSNELocalOutlierFactor(n_neighbors=5, random_state=6)
+        else:
+            clf = ProjectedLocalOutlierFactor(
+                n_neighbors  = 5,
+                projection   = None if mode == 'raw' else mode,
+                n_components = args.components,
+                n_jobs       = args.jobs,
+            )
 
-    # Perform anomaly detection
-    X_train_embedded = TSNE(n_components=2, random_state=6).fit_transform(list(X_train.embedding))
-    X_test_embedded  = TSNE(n_components=2, random_state=6).fit_transform(list(X_test .embedding))
+        start = time.perf_counter()
+        clf.fit(X_train)
+        fit_time = time.perf_counter() - start
 
-    clf = LocalOutlierFactor(n_neighbors=5, novelty=True)
-    clf.fit(X_train_embedded.tolist())
-    y_true, y_pred = y_test, clf.predict(X_test_embedded.tolist())
+        start = time.perf_counter()
+        y_true, y_pred = y_test, clf.predict(X_test)
+        predict_time = time.perf_counter() - start
 
-    # Print performance
-    print(classification_report(
-        y_true = y_true,
-        y_pred = y_pred,
-        digits = 4,
-    ))
+        # Print performance
+        print("LOF ({}) - fit: {:.4f}s, predict: {:.4f}s".format(mode, fit_time, predict_time))
+        print(classification_report(
+            y_true = y_true,
+            y_pred = y_pred,
+            digits = 4,
+        ))
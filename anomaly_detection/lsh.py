@@ -0,0 +1,440 @@
+# Imports
+from features import NUMBER, _as_list, load_policies, parse_policy
+import argformat
+import argparse
+import fnmatch
+import numpy  as np
+import os
+import pandas as pd
+import scipy.sparse as sp
+import sys
+import zlib
+
+from scipy.sparse.csgraph import connected_components
+
+# Shared instrumentation layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import metrics
+
+################################################################################
+#                               Permission sets                                #
+################################################################################
+
+def statement_permissions(statement):
+    """Return the normalized (action, resource) pairs of a single statement.
+
+        Parameters
+        ----------
+        statement : dict()
+            Statement of a policy.
+
+        Returns
+        -------
+        permissions : list of string
+            Pairs formatted as "<effect>:<action>|<resource>", where actions
+            are lowercased, account numbers in resources are replaced by "#",
+            NotAction and NotResource are prefixed with "!" and conditional
+            statements are suffixed with "?".
+        """
+    effect    = str(statement.get('Effect', 'Allow')).lower()
+    condition = '?' if 'Condition' in statement else ''
+
+    actions   = [( '', a) for a in _as_list(statement.get('Action'     ))] + \
+                [('!', a) for a in _as_list(statement.get('NotAction'  ))]
+    resources = [( '', r) for r in _as_list(statement.get('Resource'   ))] + \
+                [('!', r) for r in _as_list(statement.get('NotResource'))]
+
+    # Return pairs
+    return [
+        '{}:{}{}|{}{}{}'.format(
+            effect, action_negation, str(action).strip().lower(),
+            resource_negation, NUMBER.sub('#', str(resource).strip()), condition,
+        )
+        for action_negation, action in actions
+        for resource_negation, resource in resources
+    ]
+
+
+def added_wildcards(added, granted, policy=None):
+    """Count the added permissions that grant access through a wildcard.
+
+        Almost every statement applies to all resources ("*"), so a resource
+        wildcard only counts if it is broader than a resource that another
+        policy of the cluster grants for the same action. The other policies
+        are used rather than the consensus, as the consensus of a pair of
+        policies is their intersection, which never contains the narrower
+        resource that one of them broadened.
+
+        Parameters
+        ----------
+        added : iterable of string
+            Added permissions, formatted as by statement_permissions().
+
+        granted : dict()
+            Dictionary of "<effect>:<action>" -> list of (policy, resource)
+            granted by the policies of the cluster.
+
+        policy : int, optional
+            Policy of which permissions were added, its own resources in
+            granted are ignored.
+
+        Returns
+        -------
+        n_wildcards : int
+            Number of added Allow permissions with a wildcard action, a
+            NotAction, or a resource wildcard broader than a resource of
+            another policy of the cluster.
+        """
+    n_wildcards = 0
+    for permission in added:
+        action, resource = permission.split('|', 1)
+        if not action.startswith('allow:'):
+            continue
+
+        # Wildcard or negated actions grant more than a single action
+        if '*' in action or action.startswith('allow:!'):
+            n_wildcards += 1
+
+        # Wildcard resources count if they cover a narrower resource of another policy
+        elif '*' in resource:
+            pattern = resource.rstrip('?')
+            n_wildcards += any(
+                other_policy != policy and other != resource and
+                fnmatch.fnmatchcase(other.rstrip('?'), pattern)
+                for other_policy, other in granted.get(action, ())
+            )
+
+    # Return result
+    return n_wildcards
+
+
+def permission_sets(policies):
+    """Return the set of normalized (action, resource) pairs of each policy.
+
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName' and 'PolicyObject' column.
+
+        Returns
+        -------
+        permissions : pd.DataFrame
+            DataFrame with a 'policy' column containing the position of the
+            policy in policies and a 'permission' column, one row per
+            distinct pair of each policy.
+        """
+    records = [
+        (index, permission)
+        for index, policy_object in enumerate(policies['PolicyObject'])
+        for statement in parse_policy(policy_object)
+        for permission in statement_permissions(statement)
+    ]
+
+    # Return result
+    return pd.DataFrame(records, columns=['policy', 'permission']).drop_duplicates(ignore_index=True)
+
+################################################################################
+#                                   MinHash                                    #
+################################################################################
+
+# Mersenne prime used for the universal hash functions of MinHash
+MERSENNE = np.uint64((1 << 61) - 1)
+
+
+def minhash(permissions, n_policies, num_perm=128, random_state=0, chunk_size=2**16):
+    """Compute the MinHash signature of the permission set of each policy.
+
+        Each distinct permission is hashed once, after which all signatures
+        are computed at once by taking segment-wise minima of num_perm
+        universal hash functions over the permissions of each policy.
+
+        Parameters
+        ----------
+        permissions : pd.DataFrame
+            Permissions as returned by permission_sets().
+
+        n_policies : int
+            Number of policies.
+
+        num_perm : int, default=128
+            Number of hash functions, i.e., length of each signature.
+
+        random_state : int, default=0
+            Random state of hash functions.
+
+        chunk_size : int, default=2**16
+            Number of permissions hashed at once, limits memory usage to
+            chunk_size * num_perm * 8 bytes.
+
+        Returns
+        -------
+        signatures : np.array of shape=(n_policies, num_perm)
+            Signature of each policy, policies without permissions have a
+            signature of all 2**32-1.
+        """
+    random = np.random.RandomState(random_state)
+    a = random.randint(1, 2**61 - 1, size=num_perm, dtype=np.uint64)
+    b = random.randint(0, 2**61 - 1, size=num_perm, dtype=np.uint64)
+
+    # Hash each distinct permission to 32 bits
+    codes, uniques = pd.factorize(permissions['permission'])
+    hashes = np.fromiter(
+        (zlib.crc32(permission.encode('utf-8')) for permission in uniques),
+        dtype = np.uint64,
+        count = len(uniques),
+    )[codes]
+
+    # Permissions are sorted by policy, such that each policy is a segment
+    order    = np.argsort(permissions['policy'].values, kind='stable')
+    policies = permissions['policy'].values[order]
+    hashes   = hashes[order]
+
+    signatures = np.full((n_policies, num_perm), 0xffffffff, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for start in range(0, hashes.shape[0], chunk_size):
+            chunk    = slice(start, start + chunk_size)
+            segments = np.flatnonzero(np.r_[True, np.diff(policies[chunk]) != 0])
+            values   = ((hashes[chunk, None] * a + b) % MERSENNE) & np.uint64(0xffffffff)
+            minima   = np.minimum.reduceat(values, segments, axis=0)
+
+            # Policies may span multiple chunks
+            rows = policies[chunk][segments]
+            signatures[rows] = np.minimum(signatures[rows], minima)
+
+    # Return result
+    return signatures.astype(np.uint32)
+
+
+def lsh_bands(num_perm, threshold):
+    """Select the number of bands and rows per band of the LSH index.
+
+        Selects the bands b and rows r minimizing the sum of the probability
+        of false positives (Jaccard similarity below threshold) and false
+        negatives (Jaccard similarity above threshold), where a pair with
+        similarity s becomes a candidate with probability 1 - (1 - s^r)^b.
+
+        Parameters
+        ----------
+        num_perm : int
+            Length of signatures.
+
+        threshold : float
+            Jaccard similarity threshold of near-duplicates.
+
+        Returns
+        -------
+        bands : int
+            Number of bands.
+
+        rows : int
+            Number of rows per band.
+        """
+    similarity = np.linspace(0, 1, 1001)
+    best = None
+
+    for rows in range(1, num_perm + 1):
+        bands       = num_perm // rows
+        probability = 1 - (1 - similarity ** rows) ** bands
+        error       = np.trapezoid(np.where(similarity < threshold, probability, 1 - probability), similarity)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+
+    # Return result
+    return best[1], best[2]
+
+################################################################################
+#                               Near-duplicates                                #
+################################################################################
+
+@metrics.timed('detect.lsh.clusters')
+def near_duplicate_clusters(signatures, threshold=0.8, empty=None):
+    """Cluster policies with near-duplicate permission sets.
+
+        Each band of the signatures is hashed into buckets. Each policy is
+        linked to the first policy of each of its buckets if their signatures
+        estimate a Jaccard similarity of at least threshold, and clusters are
+        the connected components of these links. The number of compared pairs
+        is linear in the number of policies, instead of quadratic.
+
+        Parameters
+        ----------
+        signatures : np.array of shape=(n_policies, num_perm)
+            Signatures as returned by minhash().
+
+        threshold : float, default=0.8
+            Jaccard similarity threshold of near-duplicates.
+
+        empty : np.array of shape=(n_policies,), optional
+            Boolean mask of policies without permissions, which are never
+            clustered.
+
+        Returns
+        -------
+        clusters : np.array of shape=(n_policies,)
+            Cluster of each policy.
+        """
+    n_policies, num_perm = signatures.shape
+    bands, rows = lsh_bands(num_perm, threshold)
+    candidates  = np.ones(n_policies, dtype=bool) if empty is None else ~empty
+
+    sources = list()
+    targets = list()
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[:, band*rows:(band+1)*rows]).view(
+            np.dtype((np.void, 4 * rows))).ravel()
+
+        # First policy of each bucket
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        representative = first[inverse]
+
+        # Link policies to their representative if their signatures are similar
+        link = candidates & candidates[representative] & (representative != np.arange(n_policies))
+        link[link] = (signatures[link] == signatures[representative[link]]).mean(axis=1) >= threshold
+        sources.append(np.flatnonzero(link))
+        targets.append(representative[link])
+
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    graph   = sp.coo_matrix((np.ones(sources.shape[0]), (sources, targets)), shape=(n_policies, n_policies))
+
+    # Return result
+    return connected_components(graph, directed=False)[1]
+
+
+@metrics.timed('detect.lsh')
+def near_duplicates(policies, threshold=0.8, num_perm=128, random_state=0):
+    """Find near-duplicate policies and their deltas with their cluster.
+
+        The delta of a policy is given with respect to the consensus of its
+        cluster, i.e., the permissions contained in more than half of the
+        policies of the cluster. E.g., a copy of a policy that adds "*" to
+        its resources shows the added permissions.
+
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName' and 'PolicyObject' column.
+
+        threshold : float, default=0.8
+            Jaccard similarity threshold of near-duplicates.
+
+        num_perm : int, default=128
+            Length of MinHash signatures.
+
+        random_state : int, default=0
+            Random state of MinHash.
+
+        Returns
+        -------
+        result : pd.DataFrame
+            DataFrame with for each policy its 'policy' name, 'cluster',
+            'cluster_size', 'reference', i.e., the policy of the cluster
+            closest to its consensus, the Jaccard 'similarity' with the
+            consensus, the 'added' and 'removed' permissions, the number of
+            'n_added' and 'n_removed' permissions, and the number of
+            'n_added_wildcards', see added_wildcards().
+            Policies that are not near-duplicates form clusters of size 1
+            with empty deltas.
+        """
+    n_policies  = policies.shape[0]
+    permissions = permission_sets(policies)
+    signatures  = minhash(permissions, n_policies, num_perm=num_perm, random_state=random_state)
+    sizes       = np.bincount(permissions['policy'], minlength=n_policies)
+    clusters    = near_duplicate_clusters(signatures, threshold=threshold, empty=sizes == 0)
+    cluster_size = np.bincount(clusters)[clusters]
+
+    # Consensus of each cluster
+    permissions['cluster'] = clusters[permissions['policy']]
+    counts    = permissions.groupby(['cluster', 'permission']).size().rename('count').reset_index()
+    consensus = counts[2 * counts['count'] > np.bincount(clusters)[counts['cluster']]][['cluster', 'permission']]
+
+    # Compare each policy with the consensus of its cluster
+    members = pd.DataFrame({'policy': np.arange(n_policies), 'cluster': clusters})
+    pairs   = permissions.merge(
+        members.merge(consensus, on='cluster'),
+        on  = ['policy', 'cluster', 'permission'],
+        how = 'outer',
+        indicator = True,
+    )
+    added   = pairs[pairs['_merge'] == 'left_only' ].groupby('policy')['permission'].agg(sorted)
+    removed = pairs[pairs['_merge'] == 'right_only'].groupby('policy')['permission'].agg(sorted)
+    common  = np.bincount(pairs.loc[pairs['_merge'] == 'both', 'policy'], minlength=n_policies)
+    size    = np.bincount(consensus['cluster'], minlength=clusters.max() + 1)[clusters]
+
+    result = pd.DataFrame({
+        'policy'      : policies['PolicyName'].values,
+        'cluster'     : clusters,
+        'cluster_size': cluster_size,
+        'similarity'  : np.divide(common, sizes + size - common,
+                                  out=np.zeros(n_policies), where=sizes + size - common > 0),
+        'added'       : [added  .get(index, []) for index in range(n_policies)],
+        'removed'     : [removed.get(index, []) for index in range(n_policies)],
+    })
+
+    # Policies without near-duplicates have no delta
+    single = result['cluster_size'] == 1
+    result.loc[single, 'similarity'] = 1.0
+    result.loc[single, 'added'     ] = pd.Series([[]] * single.sum(), index=result.index[single], dtype=object)
+    result.loc[single, 'removed'   ] = pd.Series([[]] * single.sum(), index=result.index[single], dtype=object)
+
+    result['n_added'  ] = result['added'  ].map(len)
+    result['n_removed'] = result['removed'].map(len)
+
+    # Resources granted for each action by the policies, only of clusters with added permissions
+    selected = permissions[permissions['cluster'].isin(result.loc[result['n_added'] > 0, 'cluster'])]
+    actions  = dict()
+    for cluster, policy, permission in zip(selected['cluster'], selected['policy'], selected['permission']):
+        action, resource = permission.split('|', 1)
+        actions.setdefault(cluster, dict()).setdefault(action, []).append((policy, resource))
+
+    result['n_added_wildcards'] = [
+        added_wildcards(added, actions.get(cluster, {}), policy) if added else 0
+        for policy, (added, cluster) in enumerate(zip(result['added'], result['cluster']))
+    ]
+
+    # Reference of each cluster is the policy closest to its consensus
+    closest = result.sort_values('similarity', ascending=False, kind='stable').drop_duplicates('cluster')
+    result.insert(3, 'reference', result['cluster'].map(closest.set_index('cluster')['policy']))
+
+    # Return result
+    return result
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Find near-duplicate policies and their deltas using MinHash LSH",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("file", nargs='?', default="../collector/example/iam_policy_data_2021-03-26_14:11.xlsx", help="snapshot from which to load policies")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Jaccard similarity threshold of near-duplicates")
+    parser.add_argument("--num-perm" , type=int  , default=128, help="length of MinHash signatures")
+    parser.add_argument("--output"   , help="CSV file to write the delta of each policy to")
+    parser.add_argument("--top"      , type=int  , default=20 , help="number of largest deltas to show")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                           Near-duplicates                            #
+    ########################################################################
+
+    result = near_duplicates(load_policies(args.file), threshold=args.threshold, num_perm=args.num_perm)
+
+    clustered = result[result['cluster_size'] > 1]
+    print("{} of {} policies are near-duplicates, in {} clusters".format(
+        clustered.shape[0], result.shape[0], clustered['cluster'].nunique()))
+
+    # Show largest deltas, wildcards first
+    print()
+    print(clustered[clustered['n_added'] > 0].sort_values(
+        ['n_added_wildcards', 'n_added'], ascending=False,
+    ).head(args.top)[['policy', 'reference', 'cluster_size', 'similarity', 'n_added', 'n_added_wildcards', 'added']].to_string(index=False))
+
+    if args.output:
+        result.to_csv(args.output, index=False)
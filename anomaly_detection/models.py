@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+from features import extract_features
+import joblib
+import os
+import sklearn
+
+# Kinds of features on which a model can be fitted
+FEATURES = ('node2vec', 'permissions')
+
+
+def save_model(path, model, embedding_version, detector=None, features='node2vec', reducer=None, **metadata):
+    """Persist a fitted detector together with the embedding it was fitted on.
+
+        Parameters
+        ----------
+        path : string
+            Path to which to write the model.
+
+        model : sklearn estimator
+            Fitted detector to store.
+
+        embedding_version : string
+            Version of the embedding on which the model was fitted, see
+            utils.embedding_version().
+
+        detector : string, optional
+            Name of detector, see detectors.DETECTORS.
+
+        features : string, default='node2vec'
+            Features on which the model was fitted, either 'node2vec' for
+            the graph embedding or 'permissions' for the bag-of-permissions
+            features of features.extract_features().
+
+        reducer : TruncatedSVD, optional
+            Fitted reduction of the bag-of-permissions features, see
+            features.reduce_features(), None if the features were not reduced.
+
+        **metadata : optional
+            Additional metadata to store with the model, e.g., the seed used
+            for the train-test split.
+        """
+    if features not in FEATURES:
+        raise ValueError("Unknown features '{}', should be one of {}".format(features, FEATURES))
+
+    # Create output directory if required
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    # Store model with its metadata
+    joblib.dump({
+        'model'            : model,
+        'detector'         : detector,
+        'params'           : model.get_params(),
+        'embedding_version': embedding_version,
+        'features'         : features,
+        'reducer'          : reducer,
+        'sklearn_version'  : sklearn.__version__,
+        'created'          : datetime.now(timezone.utc).isoformat(),
+        'metadata'         : metadata,
+    }, path)
+
+
+def load_model(path):
+    """Load a detector stored by save_model().
+
+        Parameters
+        ----------
+        path : string
+            Path from which to load the model.
+
+        Returns
+        -------
+        stored : dict()
+            Dictionary containing the fitted 'model', the 'embedding_version'
+            and 'features' on which it was fitted and the remaining metadata
+            given to save_model().
+        """
+    stored = joblib.load(path)
+
+    # Models stored before the features were recorded are fitted on the graph embedding
+    stored.setdefault('features', 'node2vec')
+    stored.setdefault('reducer' , None)
+
+    # Return result
+    return stored
+
+
+def policy_features(stored, policies):
+    """Reproduce the bag-of-permissions features a stored model was fitted on.
+
+        Parameters
+        ----------
+        stored : dict()
+            Model as returned by load_model(), fitted on 'permissions'.
+
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName' and 'PolicyObject' column.
+
+        Returns
+        -------
+        matrix : np.array or scipy.sparse.csr_matrix of shape=(n_policies, n_dimensions)
+            Features of policies, reduced by the stored reducer if any.
+        """
+    if stored['features'] != 'permissions':
+        raise ValueError("Model was fitted on {} features, not on permissions".format(stored['features']))
+
+    _, matrix = extract_features(policies)
+    if stored['reducer'] is not None:
+        matrix = stored['reducer'].transform(matrix)
+
+    # Return result
+    return matrix
+
+
+def model_path(directory, detector, embedding_version):
+    """Return the default path for storing a detector.
+
+        Parameters
+        ----------
+        directory : string
+            Directory in which to store models.
+
+        detector : string
+            Name of detector, see detectors.DETECTORS.
+
+        embedding_version : string
+            Version of the embedding on which the model was fitted.
+
+        Returns
+        -------
+        path : string
+            Path of the form <directory>/<detector>-<embedding_version>.joblib
+        """
+    return os.path.join(directory, "{}-{}.joblib".format(detector, embedding_version))
@@ -1,12 +1,16 @@
-from neo4j           import GraphDatabase
 from sklearn.svm     import OneClassSVM
 from sklearn.metrics import classification_report
 from utils           import retrieve_embeddings, split_data
+import os
+import sys
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import get_driver
 
 if __name__ == "__main__":
     # Load data
-    driver = GraphDatabase.driver("bolt://localhost:7687", auth=("neo4j", "password"))
-    embedded_nodes = retrieve_embeddings(driver)
+    embedded_nodes = retrieve_embeddings(get_driver())
 
     # Split into train and test sets
     X_train, X_test, y_train, y_test = split_data(embedded_nodes)
@@ -0,0 +1,392 @@
+# Imports
+from detectors              import DETECTORS, SPARSE_DETECTORS
+from features               import extract_features, load_policies
+from run_detectors          import run_detectors
+from sklearn.decomposition  import TruncatedSVD
+from sklearn.preprocessing  import normalize
+from utils                  import embedding_matrix
+import argformat
+import argparse
+import numpy  as np
+import os
+import pandas as pd
+import scipy.sparse as sp
+import sys
+import warnings
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+import metrics
+
+################################################################################
+#                                 Attachments                                  #
+################################################################################
+
+# Policies applying to each principal, read from the effective-permission index of data_loader/permissions.py
+ATTACHMENT_QUERY = """
+MATCH (e:EffectivePermission)
+UNWIND e.policies AS policy
+RETURN DISTINCT e.principalType AS principalType, e.principal AS principal, policy
+"""
+
+POLICY_QUERY = """
+MATCH (p:Policy)
+RETURN p.name AS PolicyName, p.policyObject AS PolicyObject, p.embeddingNode2vec AS embedding
+"""
+
+
+def retrieve_attachments(driver):
+    """Retrieve the policies applying to each principal from the graph database.
+
+        All attachments are read in a single query from the
+        EffectivePermission nodes, including the policies users inherit
+        through their groups.
+
+        Parameters
+        ----------
+        driver : neo4j.GraphDatabase.driver
+            Driver for database connection.
+
+        Returns
+        -------
+        attachments : pd.DataFrame
+            DataFrame with the columns 'principalType', 'principal' and
+            'policy'.
+        """
+    with driver.session(database="neo4j") as session:
+        return pd.DataFrame(
+            [record.values() for record in session.run(ATTACHMENT_QUERY)],
+            columns = ['principalType', 'principal', 'policy'],
+        )
+
+
+def retrieve_policies(driver):
+    """Retrieve the policy documents and embeddings from the graph database.
+
+        Parameters
+        ----------
+        driver : neo4j.GraphDatabase.driver
+            Driver for database connection.
+
+        Returns
+        -------
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName', 'PolicyObject' and 'embedding'
+            column.
+        """
+    with driver.session(database="neo4j") as session:
+        return pd.DataFrame(
+            [record.values() for record in session.run(POLICY_QUERY)],
+            columns = ['PolicyName', 'PolicyObject', 'embedding'],
+        )
+
+
+def snapshot_attachments(path):
+    """Read the policies applying to each principal from a snapshot.
+
+        Parameters
+        ----------
+        path : string
+            Snapshot created by the collector.
+
+        Returns
+        -------
+        attachments : pd.DataFrame
+            DataFrame with the columns 'principalType', 'principal' and
+            'policy', see data_loader/permissions.py.
+        """
+    # Attachments are computed as for the effective-permission index
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data_loader'))
+    from permissions import attachment_records
+
+    sheets = pd.read_excel(path, sheet_name=['users', 'groups', 'roles'], index_col=0)
+    return attachment_records(sheets['users'], sheets['groups'], sheets['roles'])
+
+################################################################################
+#                                 Aggregation                                  #
+################################################################################
+
+def attachment_matrix(attachments, policies):
+    """Create the sparse incidence matrix of principals and their policies.
+
+        Parameters
+        ----------
+        attachments : pd.DataFrame
+            Attachments as returned by retrieve_attachments().
+
+        policies : array-like of shape=(n_policies,)
+            Names of policies, column j of the matrix describes policies[j].
+            Attachments of other policies are ignored.
+
+        Returns
+        -------
+        principals : pd.DataFrame
+            DataFrame with the 'principalType' and 'principal' of each row.
+
+        matrix : scipy.sparse.csr_matrix of shape=(n_principals, n_policies)
+            Matrix with a 1 for each policy applying to a principal.
+        """
+    rows, principals = pd.MultiIndex.from_frame(attachments[['principalType', 'principal']]).factorize()
+    columns = pd.Index(policies).get_indexer(attachments['policy'])
+    known   = columns >= 0
+
+    matrix = sp.csr_matrix(
+        (np.ones(known.sum(), dtype=np.float32), (rows[known], columns[known])),
+        shape = (len(principals), len(policies)),
+    )
+    matrix.data[:] = 1
+
+    # Return result
+    return principals.to_frame(index=False, name=['principalType', 'principal']), matrix
+
+
+def aggregate_embeddings(matrix, embeddings, chunk_size=2**16):
+    """Aggregate the embeddings of the policies of each principal.
+
+        Parameters
+        ----------
+        matrix : scipy.sparse.csr_matrix of shape=(n_principals, n_policies)
+            Incidence matrix as returned by attachment_matrix().
+
+        embeddings : np.array of shape=(n_policies, n_dimensions)
+            Embedding of each policy.
+
+        chunk_size : int, default=2**16
+            Number of principals of which the maximum is computed at once.
+
+        Returns
+        -------
+        result : np.array of shape=(n_principals, 2*n_dimensions)
+            Mean and element-wise maximum of the embeddings of each
+            principal, zero for principals without policies.
+        """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    counts     = np.asarray(matrix.sum(axis=1)).ravel()
+
+    # Mean as a single sparse matrix product
+    mean = sp.diags(1 / np.maximum(counts, 1)) @ matrix @ embeddings
+
+    # Maximum over the policies of each principal, i.e., over the segments of the CSR rows
+    maximum = np.zeros_like(mean)
+    for start in range(0, matrix.shape[0], chunk_size):
+        stop    = min(start + chunk_size, matrix.shape[0])
+        indptr  = matrix.indptr[start:stop+1]
+        nonzero = np.flatnonzero(np.diff(indptr))
+        if nonzero.shape[0]:
+            values = embeddings[matrix.indices[indptr[0]:indptr[-1]]]
+            maximum[start + nonzero] = np.maximum.reduceat(values, indptr[nonzero] - indptr[0], axis=0)
+
+    # Return result
+    return np.hstack([mean, maximum])
+
+
+def aggregate_features(matrix, features):
+    """Aggregate the permission features of the policies of each principal.
+
+        Parameters
+        ----------
+        matrix : scipy.sparse.csr_matrix of shape=(n_principals, n_policies)
+            Incidence matrix as returned by attachment_matrix().
+
+        features : scipy.sparse.csr_matrix of shape=(n_policies, n_features)
+            Features as returned by features.extract_features().
+
+        Returns
+        -------
+        result : scipy.sparse.csr_matrix of shape=(n_principals, n_features)
+            L2-normalized sum of the features of the policies of each
+            principal, i.e., its combined bag-of-permissions.
+        """
+    return normalize(matrix @ features, norm='l2', copy=False).tocsr()
+
+
+@metrics.timed('detect.principals.features')
+def principal_features(attachments, policies, embeddings=True, features=True, n_components=128):
+    """Compute the feature vector of each principal from its policies.
+
+        Parameters
+        ----------
+        attachments : pd.DataFrame
+            Attachments as returned by retrieve_attachments().
+
+        policies : pd.DataFrame
+            DataFrame with a 'PolicyName' and 'PolicyObject' column, and an
+            'embedding' column if embeddings is True.
+
+        embeddings : boolean, default=True
+            If True, include the mean and maximum of the policy embeddings,
+            policies without embedding are ignored.
+
+        features : boolean, default=True
+            If True, include the aggregated bag-of-permissions features.
+
+        n_components : int, default=128
+            Dimension to which the bag-of-permissions features are reduced,
+            0 keeps them sparse, which cannot be combined with embeddings.
+            The reduction is fitted on the features of the policies and
+            applied to the aggregated features of the principals, see
+            features.reduce_features().
+
+        Returns
+        -------
+        principals : pd.DataFrame
+            DataFrame with the 'principalType', 'principal' and number of
+            'policies' of each principal, row i describes row i of matrix.
+
+        matrix : np.array or scipy.sparse.csr_matrix of shape=(n_principals, n_dimensions)
+            Feature vector of each principal.
+        """
+    if not (embeddings or features):
+        raise ValueError("Principal features require embeddings, features or both")
+    if embeddings and features and not n_components:
+        raise ValueError("Sparse features cannot be combined with embeddings, set n_components")
+
+    if embeddings:
+        policies = policies[policies['embedding'].notna()].reset_index(drop=True)
+
+    principals, incidence = attachment_matrix(attachments, policies['PolicyName'])
+    principals['policies'] = incidence.getnnz(axis=1)
+    metrics.rows(principals.shape[0])
+
+    blocks = list()
+    if embeddings:
+        blocks.append(aggregate_embeddings(incidence, embedding_matrix(policies)))
+    if features:
+        _, matrix = extract_features(policies)
+        if not n_components:
+            return principals, aggregate_features(incidence, matrix)
+
+        # Reduction is fitted on the policies, of which there are far fewer than principals
+        svd = TruncatedSVD(
+            n_components = min(n_components, matrix.shape[0] - 1, matrix.shape[1] - 1),
+            random_state = 0,
+        ).fit(matrix)
+        blocks.append(svd.transform(aggregate_features(incidence, matrix)))
+
+    # Return result
+    return principals, np.hstack(blocks)
+
+################################################################################
+#                                  Detection                                   #
+################################################################################
+
+# Detectors whose decision_function scores all principals in a single
+# coordinate system, local_outlier_factor projects the samples passed to each
+# call separately using t-SNE, such that its scores are not comparable
+PRINCIPAL_DETECTORS = [name for name in DETECTORS if name != 'local_outlier_factor']
+
+@metrics.timed('detect.principals')
+def score_principals(principals, matrix, detectors=('isolation_forest',), n_workers=None):
+    """Score principals with the anomaly detectors.
+
+        Each detector is fitted on all principals, after which all principals
+        are scored.
+
+        Parameters
+        ----------
+        principals : pd.DataFrame
+            Principals as returned by principal_features().
+
+        matrix : np.array or scipy.sparse.csr_matrix of shape=(n_principals, n_dimensions)
+            Feature vector of each principal.
+
+        detectors : iterable of string, default=('isolation_forest',)
+            Names of detectors to run, see PRINCIPAL_DETECTORS.
+
+        n_workers : int, optional
+            Number of worker processes, by default one per detector.
+
+        Returns
+        -------
+        result : pd.DataFrame
+            Principals with a '<detector>_score' and '<detector>_label'
+            column per detector, where a negative score and label -1 indicate
+            an anomaly.
+        """
+    unsupported = [name for name in detectors if name not in PRINCIPAL_DETECTORS]
+    if unsupported:
+        raise ValueError("Detectors {} cannot score principals, choose from {}".format(
+            unsupported, PRINCIPAL_DETECTORS))
+
+    # Labels are derived from the scores in the same pass over the principals
+    results, scores = run_detectors(matrix, matrix, detectors=detectors, n_workers=n_workers, return_scores=True)
+
+    result = principals.copy()
+    for name, (y_pred, _, _) in results.items():
+        result['{}_score'.format(name)] = scores[name]
+        result['{}_label'.format(name)] = y_pred
+
+    # Return result
+    return result
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Detect anomalous users, groups and roles from the policies applying to them",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--detectors" , nargs='+', default=['isolation_forest'], choices=PRINCIPAL_DETECTORS, help="detectors to run")
+    parser.add_argument("--workers"   , type=int, help="number of worker processes (default=one per detector)")
+    parser.add_argument("--snapshot"  , help="read principals and policies from given snapshot (.xlsx) instead of the graph, uses no embeddings")
+    parser.add_argument("--no-embeddings", action='store_true', help="only use the bag-of-permissions features")
+    parser.add_argument("--no-features"  , action='store_true', help="only use the graph embedding")
+    parser.add_argument("--components", type=int, default=128, help="dimension of bag-of-permissions features, 0 keeps features sparse")
+    parser.add_argument("--output"    , help="CSV file to write the scores of all principals to")
+    parser.add_argument("--top"       , type=int, default=20, help="number of most anomalous principals to show")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                         Principal features                           #
+    ########################################################################
+
+    if args.snapshot:
+        attachments = snapshot_attachments(args.snapshot)
+        policies    = load_policies(args.snapshot)
+        embeddings  = False
+    else:
+        driver      = get_driver(args.uri, args.user, args.password, args.pool_size)
+        attachments = retrieve_attachments(driver)
+        policies    = retrieve_policies(driver)
+        embeddings  = not args.no_embeddings
+
+    if attachments.empty:
+        raise ValueError("No attachments found, create the effective-permission index using data_loader/permissions.py")
+
+    principals, matrix = principal_features(
+        attachments,
+        policies,
+        embeddings   = embeddings,
+        features     = not args.no_features,
+        n_components = args.components,
+    )
+
+    # Sparse features are only supported by some detectors
+    if sp.issparse(matrix):
+        unsupported = [name for name in args.detectors if name not in SPARSE_DETECTORS]
+        if unsupported:
+            warnings.warn("Skipping {}, which require dense features, use --components".format(unsupported))
+        args.detectors = [name for name in args.detectors if name in SPARSE_DETECTORS]
+        if not args.detectors:
+            raise ValueError("None of the detectors support sparse features, use --components")
+
+    ########################################################################
+    #                        Run anomaly detection                         #
+    ########################################################################
+
+    result = score_principals(principals, matrix, detectors=args.detectors, n_workers=args.workers)
+
+    # Show most anomalous principals according to the first detector
+    print(result.sort_values('{}_score'.format(args.detectors[0])).head(args.top).to_string(index=False))
+
+    if args.output:
+        result.to_csv(args.output, index=False)
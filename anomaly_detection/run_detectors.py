@@ -0,0 +1,415 @@
+# Imports
+from concurrent.futures           import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from sklearn.metrics              import classification_report
+from detectors                    import DETECTORS, SPARSE_DETECTORS, create_detector
+from features                     import extract_features, load_policies, reduce_features
+from functools                    import partial
+from models                       import model_path, save_model
+from utils                        import embedding_matrix, embedding_version, retrieve_embeddings, split_data
+import argformat
+import argparse
+import numpy as np
+import os
+import scipy.sparse as sp
+import sys
+import time
+import warnings
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+import metrics
+
+################################################################################
+#                            Shared memory matrices                            #
+################################################################################
+
+def share_array(array):
+    """Copy an array into shared memory.
+
+        Parameters
+        ----------
+        array : np.array
+            Array to copy into shared memory.
+
+        Returns
+        -------
+        shm : SharedMemory
+            Shared memory block, must be unlinked by the owner when done.
+
+        spec : tuple
+            Tuple of (name, shape, dtype) with which attach_array() can attach
+            to the shared array from another process.
+        """
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """Attach to an array created by share_array().
+
+        Parameters
+        ----------
+        spec : tuple
+            Tuple of (name, shape, dtype) as returned by share_array().
+
+        Returns
+        -------
+        shm : SharedMemory
+            Shared memory block, keep a reference while using the array.
+
+        array : np.array
+            Read-only view on the shared array, no data is copied.
+        """
+    name, shape, dtype = spec
+    shm   = SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    array.flags.writeable = False
+    return shm, array
+
+
+def share_matrix(matrix):
+    """Copy a dense or sparse (CSR) matrix into shared memory.
+
+        Parameters
+        ----------
+        matrix : np.array or scipy.sparse.csr_matrix
+            Matrix to copy into shared memory.
+
+        Returns
+        -------
+        shms : list of SharedMemory
+            Shared memory blocks, must be unlinked by the owner when done.
+
+        spec : tuple
+            Specification with which attach_matrix() can attach to the matrix.
+        """
+    # Share dense matrices directly
+    if not sp.issparse(matrix):
+        shm, spec = share_array(np.ascontiguousarray(matrix))
+        return [shm], ('dense', spec)
+
+    # Share the data, indices and index pointers of sparse matrices
+    matrix = matrix.tocsr()
+    shared = [share_array(array) for array in (matrix.data, matrix.indices, matrix.indptr)]
+    return [shm for shm, _ in shared], ('csr', [spec for _, spec in shared], matrix.shape)
+
+
+def attach_matrix(spec):
+    """Attach to a matrix created by share_matrix().
+
+        Parameters
+        ----------
+        spec : tuple
+            Specification as returned by share_matrix().
+
+        Returns
+        -------
+        shms : list of SharedMemory
+            Shared memory blocks, keep a reference while using the matrix.
+
+        matrix : np.array or scipy.sparse.csr_matrix
+            Matrix backed by shared memory.
+        """
+    if spec[0] == 'dense':
+        shm, array = attach_array(spec[1])
+        return [shm], array
+
+    # Reconstruct sparse matrix without copying
+    _, specs, shape = spec
+    attached = [attach_array(spec_) for spec_ in specs]
+    data, indices, indptr = [array for _, array in attached]
+    matrix = sp.csr_matrix(shape, dtype=data.dtype)
+    matrix.data, matrix.indices, matrix.indptr = data, indices, indptr
+    return [shm for shm, _ in attached], matrix
+
+################################################################################
+#                                Worker process                                #
+################################################################################
+
+# Shared matrices of a worker process, set by _init_worker()
+_shared = dict()
+
+
+def _init_worker(train_spec, test_spec):
+    """Attach worker process to the shared train and test matrices."""
+    _shared['train'] = attach_matrix(train_spec)
+    _shared['test' ] = attach_matrix(test_spec)
+
+
+def _evaluate(name, return_model=False, return_scores=False):
+    """Fit and predict given detector on the shared matrices.
+
+        Parameters
+        ----------
+        name : string
+            Name of detector to evaluate, see detectors.DETECTORS.
+
+        return_model : boolean, default=False
+            If True, also return the fitted detector.
+
+        return_scores : boolean, default=False
+            If True, predict the test data from its decision_function scores
+            and also return these scores.
+
+        Returns
+        -------
+        name : string
+            Name of evaluated detector.
+
+        y_pred : np.array of shape=(n_test,)
+            Prediction of inliers (1) and outliers (-1) for the test data.
+
+        fit_time : float
+            Time in seconds spent fitting the detector.
+
+        predict_time : float
+            Time in seconds spent predicting the test data.
+
+        model : sklearn estimator or None
+            Fitted detector if return_model is True, else None.
+
+        scores : np.array of shape=(n_test,) or None
+            Anomaly scores of the test data, negative scores are outliers, if
+            return_scores is True, else None.
+        """
+    _, X_train = _shared['train']
+    _, X_test  = _shared['test' ]
+
+    # Fit detector
+    start = time.perf_counter()
+    clf   = create_detector(name).fit(X_train)
+    fit_time = time.perf_counter() - start
+
+    # Predict test data
+    start  = time.perf_counter()
+    if return_scores:
+        scores = clf.decision_function(X_test)
+        y_pred = np.where(scores < 0, -1, 1)
+    else:
+        scores = None
+        y_pred = clf.predict(X_test)
+    predict_time = time.perf_counter() - start
+
+    # Return result
+    return name, y_pred, fit_time, predict_time, clf if return_model else None, scores
+
+################################################################################
+#                                    Runner                                    #
+################################################################################
+
+def run_detectors(X_train, X_test, detectors=tuple(DETECTORS), n_workers=None, return_models=False,
+                  return_scores=False):
+    """Fit and predict multiple detectors concurrently in worker processes.
+
+        Parameters
+        ----------
+        X_train : np.array or scipy.sparse.csr_matrix of shape=(n_train, n_dimensions)
+            Train data, sparse data is only supported by SPARSE_DETECTORS.
+
+        X_test : np.array or scipy.sparse.csr_matrix of shape=(n_test, n_dimensions)
+            Test data.
+
+        detectors : iterable of string, default=all detectors
+            Names of detectors to evaluate, see detectors.DETECTORS.
+
+        n_workers : int, optional
+            Number of worker processes, by default one per detector.
+
+        return_models : boolean, default=False
+            If True, additionally return the fitted detectors.
+
+        return_scores : boolean, default=False
+            If True, additionally return the decision_function scores of the
+            test data, from which the predictions are derived in the same pass.
+
+        Returns
+        -------
+        result : dict()
+            Dictionary of detector name -> (y_pred, fit_time, predict_time).
+
+        models : dict()
+            Dictionary of detector name -> fitted detector, only returned if
+            return_models is True.
+
+        scores : dict()
+            Dictionary of detector name -> np.array of shape=(n_test,) of
+            anomaly scores, negative scores are outliers, only returned if
+            return_scores is True.
+        """
+    detectors = list(detectors)
+
+    # Share matrices with workers instead of pickling them for each task
+    shm_train, train_spec = share_matrix(X_train)
+    shm_test , test_spec  = share_matrix(X_test )
+
+    try:
+        with metrics.stage('detect'), ProcessPoolExecutor(
+                max_workers = n_workers or len(detectors),
+                initializer = _init_worker,
+                initargs    = (train_spec, test_spec),
+            ) as executor:
+            results = dict()
+            models  = dict()
+            scores  = dict()
+            for name, y_pred, fit_time, predict_time, model, score in executor.map(
+                    partial(_evaluate, return_model=return_models,
+                            return_scores=return_scores), detectors):
+                results[name] = (y_pred, fit_time, predict_time)
+                models [name] = model
+                scores [name] = score
+                metrics.rows(X_train.shape[0] + X_test.shape[0])
+                metrics.count('fit_seconds.{}'    .format(name), fit_time    )
+                metrics.count('predict_seconds.{}'.format(name), predict_time)
+
+            # Return result
+            result = (results,)
+            if return_models:
+                result += (models,)
+            if return_scores:
+                result += (scores,)
+            return result if len(result) > 1 else results
+
+    finally:
+        # Release shared memory
+        for shm in shm_train + shm_test:
+            shm.close()
+            shm.unlink()
+
+
+def format_report(y_true, results):
+    """Format results of run_detectors() as a single table.
+
+        Parameters
+        ----------
+        y_true : array-like of shape=(n_test,)
+            True labels of test data.
+
+        results : dict()
+            Result as returned by run_detectors().
+
+        Returns
+        -------
+        report : string
+            Consolidated classification report with fit and predict timings.
+        """
+    # Set columns
+    header = "{:<26} {:<18} {:>9} {:>9} {:>9} {:>9} {:>10} {:>12}".format(
+        "Detector", "Class", "precision", "recall", "f1-score", "support",
+        "fit (s)", "predict (s)",
+    )
+    row = "{:<26} {:<18} {:>9.4f} {:>9.4f} {:>9.4f} {:>9} {:>10} {:>12}"
+
+    # Create report
+    lines = [header, "━"*len(header)]
+    for name, (y_pred, fit_time, predict_time) in results.items():
+        report = classification_report(
+            y_true        = y_true,
+            y_pred        = y_pred,
+            labels        = [1, -1],
+            target_names  = ["Correct", "Misconfiguration"],
+            output_dict   = True,
+            zero_division = 0,
+        )
+
+        # Add one line per class and the averages
+        for i, target in enumerate(["Correct", "Misconfiguration", "macro avg", "weighted avg"]):
+            scores = report[target]
+            lines.append(row.format(
+                name if i == 0 else "",
+                target,
+                scores['precision'],
+                scores['recall'],
+                scores['f1-score'],
+                int(scores['support']),
+                "{:.4f}".format(fit_time    ) if i == 0 else "",
+                "{:.4f}".format(predict_time) if i == 0 else "",
+            ))
+        lines.append("")
+
+    # Return report
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Run all anomaly detectors on the same split",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--detectors", nargs='+', default=list(DETECTORS), choices=list(DETECTORS), help="detectors to run")
+    parser.add_argument("--workers"  , type=int  , help="number of worker processes (default=one per detector)")
+    parser.add_argument("--seed"     , type=int  , help="seed used for train-test split")
+    parser.add_argument("--save"     , help="directory in which to store the fitted detectors")
+    parser.add_argument("--features" , help="use bag-of-permissions features of given snapshot (.xlsx) instead of embeddings")
+    parser.add_argument("--components", type=int, default=128, help="dimension of dense features, 0 keeps features sparse")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                         Load and split data                          #
+    ########################################################################
+
+    # Load data once, either from the snapshot or the graph database
+    reducer = None
+    if args.features:
+        embedded_nodes, matrix = extract_features(load_policies(args.features))
+        if args.components:
+            matrix, reducer = reduce_features(matrix, n_components=args.components, return_reducer=True)
+    else:
+        embedded_nodes = retrieve_embeddings(get_driver(args.uri, args.user, args.password, args.pool_size))
+        matrix = embedding_matrix(embedded_nodes)
+
+    # Sparse features are only supported by some detectors
+    if sp.issparse(matrix):
+        unsupported = [name for name in args.detectors if name not in SPARSE_DETECTORS]
+        if unsupported:
+            warnings.warn("Skipping {}, which require dense features, use --components".format(unsupported))
+        args.detectors = [name for name in args.detectors if name in SPARSE_DETECTORS]
+
+    # Split into train and test sets, rows of X_train and X_test index matrix
+    X_train, X_test, y_train, y_test = split_data(
+        embedded_nodes.reset_index(drop=True),
+        random_state = args.seed,
+    )
+
+    ########################################################################
+    #                        Run anomaly detection                         #
+    ########################################################################
+
+    results, models = run_detectors(
+        X_train       = matrix[X_train.index.to_numpy()],
+        X_test        = matrix[X_test .index.to_numpy()],
+        detectors     = args.detectors,
+        n_workers     = args.workers,
+        return_models = True,
+    )
+
+    # Print performance
+    print(format_report(y_test, results))
+
+    ########################################################################
+    #                             Save models                              #
+    ########################################################################
+
+    if args.save:
+        version = embedding_version(embedded_nodes, matrix)
+        for name, model in models.items():
+            path = model_path(args.save, name, version)
+            save_model(
+                path, model, version,
+                detector = name,
+                features = 'permissions' if args.features else 'node2vec',
+                reducer  = reducer,
+                seed     = args.seed,
+            )
+            print("Saved {} to {}".format(name, path))
@@ -0,0 +1,260 @@
+# Imports
+from models import load_model, policy_features
+from utils  import embedding_matrix, embedding_version, retrieve_embeddings
+import argformat
+import argparse
+import json
+import numpy  as np
+import os
+import pandas as pd
+import sys
+import warnings
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+
+class PolicyScorer(object):
+    """Score new or changed policies with a persisted detector.
+
+        The model is loaded once, such that each call only costs a single
+        prediction (and a single database lookup when scoring by name).
+
+        Parameters
+        ----------
+        path : string
+            Path of model stored by models.save_model().
+
+        driver : neo4j.GraphDatabase.driver, optional
+            Driver for database connection, required for scoring by name.
+        """
+
+    def __init__(self, path, driver=None):
+        # Load model once
+        self.stored = load_model(path)
+        self.model  = self.stored['model']
+        self.driver = driver
+
+        # Models fitted on permissions are scored by reproducing the features from the policy documents
+        self.features = self.stored['features']
+
+        # Models working on a t-SNE projection cannot score individual samples
+        if not hasattr(self.model, 'decision_function'):
+            raise ValueError("Model {} does not support scoring".format(path))
+        if self.stored.get('detector') == 'local_outlier_factor':
+            warnings.warn(
+                "Model {} projects samples using t-SNE, scores of small "
+                "batches are not meaningful.".format(path)
+            )
+
+    @property
+    def embedding_version(self):
+        """Version of the embedding on which the model was fitted."""
+        return self.stored['embedding_version']
+
+    def verify(self):
+        """Check whether the embedding in the database matches the model.
+
+            Note
+            ----
+            Retrieves all embeddings, so only call this once, not per policy.
+
+            Returns
+            -------
+            result : boolean
+                True if the model was fitted on the current embedding.
+            """
+        if self.features != 'node2vec':
+            raise ValueError("Model was fitted on {} features, not on the embedding".format(self.features))
+        return embedding_version(retrieve_embeddings(self.driver)) == self.embedding_version
+
+    def score_embeddings(self, X):
+        """Score raw embeddings.
+
+            Parameters
+            ----------
+            X : array-like of shape=(n_samples, n_dimensions) or (n_dimensions,)
+                Embeddings to score, a single embedding is also accepted.
+
+            Returns
+            -------
+            scores : np.array of shape=(n_samples,)
+                Anomaly score of each sample, negative scores are outliers.
+
+            labels : np.array of shape=(n_samples,)
+                Prediction of inliers (1) and outliers (-1).
+            """
+        if self.features != 'node2vec':
+            raise ValueError("Model was fitted on {} features, not on embeddings".format(self.features))
+        return self._score(np.atleast_2d(np.asarray(X, dtype=np.float64)))
+
+    def _score(self, X):
+        """Score feature matrix X, returns scores and labels."""
+        scores = self.model.decision_function(X)
+        return scores, np.where(scores < 0, -1, 1)
+
+    def score_documents(self, policies):
+        """Score policy documents with a model fitted on permissions.
+
+            Parameters
+            ----------
+            policies : pd.DataFrame
+                DataFrame with a 'PolicyName' and 'PolicyObject' column.
+
+            Returns
+            -------
+            result : pd.DataFrame
+                Dataframe with a 'policy', 'score' and 'label' column.
+            """
+        if policies.empty:
+            return pd.DataFrame(columns=['policy', 'score', 'label'])
+
+        scores, labels = self._score(policy_features(self.stored, policies))
+        return pd.DataFrame({
+            'policy': policies['PolicyName'].to_numpy(),
+            'score' : scores,
+            'label' : labels,
+        })
+
+    def score_policies(self, policies):
+        """Score policies by name using their embedding from the database.
+
+            Models fitted on permissions score the policy documents from the
+            database instead, see score_documents().
+
+            Parameters
+            ----------
+            policies : iterable of string
+                Names of policies to score.
+
+            Returns
+            -------
+            result : pd.DataFrame
+                Dataframe with a 'policy', 'score' and 'label' column.
+                Policies that were not found are omitted.
+            """
+        if self.driver is None:
+            raise ValueError("Scoring policies by name requires a database driver.")
+
+        if self.features == 'permissions':
+            return self.score_documents(retrieve_documents(self.driver, policies))
+
+        # Retrieve embeddings of the given policies only
+        X = retrieve_embeddings(self.driver, policies)
+        X = X[X['embedding'].notna()]
+        if X.empty:
+            return pd.DataFrame(columns=['policy', 'score', 'label'])
+
+        # Score policies
+        scores, labels = self._score(embedding_matrix(X))
+        return pd.DataFrame({
+            'policy': X['policy'].to_numpy(),
+            'score' : scores,
+            'label' : labels,
+        })
+
+
+def retrieve_documents(driver, policies):
+    """Retrieve the policy documents of the given policies from the database.
+
+        Parameters
+        ----------
+        driver : neo4j.GraphDatabase.driver
+            Driver for database connection.
+
+        policies : iterable of string
+            Names of policies to retrieve.
+
+        Returns
+        -------
+        result : pd.DataFrame
+            Dataframe with a 'PolicyName' and 'PolicyObject' column, policies
+            that were not found are omitted.
+        """
+    with driver.session(database="neo4j") as session:
+        result = session.run(
+            """
+            MATCH (p:Policy)
+            WHERE p.name IN $names
+            RETURN p.name AS PolicyName, p.policyObject AS PolicyObject
+            """,
+            names = list(policies),
+        )
+        return pd.DataFrame(
+            [dict(record) for record in result],
+            columns = ['PolicyName', 'PolicyObject'],
+        )
+
+
+def _print_scores(result):
+    """Print scores as tab separated lines and flush output."""
+    for policy, score, label in zip(result['policy'], result['score'], result['label']):
+        print("{}\t{:.6f}\t{}".format(policy, score, label))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Score policies with a persisted detector",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("model"      , help="model stored by run_detectors.py --save")
+    parser.add_argument("--policy"   , nargs='+', default=list(), help="names of policies to score")
+    parser.add_argument("--embedding", help=".npy file containing embedding(s) to score")
+    parser.add_argument("--stdin"    , action='store_true', help="score lines from stdin (policy name or JSON embedding)")
+    parser.add_argument("--verify"   , action='store_true', help="check embedding version of database")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                             Load model                               #
+    ########################################################################
+
+    # Only connect to the database if we need to look up policies
+    driver = None
+    if args.policy or args.stdin or args.verify:
+        driver = get_driver(args.uri, args.user, args.password, args.pool_size)
+
+    scorer = PolicyScorer(args.model, driver=driver)
+
+    if args.verify and not scorer.verify():
+        warnings.warn("Model was fitted on embedding version {}, which differs "
+                      "from the embedding in the database.".format(scorer.embedding_version))
+
+    ########################################################################
+    #                            Score policies                            #
+    ########################################################################
+
+    # Score given policies
+    if args.policy:
+        _print_scores(scorer.score_policies(args.policy))
+
+    # Score given embeddings
+    if args.embedding:
+        X = np.load(args.embedding)
+        scores, labels = scorer.score_embeddings(X)
+        _print_scores({
+            'policy': ["embedding-{}".format(i) for i in range(scores.shape[0])],
+            'score' : scores,
+            'label' : labels,
+        })
+
+    # Score each line from stdin, keeping the model loaded between requests
+    if args.stdin:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                scores, labels = scorer.score_embeddings(json.loads(line))
+                _print_scores({'policy': ['embedding'], 'score': scores, 'label': labels})
+            else:
+                _print_scores(scorer.score_policies([line]))
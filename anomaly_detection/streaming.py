@@ -0,0 +1,228 @@
+# Imports
+from features             import extract_features, load_policies
+from hashlib              import sha256
+from sklearn.linear_model import SGDOneClassSVM
+import argformat
+import argparse
+import glob
+import joblib
+import numpy  as np
+import os
+import pandas as pd
+import sys
+import time
+
+class StreamingDetector(object):
+    """Online anomaly detection over periodic snapshots.
+
+        Each snapshot is compared to the previous one using a fingerprint of
+        each policy document. Only new or changed policies are featurized,
+        scored and used to update an online one-class SVM, such that the cost
+        of a cycle scales with the number of changes.
+
+        Parameters
+        ----------
+        nu : float, default=0.1
+            Upper bound on the fraction of outliers, see SGDOneClassSVM.
+
+        n_features : int, default=2**18
+            Number of hashed features, see features.extract_features().
+
+        warm_up : int, default=5
+            Number of passes over the first snapshot to initialize the model,
+            later changes are learned in a single pass.
+
+        random_state : int, default=0
+            Random state of SGDOneClassSVM.
+        """
+
+    def __init__(self, nu=0.1, n_features=2**18, warm_up=5, random_state=0):
+        self.nu           = nu
+        self.n_features   = n_features
+        self.warm_up      = warm_up
+        self.random_state = random_state
+        self.model        = SGDOneClassSVM(nu=nu, random_state=random_state)
+        self.fingerprints = dict()
+        self.processed    = set()
+        self.fitted       = False
+
+    @staticmethod
+    def fingerprint(policies):
+        """Compute fingerprint of each policy document.
+
+            Parameters
+            ----------
+            policies : pd.DataFrame
+                DataFrame with a 'PolicyName' and 'PolicyObject' column.
+
+            Returns
+            -------
+            fingerprints : dict()
+                Dictionary of policy name -> fingerprint.
+            """
+        return {
+            name: sha256(str(policy).encode('utf-8')).hexdigest()
+            for name, policy in zip(policies['PolicyName'], policies['PolicyObject'])
+        }
+
+    def update(self, policies, removed=(), complete=True):
+        """Process a snapshot or snapshot diff.
+
+            Parameters
+            ----------
+            policies : pd.DataFrame
+                DataFrame with a 'PolicyName' and 'PolicyObject' column. Either
+                a full snapshot or only the added and changed policies.
+
+            removed : iterable of string, default=()
+                Names of policies removed since the previous snapshot, only
+                required if policies is not a full snapshot.
+
+            complete : boolean, default=True
+                If True, policies is a full snapshot and policies missing from
+                it are considered removed.
+
+            Returns
+            -------
+            result : pd.DataFrame
+                Score of each new or changed policy, with a 'policy', 'status'
+                ('new' or 'changed'), 'score' and 'label' column. Negative
+                scores and label -1 indicate anomalies. Empty for the first
+                snapshot, which is only used to initialize the model.
+            """
+        fingerprints = self.fingerprint(policies)
+
+        # Forget removed policies
+        removed = set(removed)
+        if complete:
+            removed |= set(self.fingerprints) - set(fingerprints)
+        for name in removed:
+            self.fingerprints.pop(name, None)
+
+        # Select new and changed policies
+        status = {
+            name: 'changed' if name in self.fingerprints else 'new'
+            for name, fingerprint in fingerprints.items()
+            if self.fingerprints.get(name) != fingerprint
+        }
+        changed = policies[policies['PolicyName'].isin(status)].drop_duplicates('PolicyName', keep='last')
+        self.fingerprints.update({name: fingerprints[name] for name in status})
+
+        result = pd.DataFrame(columns=['policy', 'status', 'score', 'label'])
+        if changed.empty:
+            return result
+
+        # Featurize only changed policies
+        X, matrix = extract_features(changed, n_features=self.n_features)
+
+        # Score before learning from the changes, except for the first snapshot
+        if self.fitted:
+            scores = self.model.decision_function(matrix)
+            result = pd.DataFrame({
+                'policy': X['policy'].to_numpy(),
+                'status': X['policy'].map(status).to_numpy(),
+                'score' : scores,
+                'label' : np.where(scores < 0, -1, 1),
+            })
+
+        # Update model incrementally
+        for _ in range(1 if self.fitted else self.warm_up):
+            self.model.partial_fit(matrix)
+        self.fitted = True
+
+        # Return result
+        return result
+
+    def save(self, path):
+        """Persist state of detector."""
+        joblib.dump(self, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load state of detector stored by save()."""
+        return joblib.load(path)
+
+
+def snapshots(directory, processed):
+    """Return snapshots in directory that were not yet processed, oldest first.
+
+        Parameters
+        ----------
+        directory : string
+            Output directory of the collector.
+
+        processed : set()
+            Paths of snapshots that were already processed.
+
+        Returns
+        -------
+        result : list of string
+            Paths of unprocessed snapshots, sorted by their timestamped name.
+        """
+    return sorted(
+        path for path in glob.glob(os.path.join(directory, '*.xlsx'))
+        if path not in processed
+    )
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Streaming anomaly detection over snapshots",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("snapshots" , nargs='*', help="snapshots (.xlsx) to process in order")
+    parser.add_argument("--state"   , default="streaming_state.joblib", help="file storing the detector state between runs")
+    parser.add_argument("--watch"   , help="collector output directory to watch for new snapshots")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between checks of watched directory")
+    parser.add_argument("--nu"      , type=float, default=0.1, help="upper bound on fraction of outliers")
+    parser.add_argument("--output"  , help="CSV file to append scores to (default=stdout)")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                           Process snapshots                          #
+    ########################################################################
+
+    # Load detector state or create new detector
+    if os.path.exists(args.state):
+        detector = StreamingDetector.load(args.state)
+    else:
+        detector = StreamingDetector(nu=args.nu)
+
+    def process(path):
+        """Process a single snapshot and emit its scores."""
+        start  = time.perf_counter()
+        result = detector.update(load_policies(path))
+        result.insert(0, 'snapshot', os.path.basename(path))
+
+        # Emit scores
+        if args.output:
+            result.to_csv(args.output, mode='a', index=False, header=not os.path.exists(args.output))
+        else:
+            result.to_csv(sys.stdout, index=False, header=False)
+
+        print("Processed {}: {} changed policies, {} anomalies in {:.2f}s".format(
+            path, result.shape[0], int((result['label'] == -1).sum()),
+            time.perf_counter() - start,
+        ), file=sys.stderr)
+
+        # Persist state after each snapshot
+        detector.processed.add(path)
+        detector.save(args.state)
+
+    # Process given snapshots
+    for path in args.snapshots:
+        process(path)
+
+    # Watch collector output for new snapshots
+    while args.watch:
+        for path in snapshots(args.watch, detector.processed):
+            process(path)
+        time.sleep(args.interval)
@@ -0,0 +1,425 @@
+# Imports
+from concurrent.futures      import ProcessPoolExecutor, as_completed
+from detectors               import DETECTORS, create_detector
+from hashlib                 import sha256
+from run_detectors           import attach_array, share_array
+from sklearn.metrics         import precision_recall_fscore_support
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from utils                   import embedding_matrix, embedding_version, repeated_split_data, retrieve_embeddings
+import argformat
+import argparse
+import json
+import os
+import pandas as pd
+import sys
+import time
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+
+################################################################################
+#                                Search spaces                                 #
+################################################################################
+
+# Default search space per detector, the defaults of detectors.DETECTORS are
+# included in each space.
+SEARCH_SPACES = {
+    'isolation_forest': {
+        'n_estimators' : [10, 20, 50, 100],
+        'max_samples'  : ['auto', 0.5, 1.0],
+        'contamination': ['auto', 0.05, 0.1],
+    },
+    'local_outlier_factor': {
+        'n_neighbors': [5, 10, 20],
+    },
+    'local_outlier_factor_raw': {
+        'n_neighbors': [5, 10, 20, 50],
+    },
+    'local_outlier_factor_pca': {
+        'n_neighbors' : [5, 10, 20, 50],
+        'n_components': [8, 16, 32, 64],
+    },
+    'one_class_svm': {
+        'gamma': [0.0001, 0.001, 0.01, 'scale'],
+        'nu'   : [0.01, 0.05, 0.1, 0.5],
+    },
+    'robust_covariance': {
+        'contamination': [0.01, 0.05, 0.1, 0.2],
+    },
+}
+
+
+def configurations(space, n_iter=None, random_state=None):
+    """Generate parameter configurations from a search space.
+
+        Parameters
+        ----------
+        space : dict()
+            Dictionary of parameter -> list of values (or distribution).
+
+        n_iter : int, optional
+            If given, sample n_iter configurations at random, otherwise
+            return all configurations of the grid.
+
+        random_state : int, optional
+            Seed used for random search.
+
+        Returns
+        -------
+        result : list of dict()
+            Parameter configurations.
+        """
+    if n_iter is None:
+        return list(ParameterGrid(space))
+
+    # Sample configurations, never more than the grid contains
+    grid = ParameterGrid(space)
+    if all(isinstance(values, list) for values in space.values()):
+        n_iter = min(n_iter, len(grid))
+    return list(ParameterSampler(space, n_iter=n_iter, random_state=random_state))
+
+################################################################################
+#                                 Result cache                                 #
+################################################################################
+
+def seeded_params(detector, params, seed):
+    """Return the parameters with which a detector is fitted on a split.
+
+        Detectors that are randomized but have no fixed random_state, e.g.,
+        IsolationForest, are seeded with the seed of the split, such that
+        each cached cell is reproducible.
+
+        Parameters
+        ----------
+        detector : string
+            Name of detector, see detectors.DETECTORS.
+
+        params : dict()
+            Parameters of detector.
+
+        seed : int
+            Seed of train-test split.
+
+        Returns
+        -------
+        params : dict()
+            Parameters including random_state if required.
+        """
+    estimator, defaults = DETECTORS[detector]
+    fixed = {**estimator().get_params(), **defaults, **params}
+    if 'random_state' not in fixed or fixed['random_state'] is not None:
+        return params
+    return {**params, 'random_state': seed}
+
+
+def cache_key(version, detector, params, seed):
+    """Return the cache key of a single cell of the sweep.
+
+        Parameters
+        ----------
+        version : string
+            Embedding version, see utils.embedding_version().
+
+        detector : string
+            Name of detector.
+
+        params : dict()
+            Parameters with which detector is fitted, see seeded_params().
+
+        seed : int
+            Seed of train-test split.
+
+        Returns
+        -------
+        key : string
+            Key identifying the cell.
+        """
+    return sha256(json.dumps(
+        [version, detector, params, seed],
+        sort_keys = True,
+        default   = str,
+    ).encode('utf-8')).hexdigest()
+
+
+def load_cache(path):
+    """Load finished cells from a cache file.
+
+        Parameters
+        ----------
+        path : string
+            Path of cache file, one JSON result per line.
+
+        Returns
+        -------
+        cache : dict()
+            Dictionary of cache key -> result.
+        """
+    cache = dict()
+    if path is None or not os.path.exists(path):
+        return cache
+
+    with open(path) as infile:
+        for line in infile:
+            # Skip partially written lines, e.g., from an interrupted sweep
+            try:
+                result = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            cache[result['key']] = result
+
+    # Return cache
+    return cache
+
+################################################################################
+#                                Worker process                                #
+################################################################################
+
+# Shared matrix of a worker process, set by _init_worker()
+_shared = dict()
+
+
+def _init_worker(spec):
+    """Attach worker process to the shared embedding matrix."""
+    _shared['X'] = attach_array(spec)
+
+
+def _evaluate(key, detector, params, seed, train, test, y_test):
+    """Fit and evaluate a single configuration on a single split.
+
+        The detector is fitted with seeded_params(), the result reports
+        params, such that configurations can be aggregated over splits.
+
+        Returns
+        -------
+        result : dict()
+            Precision, recall and F1-score of misconfigurations with the fit
+            and predict time of the configuration.
+        """
+    _, X = _shared['X']
+
+    # Fit detector
+    start = time.perf_counter()
+    clf   = create_detector(detector, **seeded_params(detector, params, seed)).fit(X[train])
+    fit_time = time.perf_counter() - start
+
+    # Predict test data
+    start  = time.perf_counter()
+    y_pred = clf.predict(X[test])
+    predict_time = time.perf_counter() - start
+
+    # Compute performance for misconfigurations
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        y_test, y_pred, labels=[-1], zero_division=0,
+    )
+
+    # Return result
+    return {
+        'key'         : key,
+        'detector'    : detector,
+        'params'      : params,
+        'seed'        : seed,
+        'precision'   : float(precision[0]),
+        'recall'      : float(recall[0]),
+        'f1'          : float(f1[0]),
+        'fit_time'    : fit_time,
+        'predict_time': predict_time,
+    }
+
+################################################################################
+#                                    Sweep                                     #
+################################################################################
+
+def sweep(
+        X,
+        spaces       = SEARCH_SPACES,
+        n_repeats    = 5,
+        n_iter       = None,
+        random_state = 0,
+        cache        = None,
+        n_workers    = None,
+    ):
+    """Evaluate configurations of detectors over repeated splits in parallel.
+
+        Parameters
+        ----------
+        X : pd.DataFrame
+            Embeddings as returned by utils.retrieve_embeddings().
+
+        spaces : dict(), default=SEARCH_SPACES
+            Dictionary of detector name -> search space.
+
+        n_repeats : int, default=5
+            Number of train-test splits on which to evaluate each
+            configuration, see utils.repeated_split_data().
+
+        n_iter : int, optional
+            If given, perform a random search of n_iter configurations per
+            detector instead of a grid search.
+
+        random_state : int, default=0
+            Seed for splits and random search, fixing it allows reruns to
+            reuse cached cells.
+
+        cache : string, optional
+            Path of cache file, cells found in the cache are not recomputed
+            and new cells are appended to the cache.
+
+        n_workers : int, optional
+            Number of worker processes, by default the number of CPUs.
+
+        Returns
+        -------
+        result : pd.DataFrame
+            Result of each cell, i.e., each configuration on each split.
+        """
+    version = embedding_version(X)
+    X = X.reset_index(drop=True)
+
+    # Compute splits once, each split is represented by row positions of X
+    splits = [
+        (seed, X_train.index.to_numpy(), X_test.index.to_numpy(), y_test.to_numpy())
+        for seed, X_train, X_test, y_train, y_test in repeated_split_data(
+            X[['policy']], n_repeats=n_repeats, random_state=random_state,
+        )
+    ]
+
+    # Collect cells, skipping those that were already cached
+    finished = load_cache(cache)
+    results  = list()
+    tasks    = list()
+    for detector, space in spaces.items():
+        for params in configurations(space, n_iter, random_state):
+            for seed, train, test, y_test in splits:
+                key = cache_key(version, detector, seeded_params(detector, params, seed), seed)
+                if key in finished:
+                    results.append(finished[key])
+                else:
+                    tasks.append((key, detector, params, seed, train, test, y_test))
+
+    # Evaluate remaining cells with the embedding matrix in shared memory
+    if tasks:
+        shm, spec = share_array(embedding_matrix(X))
+        try:
+            with ProcessPoolExecutor(
+                    max_workers = n_workers,
+                    initializer = _init_worker,
+                    initargs    = (spec,),
+                ) as executor:
+                futures = [executor.submit(_evaluate, *task) for task in tasks]
+
+                # Store each result as soon as it is available
+                outfile = open(cache, 'a') if cache else None
+                try:
+                    for future in as_completed(futures):
+                        result = future.result()
+                        results.append(result)
+                        if outfile is not None:
+                            outfile.write(json.dumps(result, default=str) + '\n')
+                            outfile.flush()
+                finally:
+                    if outfile is not None:
+                        outfile.close()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    # Return results
+    return pd.DataFrame(results)
+
+
+def rank(results, by='f1'):
+    """Aggregate results of sweep() per configuration and rank them.
+
+        Parameters
+        ----------
+        results : pd.DataFrame
+            Results as returned by sweep().
+
+        by : string, default='f1'
+            Metric by which to rank configurations.
+
+        Returns
+        -------
+        ranking : pd.DataFrame
+            Mean and standard deviation of each metric per configuration,
+            sorted from best to worst.
+        """
+    results = results.assign(params=results['params'].map(
+        lambda params: json.dumps(params, sort_keys=True, default=str)
+    ))
+
+    # Aggregate over splits
+    ranking = results.groupby(['detector', 'params']).agg(
+        precision     = ('precision'   , 'mean'),
+        precision_std = ('precision'   , 'std' ),
+        recall        = ('recall'      , 'mean'),
+        recall_std    = ('recall'      , 'std' ),
+        f1            = ('f1'          , 'mean'),
+        f1_std        = ('f1'          , 'std' ),
+        fit_time      = ('fit_time'    , 'mean'),
+        predict_time  = ('predict_time', 'mean'),
+        splits        = ('seed'        , 'count'),
+    )
+
+    # Rank configurations
+    return ranking.sort_values([by, 'fit_time'], ascending=[False, True]).reset_index()
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Hyperparameter sweep of anomaly detectors",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--detectors", nargs='+', default=list(SEARCH_SPACES), choices=list(DETECTORS), help="detectors to sweep")
+    parser.add_argument("--space"    , help="JSON file of detector -> parameter -> values (default=SEARCH_SPACES)")
+    parser.add_argument("--repeats"  , type=int, default=5, help="number of train-test splits")
+    parser.add_argument("--n-iter"   , type=int, help="random search of given number of configurations")
+    parser.add_argument("--seed"     , type=int, default=0, help="seed for splits and random search")
+    parser.add_argument("--cache"    , default="sweep_cache.jsonl", help="cache of finished cells")
+    parser.add_argument("--workers"  , type=int, help="number of worker processes")
+    parser.add_argument("--rank-by"  , default='f1', choices=['precision', 'recall', 'f1'], help="metric to rank by")
+    parser.add_argument("--output"   , help="optional CSV file to write ranking to")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Load search spaces
+    spaces = SEARCH_SPACES
+    if args.space:
+        with open(args.space) as infile:
+            spaces = json.load(infile)
+    spaces = {detector: spaces[detector] for detector in args.detectors if detector in spaces}
+
+    ########################################################################
+    #                              Run sweep                               #
+    ########################################################################
+
+    # Load data
+    embedded_nodes = retrieve_embeddings(get_driver(args.uri, args.user, args.password, args.pool_size))
+
+    # Perform sweep
+    results = sweep(
+        embedded_nodes,
+        spaces       = spaces,
+        n_repeats    = args.repeats,
+        n_iter       = args.n_iter,
+        random_state = args.seed,
+        cache        = args.cache,
+        n_workers    = args.workers,
+    )
+    ranking = rank(results, by=args.rank_by)
+
+    # Print ranking
+    with pd.option_context('display.max_rows', None, 'display.max_colwidth', None, 'display.width', None):
+        print(ranking.to_string(index=False, float_format='{:.4f}'.format))
+
+    if args.output:
+        ranking.to_csv(args.output, index=False)
@@ -0,0 +1,33 @@
+from lsh import near_duplicates
+import pandas as pd
+
+
+def policy_object(resource):
+    """Policy object of a bucket policy, with resource for s3:GetObject."""
+    return str([
+        {
+            'Effect'  : 'Allow',
+            'Action'  : ['s3:Get{}'.format(i) for i in range(20)],
+            'Resource': 'arn:aws:s3:::mybucket/*',
+        },
+        {
+            'Effect'  : 'Allow',
+            'Action'  : 's3:GetObject',
+            'Resource': resource,
+        },
+    ])
+
+
+def test_broadened_resource_of_pair():
+    """A copy broadening a single resource to "*" counts as added wildcard."""
+    policies = pd.DataFrame({
+        'PolicyName'  : ['known-good', 'broadened'],
+        'PolicyObject': [policy_object('arn:aws:s3:::mybucket/*'), policy_object('*')],
+    })
+
+    result = near_duplicates(policies).set_index('policy')
+
+    assert (result['cluster_size'] == 2).all()
+    assert result.loc['broadened' , 'added'] == ['allow:s3:getobject|*']
+    assert result.loc['broadened' , 'n_added_wildcards'] == 1
+    assert result.loc['known-good', 'n_added_wildcards'] == 0
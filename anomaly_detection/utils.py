@@ -1,7 +1,9 @@
-from sklearn.model_selection import train_test_split
+from hashlib import sha256
+import numpy  as np
+import os
 import pandas as pd
 
-def retrieve_embeddings(driver):
+def retrieve_embeddings(driver, policies=None):
     """Retrieve the policy nodes and their embedding from the graph database.
 
         Parameters
@@ -9,6 +11,9 @@ def retrieve_embeddings(driver):
         driver : neo4j.GraphDatabase.driver
             Driver for database connection.
 
+        policies : iterable of string, optional
+            If given, only retrieve the policies with the given names.
+
         Returns
         -------
         result : pd.DataFrame
@@ -16,33 +21,205 @@ def retrieve_embeddings(driver):
         """
     # Create a graph database session
     with driver.session(database="neo4j") as session:
-        # Collect all policies
+        # Collect all (or the requested) policies
         result = session.run(
             """
             MATCH (p:Policy)
+            WHERE $names IS NULL OR p.name IN $names
             RETURN p.name AS policy, p.embeddingNode2vec AS embedding
             """,
+            names = None if policies is None else list(policies),
         )
 
         # Transform retrieved data to a pandas dataframe and return
-        return pd.DataFrame([dict(record) for record in result])
-
-
-def split_data(X, misconfigurations = [
-        'tf-secmon-iam-policy',
-        'tf-splunk-ingestion-aws-addon-policy-master20200917101618881200000005',
-        'tf-customconfig-policy-master',
-        'tf-ds-tscm-lambda-policy',
-        'tf-aws-team-cf-cr',
-        'awt-role-boundary',
-        'awt-user-boundary',
-        'CloudabilityPolicy',
-        'PowerUserAccess',
-        'AdministratorAccess',
-        'AWSOpsWorksRegisterCLI',
-        'AWSCodeStarServiceRole',
-        'AWSApplicationMigrationReplicationServerPolicy',
-    ]):
+        return pd.DataFrame(
+            [dict(record) for record in result],
+            columns = ['policy', 'embedding'],
+        )
+
+
+def iter_embeddings(driver, chunk_size=10000):
+    """Stream the policy nodes and their embedding from the graph database.
+
+        Parameters
+        ----------
+        driver : neo4j.GraphDatabase.driver
+            Driver for database connection.
+
+        chunk_size : int, default=10000
+            Number of policies per chunk.
+
+        Yields
+        ------
+        chunk : pd.DataFrame
+            Pandas dataframe containing at most chunk_size retrieved records,
+            policies without embedding are omitted.
+        """
+    with driver.session(database="neo4j", fetch_size=chunk_size) as session:
+        result = session.run(
+            """
+            MATCH (p:Policy)
+            WHERE p.embeddingNode2vec IS NOT NULL
+            RETURN p.name AS policy, p.embeddingNode2vec AS embedding
+            """,
+        )
+
+        # Records are fetched lazily, so only a single chunk is in memory
+        chunk = list()
+        for record in result:
+            chunk.append(dict(record))
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=['policy', 'embedding'])
+                chunk = list()
+        if chunk:
+            yield pd.DataFrame(chunk, columns=['policy', 'embedding'])
+
+
+def save_embedding_cache(driver, directory, chunk_size=10000):
+    """Store all policy embeddings of the graph database in a cache directory.
+
+        The cache consists of a 'policies.txt' file with one policy name per
+        line and an 'embeddings.npy' file with the corresponding embeddings,
+        which is written chunk by chunk.
+
+        Parameters
+        ----------
+        driver : neo4j.GraphDatabase.driver
+            Driver for database connection.
+
+        directory : string
+            Directory in which to store the cache.
+
+        chunk_size : int, default=10000
+            Number of policies to retrieve at once.
+
+        Returns
+        -------
+        n_policies : int
+            Number of stored policies.
+        """
+    os.makedirs(directory, exist_ok=True)
+
+    # Determine shape of cache
+    with driver.session(database="neo4j") as session:
+        record = session.run(
+            """
+            MATCH (p:Policy)
+            WHERE p.embeddingNode2vec IS NOT NULL
+            RETURN count(p) AS n, max(size(p.embeddingNode2vec)) AS d
+            """,
+        ).single()
+    n, d = record['n'], record['d'] or 0
+
+    # Write embeddings chunk by chunk
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(directory, 'embeddings.npy'),
+        mode  = 'w+',
+        dtype = np.float64,
+        shape = (n, d),
+    )
+    offset = 0
+    with open(os.path.join(directory, 'policies.txt'), 'w') as outfile:
+        for chunk in iter_embeddings(driver, chunk_size):
+            # Guard against policies created while caching
+            chunk = chunk.iloc[:n - offset]
+            embeddings[offset:offset+chunk.shape[0]] = embedding_matrix(chunk)
+            outfile.writelines(name.replace('\n', ' ') + '\n' for name in chunk['policy'])
+            offset += chunk.shape[0]
+    embeddings.flush()
+
+    # Return number of stored policies
+    return offset
+
+
+def load_embedding_cache(directory):
+    """Load an embedding cache created by save_embedding_cache().
+
+        Parameters
+        ----------
+        directory : string
+            Directory of the cache.
+
+        Returns
+        -------
+        policies : list of string
+            Name of each policy.
+
+        embeddings : np.memmap of shape=(n_policies, n_dimensions)
+            Memory mapped embeddings, only the accessed rows are read.
+        """
+    with open(os.path.join(directory, 'policies.txt')) as infile:
+        policies = infile.read().splitlines()
+    embeddings = np.load(os.path.join(directory, 'embeddings.npy'), mmap_mode='r')
+    # Policies removed while caching leave unused rows at the end
+    n = min(len(policies), embeddings.shape[0])
+    return policies[:n], embeddings[:n]
+
+
+def embedding_version(X, matrix=None):
+    """Compute a version identifier of the embeddings in X.
+
+        The version changes whenever a policy is added, removed or receives a
+        different embedding, e.g., after recomputing the graph embedding.
+
+        Parameters
+        ----------
+        X : pd.DataFrame
+            Dataframe as returned by retrieve_embeddings().
+
+        matrix : np.array or scipy.sparse matrix, optional
+            If given, use the rows of matrix as embeddings of the policies in
+            X instead of the 'embedding' column, e.g., for features.
+
+        Returns
+        -------
+        version : string
+            Hexadecimal digest identifying the embeddings.
+        """
+    if matrix is None:
+        matrix = embedding_matrix(X)
+
+    # Hash embeddings in a fixed order of policies
+    order  = np.argsort(X['policy'].astype(str).to_numpy(), kind='stable')
+    matrix = matrix[order]
+    digest = sha256()
+    digest.update('\0'.join(X['policy'].astype(str).to_numpy()[order]).encode('utf-8'))
+    if hasattr(matrix, 'tocsr'):
+        matrix = matrix.tocsr()
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            digest.update(np.ascontiguousarray(array).tobytes())
+    else:
+        digest.update(np.ascontiguousarray(matrix).tobytes())
+
+    # Return version
+    return digest.hexdigest()[:16]
+
+
+# Policy names of misconfigurations in our own database
+MISCONFIGURATIONS = [
+    'tf-secmon-iam-policy',
+    'tf-splunk-ingestion-aws-addon-policy-master20200917101618881200000005',
+    'tf-customconfig-policy-master',
+    'tf-ds-tscm-lambda-policy',
+    'tf-aws-team-cf-cr',
+    'awt-role-boundary',
+    'awt-user-boundary',
+    'CloudabilityPolicy',
+    'PowerUserAccess',
+    'AdministratorAccess',
+    'AWSOpsWorksRegisterCLI',
+    'AWSCodeStarServiceRole',
+    'AWSApplicationMigrationReplicationServerPolicy',
+]
+
+
+def split_data(
+        X,
+        misconfigurations = MISCONFIGURATIONS,
+        test_size         = 0.1,
+        random_state      = None,
+        stratify          = None,
+    ):
     """Split data such that the train data contains only correct configurations
         and the test data contains a mix of correct and misconfigured policies.
 
@@ -57,52 +234,175 @@ def split_data(X, misconfigurations = [
             Important: The misconfigurations must be specified if using
             different evaluation data.
 
+        test_size : float or int, default=0.1
+            Fraction (float) or number (int) of correct configurations to put
+            in the test set.
+
+        random_state : int, np.random.RandomState or None, default=None
+            Seed used for shuffling the correct configurations, pass an int
+            for reproducible splits.
+
+        stratify : string, array-like or None, default=None
+            If given, split the correct configurations in a stratified
+            fashion. Either the name of a column of X, or an array-like of
+            shape=(n_samples,) containing the class of each row in X.
+
         Returns
         -------
-        X_train : list
+        X_train : pd.DataFrame
             Train data.
 
-        X_test : list
+        X_test : pd.DataFrame
             Test data.
 
-        y_train : list
+        y_train : pd.Series
             Train labels.
 
-        y_test : list
+        y_test : pd.Series
             Test labels.
         """
-    # Set all target values to 1, i.e. benign
-    X['target'] = 1
+    # Create mask of misconfigured policies, this does not modify X
+    mask = _misconfiguration_mask(X, misconfigurations)
+
+    # Split positions of correct configurations
+    train, test = _split_positions(
+        positions    = np.flatnonzero(~mask),
+        test_size    = test_size,
+        random_state = random_state,
+        stratify     = _stratify_labels(X, stratify),
+    )
+
+    # Return result
+    return _take_split(X, mask, train, test)
+
+
+def repeated_split_data(
+        X,
+        misconfigurations = MISCONFIGURATIONS,
+        n_repeats         = 10,
+        test_size         = 0.1,
+        random_state      = None,
+        stratify          = None,
+    ):
+    """Generate repeated splits as given by split_data(), e.g., for
+        evaluating over multiple folds.
+
+        Note
+        ----
+        The misconfiguration mask is computed only once, each repetition only
+        shuffles the positions of the correct configurations.
+
+        Parameters
+        ----------
+        X : pd.DataFrame
+            Dataframe to split into train and test data.
+
+        misconfigurations : list, default=list used for own database.
+            List of misconfigured policynames.
+
+        n_repeats : int, default=10
+            Number of splits to generate.
+
+        test_size : float or int, default=0.1
+            Fraction (float) or number (int) of correct configurations to put
+            in the test set.
+
+        random_state : int, np.random.RandomState or None, default=None
+            Seed from which the seed of each repetition is derived, pass an
+            int for reproducible splits.
+
+        stratify : string, array-like or None, default=None
+            See split_data().
+
+        Yields
+        ------
+        seed : int
+            Seed used for the given split, passing it as random_state to
+            split_data() reproduces the split.
+
+        X_train, X_test, y_train, y_test : tuple
+            Split as returned by split_data().
+        """
+    # Compute mask and labels once for all repetitions
+    mask      = _misconfiguration_mask(X, misconfigurations)
+    positions = np.flatnonzero(~mask)
+    labels    = _stratify_labels(X, stratify)
+
+    # Derive a seed for each repetition
+    from sklearn.utils import check_random_state
+    seeds = check_random_state(random_state).randint(
+        np.iinfo(np.int32).max,
+        size = n_repeats,
+    )
+
+    # Yield each split
+    for seed in seeds:
+        train, test = _split_positions(positions, test_size, int(seed), labels)
+        yield (int(seed),) + _take_split(X, mask, train, test)
+
 
-    ############################################################################
-    #                        Extract misconfigurations                         #
-    ############################################################################
+################################################################################
+#                           Auxiliary split methods                            #
+################################################################################
 
-    # Create dataframe for misconfigurations
-    df_misconfs = pd.DataFrame(columns=['policy', 'embedding', 'target'])
+def _misconfiguration_mask(X, misconfigurations):
+    """Return boolean mask indicating which rows of X are misconfigured."""
+    return X['policy'].isin(set(misconfigurations)).to_numpy()
 
-    # Loop over all policies
-    for name in misconfigurations:
-        for index, policy in X.iterrows():
-            # Check if policy is misconfigured
-            if policy.policy == name:
 
-                # Add policy to misconfigurations
-                df_misconfs = df_misconfs.append(policy, ignore_index=True)
-                # Remove policy from correct configurations
-                X.drop(index, inplace=True)
+def _stratify_labels(X, stratify):
+    """Return stratification labels for each row in X or None."""
+    if stratify is None:
+        return None
+    if isinstance(stratify, str):
+        return X[stratify].to_numpy()
+    return np.asarray(stratify)
 
-    # Set misconfiguration target to malicious
-    df_misconfs['target'] = -1
-    y = X.pop('target')
 
-    # Split benign data into train-test sets
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1)
+def _split_positions(positions, test_size, random_state, stratify):
+    """Split the positions of correct configurations into train and test."""
+    # Imported on first use, as importing scikit-learn is slow
+    from sklearn.model_selection import train_test_split
+    return train_test_split(
+        positions,
+        test_size    = test_size,
+        random_state = random_state,
+        stratify     = None if stratify is None else stratify[positions],
+    )
 
-    # Add misconfigurations to test set
-    y_misconfs = df_misconfs.pop('target')
-    X_test = X_test.append(df_misconfs)
-    y_test = y_test.append( y_misconfs)
+
+def _take_split(X, mask, train, test):
+    """Select train and test rows from X and create corresponding labels."""
+    # Test set contains correct configurations followed by misconfigurations
+    test = np.concatenate((test, np.flatnonzero(mask)))
+
+    # Select data
+    X_train = X.iloc[train]
+    X_test  = X.iloc[test]
+
+    # Create labels, 1 for benign and -1 for misconfigurations
+    y_train = pd.Series(1, index=X_train.index, name='target')
+    y_test  = pd.Series(
+        np.where(mask[test], -1, 1),
+        index = X_test.index,
+        name  = 'target',
+    )
 
     # Return result
     return X_train, X_test, y_train, y_test
+
+
+def embedding_matrix(X):
+    """Stack the embeddings of given dataframe into a single matrix.
+
+        Parameters
+        ----------
+        X : pd.DataFrame
+            Dataframe containing an 'embedding' column.
+
+        Returns
+        -------
+        result : np.array of shape=(n_samples, n_dimensions)
+            Embeddings as a contiguous float matrix.
+        """
+    return np.asarray(X['embedding'].tolist(), dtype=np.float64)
@@ -0,0 +1,148 @@
+import json
+import os
+import sqlite3
+
+from hashlib import sha256
+
+def fingerprint(name, policy_object):
+    """Compute fingerprint of a policy document.
+
+        Parameters
+        ----------
+        name : string
+            Name of policy.
+
+        policy_object : string
+            Policy object as stored in the PolicyObject column.
+
+        Returns
+        -------
+        fingerprint : string
+            Hash of policy name and document, statements of policies with
+            equal fingerprints have equal violations.
+        """
+    return sha256('{}\0{}'.format(name, policy_object).encode('utf-8')).hexdigest()
+
+
+class VerdictCache(object):
+    """Persistent cache of violations of policy documents.
+
+        Stores the violations of each statement of a policy document, keyed by
+        the fingerprint of the document and the version of the rules, see
+        CloudCustodianCustomEngine.version. Entries of other rule versions are
+        never returned, such that changing the rules invalidates the cache.
+
+        Parameters
+        ----------
+        path : string
+            Path of SQLite database file.
+
+        version : string
+            Version of the rules.
+
+        readonly : boolean, default=False
+            If True, open the cache for reading only, e.g., in worker
+            processes while the main process writes.
+        """
+
+    def __init__(self, path, version, readonly=False):
+        self.path     = path
+        self.version  = version
+        self.readonly = readonly
+
+        if readonly:
+            # A missing cache behaves as an empty cache
+            self.connection = None
+            if os.path.exists(path):
+                self.connection = sqlite3.connect(
+                    'file:{}?mode=ro'.format(path), uri=True, timeout=30)
+        else:
+            self.connection = sqlite3.connect(path, timeout=30)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "    fingerprint TEXT NOT NULL,"
+                "    version     TEXT NOT NULL,"
+                "    violations  TEXT NOT NULL,"
+                "    PRIMARY KEY (fingerprint, version)"
+                ")"
+            )
+            self.connection.commit()
+
+    def get(self, fingerprints, batch_size=500):
+        """Retrieve cached violations.
+
+            Parameters
+            ----------
+            fingerprints : iterable of string
+                Fingerprints of policy documents to retrieve.
+
+            batch_size : int, default=500
+                Number of fingerprints to query at once.
+
+            Returns
+            -------
+            result : dict()
+                Dictionary of fingerprint -> list of frozenset, containing the
+                violations of each statement, only for cached documents.
+            """
+        result = dict()
+        if self.connection is None:
+            return result
+
+        fingerprints = list(fingerprints)
+        for start in range(0, len(fingerprints), batch_size):
+            batch = fingerprints[start:start+batch_size]
+            rows  = self.connection.execute(
+                "SELECT fingerprint, violations FROM verdicts "
+                "WHERE version = ? AND fingerprint IN ({})".format(','.join('?' * len(batch))),
+                [self.version] + batch,
+            )
+            for fingerprint, violations in rows:
+                result[fingerprint] = [frozenset(v) for v in json.loads(violations)]
+
+        # Return result
+        return result
+
+    def put(self, entries):
+        """Store violations.
+
+            Parameters
+            ----------
+            entries : dict()
+                Dictionary of fingerprint -> list of sets, containing the
+                violations of each statement of a policy document.
+            """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+            [
+                (fingerprint, self.version, json.dumps([sorted(v) for v in violations]))
+                for fingerprint, violations in entries.items()
+            ],
+        )
+        self.connection.commit()
+
+    def prune(self):
+        """Remove entries of other rule versions.
+
+            Returns
+            -------
+            removed : int
+                Number of removed entries.
+            """
+        removed = self.connection.execute(
+            "DELETE FROM verdicts WHERE version != ?", (self.version,)).rowcount
+        self.connection.commit()
+        return removed
+
+    def close(self):
+        """Close the cache."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
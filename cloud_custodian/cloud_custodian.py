@@ -2,11 +2,23 @@ import argformat
 import argparse
 import json
 import numpy  as np
+import os
 import pandas as pd
+import sys
+import time
 import warnings
 import yaml
 
-from sklearn.metrics import classification_report
+from cache              import VerdictCache, fingerprint
+from collections        import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from hashlib            import sha256
+from matching           import PatternTrie, broad_resource, covers
+from statements         import StatementTable
+
+# Shared instrumentation layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import metrics
 
 def get_policies(data):
     """Extract policies from pandas DataFrame.
@@ -48,7 +60,7 @@ def get_policies(data):
     return policies
 
 
-def preprocess_policies(policies, misconfigurations):
+def preprocess_policies(policies, misconfigurations, columnar=False):
     """Transform policies into labelled training and testing data.
 
         Parameters
@@ -59,14 +71,24 @@ def preprocess_policies(policies, misconfigurations):
         misconfigurations : iterable
             Iterable of policy names that are misconfigured.
 
+        columnar : boolean, default=False
+            If True, return statements as a StatementTable, which requires
+            several times less memory and is evaluated using vectorized
+            operations by the CloudCustodianCustomEngine.
+
         Returns
         -------
-        X : np.array of shape=(n_subpolicies)
+        X : np.array of shape=(n_subpolicies) or StatementTable
             Policies to check.
 
         y : np.array of shape=(n_subpolicies)
             Labels for each policy
         """
+    # Return columnar statements, without modifying the statements
+    if columnar:
+        X = StatementTable.from_policies(policies)
+        return X, X.labels(misconfigurations)
+
     # Cast misconfigurations to set
     misconfigurations = set(misconfigurations)
 
@@ -92,6 +114,19 @@ def preprocess_policies(policies, misconfigurations):
 
 
 def load_policies_cloud_custodian(paths):
+    """Load Cloud Custodian rule files.
+
+        Parameters
+        ----------
+        paths : iterable of string
+            Paths of YAML files containing Cloud Custodian rules.
+
+        Returns
+        -------
+        rules : list of dict()
+            Loaded YAML document of each file, see custodian_rules() to
+            translate them for the CloudCustodianCustomEngine.
+        """
     # Initialise rules
     rules = list()
 
@@ -116,15 +151,535 @@ def load_policies_cloud_custodian(paths):
     return rules
 
 
+################################################################################
+#                                    Rules                                     #
+################################################################################
+
+class Rule(namedtuple('Rule', [
+        'name',
+        'actions',
+        'patterns',
+        'policy_names',
+        'effect',
+        'resource',
+        'allow_condition',
+        'overly_permissive',
+    ])):
+    """A single rule checked by the CloudCustodianCustomEngine.
+
+        A statement violates a rule if it has the rule's effect, covers the
+        rule's resource, has no Condition (unless allow_condition is True), and
+        either grants one of the rule's actions, grants any action matching one
+        of the rule's patterns or belongs to one of the rule's policies.
+        Actions and resources are matched case-insensitively with wildcards,
+        see matching.py.
+
+        Attributes
+        ----------
+        name : string
+            Name of violation reported for this rule.
+
+        actions : tuple of string
+            Actions of which any must be covered by an action of the statement,
+            e.g., "ec2:RunInstances" is covered by "ec2:Run*" and "ec2:*",
+            whereas "ec2:*" is only covered by statements granting all actions
+            of ec2.
+
+        patterns : tuple of string
+            Action patterns of which any must overlap an action of the
+            statement, e.g., "s3:Put*" overlaps "s3:PutObject" and "s3:*".
+
+        policy_names : tuple of string
+            Names of policies for which statements violate this rule.
+
+        effect : string, default="Allow"
+            Effect of statement.
+
+        resource : string, default="*"
+            Resource that must be covered by the statement, "*" matches all
+            broad resources, see matching.broad_resource().
+
+        allow_condition : boolean, default=False
+            If True, also match statements containing a Condition.
+
+        overly_permissive : boolean, default=False
+            If True, the rule is used in the non-strict detection of overly
+            permissive policies.
+        """
+    __slots__ = ()
+
+Rule.__new__.__defaults__ = ((), (), (), "Allow", "*", False, False)
+
+
+# Rules are manually implemented version of policies from
+# https://github.com/davidclin/cloudcustodian-policies.
+DEFAULT_RULES = (
+    # iam-ec2-policy-check
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-ec2-policy-check.yml
+    Rule('allow-all', actions=('*',), allow_condition=True, overly_permissive=True),
+
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-ec2-policy-check.yml
+    Rule('ec2:*'                      , actions=('ec2:*'                      ,)),
+    Rule('elasticloadbalancing:*'     , actions=('elasticloadbalancing:*'     ,)),
+    Rule('cloudwatch:*'               , actions=('cloudwatch:*'               ,)),
+    Rule('autoscaling:*'              , actions=('autoscaling:*'              ,)),
+    Rule('iam:CreateServiceLinkedRole', actions=('iam:CreateServiceLinkedRole',)),
+    Rule('ec2:RunInstances'           , actions=('ec2:RunInstances'           ,)),
+
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-CreatePolicy-audit.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-CreatePolicyVersion-audit.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-account-Summary-audit.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-account-audit.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-user-DeleteLoginProfile-offboarding.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-user-UpdateAccessKey-offboarding.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/c7n-org/CustomAccount/iam-user-CreateLoginProfile.yml
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/c7n-org/CustomAccount/iam-user-UpdateAccessKey-audit.yml
+    Rule('account:*'            , actions=('account:*'            ,)),
+    Rule('account:EnableRegion' , actions=('account:EnableRegion' ,)),
+
+    # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-role-with-managed-policy-audit.yml
+    Rule('policyname-violation', policy_names=(
+        "AmazonEC2FullAccess",
+        "AutoScalingFullAccess",
+        "ElasitcLoadBalancingFullAccess",
+        "AutoScalingConsoleFullAccess",
+    )),
+)
+
+
+# Actions matched by the has-allow-all filter after applying the patch of
+# README.md to the c7n iam.py module.
+HAS_ALLOW_ALL_PATCH = (
+    'ec2:*',
+    'elasticloadbalancing:*',
+    'cloudwatch:*',
+    'autoscaling:*',
+    'iam:CreateServiceLinkedRole',
+    'ec2:RunInstances',
+)
+
+
+def custodian_rules(documents, patched=True):
+    """Translate Cloud Custodian rules into Rules for the custom engine.
+
+        Supports the filters used by the IAM rules of cloudcustodian-policies.
+        Other filters are skipped with a warning. Note that the filters of a
+        single policy are combined, i.e., a statement violates the policy if
+        it matches any of its filters.
+
+          - has-allow-all: statements allowing action "*" (and the actions of
+            HAS_ALLOW_ALL_PATCH if patched).
+          - check-permissions: statements allowing any of the given actions.
+          - has-specific-managed-policy and value filters on PolicyName:
+            statements of the given policies.
+          - cloudtrail mode: statements allowing any of the audited events.
+
+        Parameters
+        ----------
+        documents : iterable of dict()
+            Documents as returned by load_policies_cloud_custodian().
+
+        patched : boolean, default=True
+            If True, has-allow-all filters include the actions of the README.md
+            patch.
+
+        Returns
+        -------
+        rules : list of Rule
+            Rules of all policies in documents.
+        """
+    rules = list()
+
+    for document in documents:
+        for policy in (document or dict()).get('policies', list()):
+            name     = policy.get('name', 'unnamed')
+            actions  = list()
+            patterns = list()
+            policies = list()
+
+            # Translate filters, flattening boolean blocks
+            filters = list(policy.get('filters', list()))
+            while filters:
+                filter_ = filters.pop()
+                if isinstance(filter_, str):
+                    filter_ = {'type': filter_}
+                if not isinstance(filter_, dict):
+                    continue
+
+                # Boolean blocks
+                if any(block in filter_ for block in ('or', 'and', 'not')):
+                    filters.extend(filter_.get('or', list()) + filter_.get('and', list()))
+                    if 'not' in filter_:
+                        warnings.warn("Skipping 'not' filter of rule {}".format(name))
+                    continue
+
+                # Shorthand value filter, e.g., {'PolicyName': 'AdministratorAccess'}
+                if 'type' not in filter_ and list(filter_) == ['PolicyName']:
+                    filter_ = {'type': 'value', 'key': 'PolicyName', 'value': filter_['PolicyName']}
+
+                type_ = filter_.get('type')
+                if type_ == 'has-allow-all':
+                    rules.append(Rule(name + ':allow-all', actions=('*',), overly_permissive=True))
+                    if patched:
+                        actions.extend(HAS_ALLOW_ALL_PATCH)
+                elif type_ == 'check-permissions' and filter_.get('match', 'allowed') == 'allowed':
+                    patterns.extend(filter_.get('actions', list()))
+                elif type_ == 'has-specific-managed-policy':
+                    policies.append(filter_.get('value'))
+                elif type_ == 'value' and filter_.get('key') == 'PolicyName' and \
+                        filter_.get('op', 'eq') in ('eq', 'equal', 'in'):
+                    value = filter_.get('value')
+                    policies.extend(value if isinstance(value, list) else [value])
+                else:
+                    warnings.warn("Skipping unsupported filter {} of rule {}".format(type_, name))
+
+            # Translate audited cloudtrail events into actions
+            mode = policy.get('mode') or dict()
+            if mode.get('type') == 'cloudtrail':
+                for event in mode.get('events', list()):
+                    if isinstance(event, dict) and 'source' in event and 'event' in event:
+                        patterns.append('{}:{}'.format(
+                            event['source'].split('.', 1)[0], event['event']))
+                    else:
+                        warnings.warn("Skipping shorthand event {} of rule {}".format(event, name))
+
+            # Add rule
+            if actions or patterns or policies:
+                rules.append(Rule(
+                    name,
+                    actions      = tuple(actions),
+                    patterns     = tuple(patterns),
+                    policy_names = tuple(str(policy) for policy in policies),
+                ))
+
+    # Return rules
+    return rules
+
+################################################################################
+#                                    Engine                                    #
+################################################################################
+
+# Empty set of violations
+EMPTY = frozenset()
+
+
 class CloudCustodianCustomEngine(object):
-    """A custom engine for checking Cloud Custodian rules."""
+    """A custom engine for checking Cloud Custodian rules.
+
+        Rules are compiled once into pattern tries, indexed by the effect,
+        resource and presence of a Condition of a statement. Each statement is
+        then evaluated in a single pass using one trie lookup per distinct
+        action, whose result is cached as statements share few distinct
+        actions and resources.
+
+        Parameters
+        ----------
+        rules : iterable of Rule, default=DEFAULT_RULES
+            Rules to check, see custodian_rules() for using Cloud Custodian
+            rule files.
+        """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = tuple(rules)
+
+        # Version of rules, changes whenever any rule changes
+        self.version = sha256(repr(self.rules).encode('utf-8')).hexdigest()[:16]
+
+        # Names of violations used for non-strict detection
+        self.overly_permissive = frozenset(
+            rule.name for rule in self.rules if rule.overly_permissive
+        )
+
+        # Compile rules into tries of actions and patterns, and lookup tables of policy name -> violations
+        tables = dict()
+        for rule in self.rules:
+            for has_condition in ((False, True) if rule.allow_condition else (False,)):
+                actions, patterns, policies = tables.setdefault(
+                    (rule.effect, rule.resource, has_condition),
+                    (PatternTrie(), PatternTrie(), dict()),
+                )
+                for action in rule.actions:
+                    actions.add(action, rule.name)
+                for pattern in rule.patterns:
+                    patterns.add(pattern, rule.name)
+                for policy in rule.policy_names:
+                    policies.setdefault(policy, set()).add(rule.name)
+
+        self.tables = {
+            key: (actions, patterns, {
+                policy: frozenset(names) for policy, names in policies.items()
+            }) for key, (actions, patterns, policies) in tables.items()
+        }
+
+        # Distinct resources of rules
+        self.resources = tuple(sorted({resource for _, resource, _ in self.tables}))
+
+        # Caches of resource -> covered rule resources and (table, action) -> violations
+        self._resource_cache = dict()
+        self._action_cache   = {key: dict() for key in self.tables}
+
+    def _covered_resources(self, resource):
+        """Return the rule resources covered by a statement resource.
+
+            Parameters
+            ----------
+            resource : string or list of string
+                Resource of statement.
+
+            Returns
+            -------
+            result : tuple of string
+                Resources of rules covered by resource.
+            """
+        result = self._resource_cache.get(resource) if isinstance(resource, str) else None
+        if result is not None:
+            return result
+
+        resources = tuple(
+            r for r in (resource if isinstance(resource, list) else [resource])
+            if isinstance(r, str)
+        )
+        result = self._resource_cache.get(resources)
+        if result is None:
+            result = tuple(
+                rule_resource for rule_resource in self.resources if any(
+                    broad_resource(r) if rule_resource == '*' else covers(r, rule_resource)
+                    for r in resources
+                )
+            )
+            self._resource_cache[resource if isinstance(resource, str) else resources] = result
+        return result
+
+    def _action_violations(self, key, action):
+        """Return violations of a single action for the table of key."""
+        cache  = self._action_cache[key]
+        result = cache.get(action)
+        if result is None:
+            actions, patterns, _ = self.tables[key]
+            result = cache[action] = frozenset(
+                actions.covered_by(action) | patterns.overlapping(action)
+            )
+        return result
+
+    def evaluate(self, X):
+        """Evaluate all statements in a single pass.
+
+            Parameters
+            ----------
+            X : array-like of shape=(n_samples,)
+                Statements to check.
+
+            Returns
+            -------
+            result : list of frozenset
+                Violations of each statement.
+            """
+        verify = self.verify_statement
+        return [verify(statement) for statement in X]
+
+    def verdicts(self, violations):
+        """Derive loose and strict verdicts from violations.
+
+            Parameters
+            ----------
+            violations : list of set
+                Violations of each statement as returned by evaluate().
+
+            Returns
+            -------
+            loose : np.array of shape=(n_samples,)
+                Evaluation of acceptable (0) or overly permissive (1) policies.
+
+            strict : np.array of shape=(n_samples,)
+                Evaluation of acceptable (0) or misconfigured (1) policies.
+            """
+        disjoint = self.overly_permissive.isdisjoint
+        n_samples = len(violations)
+        loose  = np.fromiter((not disjoint(v) for v in violations), dtype=bool, count=n_samples)
+        strict = np.fromiter((bool(v)         for v in violations), dtype=bool, count=n_samples)
+        return loose.astype(int), strict.astype(int)
+
+    def classify(self, X):
+        """Evaluate statements and return loose and strict verdicts.
+
+            Parameters
+            ----------
+            X : array-like of shape=(n_samples,) or StatementTable
+                Statements to check. A StatementTable is evaluated using
+                vectorized operations, see classify_table().
+
+            Returns
+            -------
+            loose : np.array of shape=(n_samples,)
+                Evaluation of acceptable (0) or overly permissive (1) policies.
+
+            strict : np.array of shape=(n_samples,)
+                Evaluation of acceptable (0) or misconfigured (1) policies.
+            """
+        with metrics.stage('rules.classify'), metrics.sample('rules.classify'):
+            metrics.rows(len(X))
+            if isinstance(X, StatementTable):
+                return self.classify_table(X)
+            return self.verdicts(self.evaluate(X))
+
+    def classify_table(self, table):
+        """Evaluate a StatementTable using vectorized operations.
+
+            Rules are only evaluated once per distinct string in the table,
+            yielding a mask per string id. Each statement is then evaluated by
+            indexing these masks with the ids of its actions and resources.
+
+            Parameters
+            ----------
+            table : StatementTable
+                Statements to check.
+
+            Returns
+            -------
+            loose : np.array of shape=(n_samples,)
+                Evaluation of acceptable (0) or overly permissive (1) policies.
+
+            strict : np.array of shape=(n_samples,)
+                Evaluation of acceptable (0) or misconfigured (1) policies.
+            """
+        n_strings = len(table.strings)
+        loose     = np.zeros(len(table), dtype=bool)
+        strict    = np.zeros(len(table), dtype=bool)
+
+        # Distinct actions, resources and policy names in table
+        actions   = np.unique(table.action_ids  )
+        resources = np.unique(table.resource_ids)
+        policies  = np.unique(table.policy      )
+
+        # Statements covering each rule resource
+        covered = dict()
+        for resource in self.resources:
+            mask = np.zeros(n_strings, dtype=bool)
+            mask[resources] = [
+                resource in self._covered_resources(table.strings[id]) for id in resources
+            ]
+            covered[resource] = table.any_segment(mask[table.resource_ids], table.resource_offsets)
+
+        for key, (_, _, policy_violations) in self.tables.items():
+            effect, resource, has_condition = key
+
+            # Effect used by no statement, statements without effect also have id -1
+            effect_id = table.id(effect)
+            if effect_id < 0:
+                continue
+
+            # Select statements of table
+            selected = (
+                (table.effect == effect_id) &
+                (table.condition == has_condition) &
+                covered[resource]
+            )
+            if not selected.any():
+                continue
+
+            # Masks of strings with any and overly permissive violations
+            mask_any = np.zeros(n_strings, dtype=bool)
+            mask_op  = np.zeros(n_strings, dtype=bool)
+            for id in actions:
+                violations = self._action_violations(key, table.strings[id])
+                if violations:
+                    mask_any[id] = True
+                    mask_op [id] = not self.overly_permissive.isdisjoint(violations)
+
+            policy_any = np.zeros(n_strings, dtype=bool)
+            policy_op  = np.zeros(n_strings, dtype=bool)
+            for id in policies:
+                violations = policy_violations.get(table.strings[id])
+                if violations:
+                    policy_any[id] = True
+                    policy_op [id] = not self.overly_permissive.isdisjoint(violations)
+
+            # Evaluate statements
+            strict |= selected & (
+                table.any_segment(mask_any[table.action_ids], table.action_offsets) |
+                policy_any[table.policy]
+            )
+            loose |= selected & (
+                table.any_segment(mask_op[table.action_ids], table.action_offsets) |
+                policy_op[table.policy]
+            )
+
+        # Return result
+        return loose.astype(int), strict.astype(int)
+
+    def checks(self, actions, resources, policies=()):
+        """Compile rules into checks restricted to the given strings.
+
+            Used to evaluate the rules inside a database, see graph_rules.py.
+            A statement fails a check if it has the check's effect and
+            condition, any of its resources, and any of its actions or belongs
+            to any of its policies.
+
+            Parameters
+            ----------
+            actions : iterable of string
+                Distinct actions of all statements.
+
+            resources : iterable of string
+                Distinct resources of all statements.
+
+            policies : iterable of string, default=()
+                Distinct names of all policies.
+
+            Returns
+            -------
+            checks : list of dict()
+                Checks with the keys 'effect', 'condition', 'resources',
+                'actions' and 'policies', where 'actions' and 'policies'
+                map each action or policy name to its violations. Checks
+                that cannot fail are omitted.
+            """
+        actions   = [action   for action   in set(actions  ) if isinstance(action  , str)]
+        resources = [resource for resource in set(resources) if isinstance(resource, str)]
+        policies  = set(policies)
+        result    = list()
+
+        for key, (_, _, policy_violations) in self.tables.items():
+            effect, resource, has_condition = key
+
+            # Select resources and actions that match rules of key
+            covered = [r for r in resources if resource in self._covered_resources(r)]
+            if not covered:
+                continue
+            action_violations = dict()
+            for action in actions:
+                violations = self._action_violations(key, action)
+                if violations:
+                    action_violations[action] = sorted(violations)
+            policies_ = {
+                policy: sorted(violations) for policy, violations in policy_violations.items()
+                if policy in policies
+            }
+
+            # Add check
+            if action_violations or policies_:
+                result.append({
+                    'effect'   : effect,
+                    'condition': has_condition,
+                    'resources': covered,
+                    'actions'  : action_violations,
+                    'policies' : policies_,
+                })
+
+        # Return result
+        return result
 
     def predict(self, X, strict=False):
         """Validate whether given IAM management is in accordance with policies.
 
+            Note
+            ----
+            To obtain both strict and non-strict results, use classify(),
+            which evaluates each statement only once.
+
             Parameters
             ----------
-            X : array-like of shape=(n_samples,)
+            X : array-like of shape=(n_samples,) or StatementTable
                 Samples for which to check if they match our rules.
 
             strict : boolean, default=False
@@ -137,31 +692,13 @@ class CloudCustodianCustomEngine(object):
             result : np.array of shape=(n_samples,)
                 Evaluation of acceptable (0) or misconfigured (1) policies.
             """
-        # Initialise result
-        result = list()
-
-        # Loop over all policies
-        for statement in X:
-            # Check if statement is correct
-            violations = self.verify_statement(statement)
-
-            if violations and (strict or "allow-all" in violations):
-                result.append(1)
-            else:
-                result.append(0)
-
-        # Return result
-        return np.asarray(result)
+        loose, strict_ = self.classify(X)
+        return strict_ if strict else loose
 
 
     def verify_statement(self, statement):
         """Verify whether a statement is acceptable for our rules.
 
-            Note
-            ----
-            Rules are manually implemented version of policies from
-            https://github.com/davidclin/cloudcustodian-policies.
-
             Parameters
             ----------
             statement : dict()
@@ -169,65 +706,219 @@ class CloudCustodianCustomEngine(object):
 
             Returns
             -------
-            result : set()
+            result : frozenset()
                 Set of matching policies.
             """
-        # Initialise result
-        result = set()
-
-        # Extract values
-        action   = statement.get('Action')
-        resource = statement.get('Resource')
-        effect   = statement.get('Effect')
-        if action is None:
-            actions = list()
-        elif isinstance(action, list):
-            actions = action
-        else:
-            actions = [action]
-
-        # iam-ec2-policy-check
-        # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-ec2-policy-check.yml
-        if action == '*' and resource == '*' and effect == "Allow":
-            result.add('allow-all')
-
-        # Other policy checks
-        if 'Condition' not in statement and resource == "*" and effect == "Allow":
-
-            # Specify mismatches
-            mismatches = [
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-ec2-policy-check.yml
-                "ec2:*",
-                "elasticloadbalancing:*",
-                "cloudwatch:*",
-                "autoscaling:*",
-                "iam:CreateServiceLinkedRole",
-                "ec2:RunInstances",
-
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-CreatePolicy-audit.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-CreatePolicyVersion-audit.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-account-Summary-audit.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-policy-account-audit.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-user-DeleteLoginProfile-offboarding.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-user-UpdateAccessKey-offboarding.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/c7n-org/CustomAccount/iam-user-CreateLoginProfile.yml
-                # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/c7n-org/CustomAccount/iam-user-UpdateAccessKey-audit.yml
-                "account:*",
-                "account:EnableRegion",
-            ]
+        result    = EMPTY
+        effect    = statement.get('Effect')
+        condition = 'Condition' in statement
+
+        # Actions of statement
+        action = statement.get('Action')
+        if isinstance(action, str):
+            action = (action,)
+        elif not isinstance(action, list):
+            action = ()
+
+        # Look up tables for effect, condition and each covered resource
+        for resource in self._covered_resources(statement.get('Resource')):
+            key   = (effect, resource, condition)
+            cache = self._action_cache.get(key)
+            if cache is None:
+                continue
+
+            # Look up violations of each action, from cache if possible
+            for action_ in action:
+                if isinstance(action_, str):
+                    violations = cache.get(action_)
+                    if violations is None:
+                        violations = self._action_violations(key, action_)
+                    if violations:
+                        result = result | violations
+
+            # Look up violations of the policy name
+            violations = self.tables[key][2].get(statement.get('PolicyName'))
+            if violations is not None:
+                result = result | violations
 
-            # Check against mismatches
-            for mismatch in mismatches:
-                if mismatch in actions:
-                    result.add(mismatch)
+        # Return result
+        return result
 
-            # https://github.com/davidclin/cloudcustodian-policies/blob/master/policies/iam-role-with-managed-policy-audit.yml
-            if statement.get('PolicyName') in {"AmazonEC2FullAccess", "AutoScalingFullAccess", "ElasitcLoadBalancingFullAccess", "AutoScalingConsoleFullAccess"}:
-                result.add("policyname-violation")
 
+################################################################################
+#                               File evaluation                                #
+################################################################################
 
-        # Return result
-        return result
+# Policies that are misconfigured in our data
+MISCONFIGURATIONS = [
+    'AmazonS3FullAccess',
+    'AdministratorAccess',
+    'PowerUserAccess',
+    'DataScientist',
+    'AWS_ConfigRole',
+    'AWSCodeCommitPowerUser',
+]
+
+# Engine of a worker process, set by _init_worker()
+_worker = dict()
+
+
+def _init_worker(rule_files=None, misconfigurations=MISCONFIGURATIONS, cache=None):
+    """Build the engine once per worker process.
+
+        Parameters
+        ----------
+        rule_files : iterable of string, optional
+            Files containing cloud custodian rules, by default DEFAULT_RULES
+            are used.
+
+        misconfigurations : iterable, default=MISCONFIGURATIONS
+            Iterable of policy names that are misconfigured.
+
+        cache : string, optional
+            Path of verdict cache, which workers only read from.
+        """
+    if rule_files:
+        rules = custodian_rules(load_policies_cloud_custodian(rule_files))
+    else:
+        rules = DEFAULT_RULES
+    _worker['engine'           ] = CloudCustodianCustomEngine(rules)
+    _worker['misconfigurations'] = set(misconfigurations)
+    _worker['cache'            ] = None if cache is None else VerdictCache(
+        cache, _worker['engine'].version, readonly=True)
+
+
+def confusion_counts(y_true, y_pred):
+    """Count (true, predicted) pairs of binary labels.
+
+        Returns
+        -------
+        counts : np.array of shape=(4,)
+            Counts of (0, 0), (0, 1), (1, 0) and (1, 1), i.e., a flattened
+            confusion matrix that can be summed over files.
+        """
+    return np.bincount(2 * np.asarray(y_true) + np.asarray(y_pred), minlength=4)
+
+
+def evaluate_file(path):
+    """Load and evaluate all statements of a single file.
+
+        Runs in a worker process initialized by _init_worker(), such that only
+        the statements of a single file are held in memory at once.
+
+        Parameters
+        ----------
+        path : string
+            Path of excel file containing statements.
+
+        Returns
+        -------
+        loose : np.array of shape=(4,)
+            Confusion counts of the non-strict (only overly permissive)
+            detection, see confusion_counts().
+
+        strict : np.array of shape=(4,)
+            Confusion counts of the strict detection.
+
+        elapsed : float
+            Time in seconds to load and evaluate file.
+
+        hits : int
+            Number of policy documents found in the verdict cache.
+
+        entries : dict()
+            Violations of policy documents that were not found in the verdict
+            cache, to be stored by the main process, see VerdictCache.put().
+        """
+    start  = time.perf_counter()
+    engine = _worker['engine']
+    data   = pd.read_excel(path)
+
+    # Evaluate all statements once and derive both verdicts
+    if _worker['cache'] is None:
+        statements = get_policies(data)
+        X, y       = preprocess_policies(statements, _worker['misconfigurations'], columnar=True)
+        y_pred_loose, y_pred_strict = engine.classify(X)
+        hits, entries = 0, dict()
+    else:
+        y, y_pred_loose, y_pred_strict, hits, entries = _evaluate_cached(data)
+
+    # Return counts
+    return (
+        confusion_counts(y, y_pred_loose ),
+        confusion_counts(y, y_pred_strict),
+        time.perf_counter() - start,
+        hits,
+        entries,
+    )
+
+
+def _evaluate_cached(data):
+    """Evaluate data, only parsing and evaluating uncached policy documents.
+
+        Returns
+        -------
+        y : np.array of shape=(n_subpolicies,)
+            Labels for each policy.
+
+        loose : np.array of shape=(n_subpolicies,)
+            Non-strict verdicts, see CloudCustodianCustomEngine.verdicts().
+
+        strict : np.array of shape=(n_subpolicies,)
+            Strict verdicts, see CloudCustodianCustomEngine.verdicts().
+
+        hits : int
+            Number of policy documents found in the verdict cache.
+
+        entries : dict()
+            Dictionary of fingerprint -> violations of uncached documents.
+        """
+    engine = _worker['engine']
+
+    # Fingerprint documents, later documents replace earlier ones as in get_policies()
+    documents = dict(zip(data['PolicyName'], data['PolicyObject']))
+    keys      = {name: fingerprint(name, policy) for name, policy in documents.items()}
+    cached    = _worker['cache'].get(keys.values())
+
+    # Parse and evaluate uncached documents only
+    statements = get_policies(data[data['PolicyName'].map(lambda name: keys[name] not in cached)])
+    X, _       = preprocess_policies(statements, ())
+    violations = iter(engine.evaluate(X))
+    entries    = {
+        keys[name]: [next(violations) for _ in policy]
+        for name, policy in statements.items()
+    }
+
+    # Combine violations of all documents
+    result = list()
+    y      = list()
+    for name in documents:
+        violations = cached.get(keys[name])
+        if violations is None:
+            violations = entries[keys[name]]
+        result.extend(violations)
+        y.extend([int(name in _worker['misconfigurations'])] * len(violations))
+
+    # Return result
+    loose, strict = engine.verdicts(result)
+    return np.asarray(y, dtype=int), loose, strict, len(documents) - len(entries), entries
+
+
+def counts_report(counts):
+    """Create a classification report from summed confusion counts."""
+    # Imported on first use, as importing scikit-learn is slow
+    from sklearn.metrics import classification_report
+
+    # Expand counts to one byte per statement rather than passing them as
+    # sample_weight, which would print the support as float
+    return classification_report(
+        y_true        = np.repeat(np.array([0, 0, 1, 1], dtype=np.int8), counts),
+        y_pred        = np.repeat(np.array([0, 1, 0, 1], dtype=np.int8), counts),
+        labels        = [0, 1],
+        target_names  = ["Correct", "Misconfiguration"],
+        digits        = 4,
+        zero_division = 0,
+    )
 
 
 if __name__ == "__main__":
@@ -242,49 +933,62 @@ if __name__ == "__main__":
 
     # Add arguments
     parser.add_argument("statements", nargs='+', help="File(s) containing statements.")
-    # parser.add_argument("rules"   , nargs='+', help="File(s) containing cloud custodian rules.")
+    parser.add_argument("--rules"   , nargs='+', help="File(s) containing cloud custodian rules, by default DEFAULT_RULES are used.")
+    parser.add_argument("--workers" , type=int, help="number of worker processes, by default the number of CPUs")
+    parser.add_argument("--cache"   , help="SQLite file caching violations of policy documents between runs")
 
     # Parse arguments
     args = parser.parse_args()
 
     ########################################################################
-    #                              Load data                               #
+    #                           Evaluate files                             #
     ########################################################################
 
-    # Set misconfigurations
-    misconfigurations = [
-        'AmazonS3FullAccess',
-        'AdministratorAccess',
-        'PowerUserAccess',
-        'DataScientist',
-        'AWS_ConfigRole',
-        'AWSCodeCommitPowerUser',
-    ]
-
-    X = list()
-    y = list()
-
-    # Load data for each input
-    for policy in args.statements:
-        data       = pd.read_excel(policy)
-        statements = get_policies(data)
-        X_, y_     = preprocess_policies(statements, misconfigurations)
-
-        # Add partial results
-        X.append(X_)
-        y.append(y_)
-
-    # Concatenate partial results
-    X = np.concatenate(X)
-    y = np.concatenate(y)
-
-    ########################################################################
-    #                      Load Cloud Custodian rules                      #
-    ########################################################################
+    # Sum of confusion counts over all files
+    counts_loose  = np.zeros(4, dtype=int)
+    counts_strict = np.zeros(4, dtype=int)
 
-    engine = CloudCustodianCustomEngine()
-    y_pred_loose  = engine.predict(X, strict=False)
-    y_pred_strict = engine.predict(X, strict=True )
+    # Open verdict cache, only written by this process
+    cache = None
+    if args.cache:
+        if args.rules:
+            rules = custodian_rules(load_policies_cloud_custodian(args.rules))
+        else:
+            rules = DEFAULT_RULES
+        cache = VerdictCache(args.cache, CloudCustodianCustomEngine(rules).version)
+    hits   = 0
+    misses = 0
+
+    # Load and evaluate files in worker processes, reporting each file once done
+    with metrics.stage('rules'), ProcessPoolExecutor(
+            max_workers = min(args.workers or os.cpu_count() or 1, len(args.statements)),
+            initializer = _init_worker,
+            initargs    = (args.rules, MISCONFIGURATIONS, args.cache),
+        ) as executor:
+        futures = {executor.submit(evaluate_file, path): path for path in args.statements}
+
+        for future in as_completed(futures):
+            loose, strict, elapsed, hits_, entries = future.result()
+            counts_loose  += loose
+            counts_strict += strict
+            metrics.rows(int(loose.sum()))
+            metrics.count('worker_seconds', elapsed)
+            print("{}: {} statements, {} overly permissive, {} misconfigured ({:.2f}s)".format(
+                futures[future], loose.sum(), loose[1::2].sum(), strict[1::2].sum(), elapsed,
+            ))
+
+            # Store violations of new and changed documents
+            if cache is not None:
+                cache.put(entries)
+                hits   += hits_
+                misses += len(entries)
+
+    # Report cache usage and remove entries of previous rules
+    if cache is not None:
+        print("Verdict cache: {} hits, {} misses ({:.1%} hit rate), {} outdated entries removed".format(
+            hits, misses, hits / max(hits + misses, 1), cache.prune(),
+        ))
+        cache.close()
 
     ########################################################################
     #                          Print performance                           #
@@ -294,21 +998,9 @@ if __name__ == "__main__":
     print()
     print("Performance - Only overly permissive detection")
     print("━"*60)
-    print(classification_report(
-        y_true        = y,
-        y_pred        = y_pred_loose,
-        target_names  = ["Correct", "Misconfiguration"],
-        digits        = 4,
-        zero_division = 0,
-    ))
+    print(counts_report(counts_loose))
 
     print()
     print("Performance - Strict detection")
     print("━"*60)
-    print(classification_report(
-        y_true        = y,
-        y_pred        = y_pred_strict,
-        target_names  = ["Correct", "Misconfiguration"],
-        digits        = 4,
-        zero_division = 0,
-    ))
+    print(counts_report(counts_strict))
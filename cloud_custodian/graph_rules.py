@@ -0,0 +1,185 @@
+import argformat
+import argparse
+import numpy  as np
+import os
+import pandas as pd
+import sys
+import time
+import warnings
+
+from cloud_custodian import (
+    CloudCustodianCustomEngine, DEFAULT_RULES, MISCONFIGURATIONS,
+    custodian_rules, load_policies_cloud_custodian,
+)
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_driver
+
+################################################################################
+#                                   Queries                                    #
+################################################################################
+
+# Distinct strings of the graph, rules are only compiled for these strings
+STRINGS_QUERY = """
+MATCH (a:Action)-[:WORKS_ON]->(r:Resource)
+RETURN
+    collect(DISTINCT a.name) AS actions,
+    collect(DISTINCT r.name) AS resources,
+    sum(CASE WHEN a.effect IS NULL THEN 1 ELSE 0 END) AS missing
+"""
+
+POLICIES_QUERY = """
+MATCH (p:Policy)
+RETURN collect(DISTINCT p.name) AS policies
+"""
+
+# Statements of which an action violates a check, starting from the index on action names
+ACTION_QUERY = """
+UNWIND $checks AS check
+MATCH (a:Action)
+WHERE a.name IN check.names
+  AND a.effect = check.effect
+  AND coalesce(a.condition, false) = check.condition
+MATCH (p:Policy)-[:CONTAINS]->(a)-[:WORKS_ON]->(r:Resource)
+WHERE r.name IN check.resources
+RETURN p.name AS policy, collect(DISTINCT check.actions[a.name]) AS violations
+"""
+
+# Statements of policies that violate a check, starting from the index on policy names
+POLICY_QUERY = """
+UNWIND $checks AS check
+MATCH (p:Policy)
+WHERE p.name IN check.policy_names
+MATCH (p)-[:CONTAINS]->(a:Action)-[:WORKS_ON]->(r:Resource)
+WHERE a.effect = check.effect
+  AND coalesce(a.condition, false) = check.condition
+  AND r.name IN check.resources
+RETURN p.name AS policy, collect(DISTINCT check.policies[p.name]) AS violations
+"""
+
+################################################################################
+#                                  Evaluation                                  #
+################################################################################
+
+def evaluate_graph(driver, engine):
+    """Evaluate the rules of engine on the policies in the graph database.
+
+        The rules are compiled into checks for the distinct actions and
+        resources in the graph, which are evaluated by two set-oriented
+        queries, such that statements are never transferred to the client.
+        Requires a graph loaded by data_loader/load_data.py, which stores the
+        effect and presence of a condition of each statement on its actions.
+
+        Parameters
+        ----------
+        driver : neo4j.GraphDatabase.driver
+            Driver for database connection.
+
+        engine : CloudCustodianCustomEngine
+            Engine containing rules to evaluate.
+
+        Returns
+        -------
+        result : pd.DataFrame
+            DataFrame with a 'policy', 'violations', 'overly_permissive' and
+            'misconfigured' column for each policy in the graph.
+        """
+    with driver.session(database="neo4j") as session:
+        # Retrieve distinct strings
+        strings  = session.run(STRINGS_QUERY).single()
+        policies = session.run(POLICIES_QUERY).single()['policies']
+        if strings['missing']:
+            warnings.warn(
+                "{} actions without effect, please reload the graph using "
+                "data_loader/load_data.py".format(strings['missing'])
+            )
+
+        # Compile rules into checks
+        checks = engine.checks(strings['actions'], strings['resources'], policies)
+        for check in checks:
+            check['names'       ] = list(check['actions' ])
+            check['policy_names'] = list(check['policies'])
+
+        # Evaluate checks
+        violations = {policy: set() for policy in policies}
+        for query in (ACTION_QUERY, POLICY_QUERY):
+            for record in session.run(query, checks=checks):
+                for names in record['violations']:
+                    violations[record['policy']].update(names)
+
+    # Return result
+    return pd.DataFrame({
+        'policy'           : list(violations),
+        'violations'       : [sorted(names) for names in violations.values()],
+        'overly_permissive': [not engine.overly_permissive.isdisjoint(names) for names in violations.values()],
+        'misconfigured'    : [bool(names) for names in violations.values()],
+    })
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Cloud Custodian checks evaluated in the graph database",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--rules"   , nargs='+', help="File(s) containing cloud custodian rules, by default DEFAULT_RULES are used.")
+    parser.add_argument("--output"  , help="CSV file to write the result of each policy to")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                            Evaluate graph                            #
+    ########################################################################
+
+    # Build engine from given rule files or fall back to default rules
+    if args.rules:
+        rules = custodian_rules(load_policies_cloud_custodian(args.rules))
+    else:
+        rules = DEFAULT_RULES
+    engine = CloudCustodianCustomEngine(rules)
+
+    # Evaluate rules in graph
+    start  = time.perf_counter()
+    driver = get_driver(args.uri, args.user, args.password, args.pool_size)
+    result = evaluate_graph(driver, engine)
+    print("Evaluated {} policies in {:.2f}s".format(result.shape[0], time.perf_counter() - start))
+
+    if args.output:
+        result.to_csv(args.output, index=False)
+
+    # Print flagged policies
+    for _, row in result[result['misconfigured']].iterrows():
+        print("{}: {}".format(row['policy'], ', '.join(row['violations'])))
+
+    ########################################################################
+    #                          Print performance                           #
+    ########################################################################
+
+    # Imported on first use, as importing scikit-learn is slow
+    from sklearn.metrics import classification_report
+
+    y = np.isin(result['policy'], MISCONFIGURATIONS).astype(int)
+
+    for title, column in (
+            ("Only overly permissive detection", 'overly_permissive'),
+            ("Strict detection"                , 'misconfigured'    ),
+        ):
+        print()
+        print("Performance (policies) - {}".format(title))
+        print("━"*60)
+        print(classification_report(
+            y_true        = y,
+            y_pred        = result[column].astype(int),
+            labels        = [0, 1],
+            target_names  = ["Correct", "Misconfiguration"],
+            digits        = 4,
+            zero_division = 0,
+        ))
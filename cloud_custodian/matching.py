@@ -0,0 +1,406 @@
+import argformat
+import argparse
+import fnmatch
+import functools
+import numpy as np
+import re
+import time
+
+################################################################################
+#                                 Pattern trie                                 #
+################################################################################
+
+# Runs of wildcards containing a "*"
+WILDCARDS = re.compile(r'[*?]*\*[*?]*')
+
+
+def normalize(pattern):
+    """Normalize a pattern for matching.
+
+        Lowercases the pattern and rewrites each run of wildcards containing a
+        "*" into its "?" wildcards followed by a single "*", e.g., "a*?*b"
+        becomes "a?*b". Both match the same strings.
+
+        Parameters
+        ----------
+        pattern : string
+            Pattern to normalize.
+
+        Returns
+        -------
+        result : string
+            Normalized pattern.
+        """
+    return WILDCARDS.sub(lambda run: '?' * run.group().count('?') + '*', pattern.lower())
+
+
+class _Node(object):
+    """Node of a PatternTrie.
+
+        Attributes
+        ----------
+        children : dict()
+            Dictionary of symbol -> child node, symbols are lowercase
+            characters or the wildcards "*" and "?".
+
+        values : set()
+            Values of patterns ending in this node.
+
+        loop : boolean
+            True if node is reached through a "*", i.e., it may consume any
+            number of characters.
+        """
+    __slots__ = ('children', 'values', 'loop')
+
+    def __init__(self, loop=False):
+        self.children = dict()
+        self.values   = set()
+        self.loop     = loop
+
+
+class PatternTrie(object):
+    """Case-insensitive trie of IAM patterns.
+
+        IAM patterns, i.e., actions and resources, may contain the wildcards
+        "*" (any sequence of characters) and "?" (any single character). The
+        trie stores patterns of rules and answers queries for a statement
+        pattern against all stored patterns at once, by traversing the trie
+        and the statement pattern simultaneously instead of comparing each
+        pair of patterns.
+
+        Parameters
+        ----------
+        patterns : iterable of (string, object), default=()
+            Patterns to add with their associated value.
+        """
+
+    def __init__(self, patterns=()):
+        self.root = _Node()
+        self.size = 0
+        for pattern, value in patterns:
+            self.add(pattern, value)
+
+    def __len__(self):
+        """Return number of stored patterns."""
+        return self.size
+
+    def add(self, pattern, value):
+        """Add a pattern with its associated value.
+
+            Parameters
+            ----------
+            pattern : string
+                Pattern to add, compared case-insensitively.
+
+            value : object
+                Value returned by queries matching pattern.
+            """
+        node = self.root
+        for symbol in normalize(pattern):
+            child = node.children.get(symbol)
+            if child is None:
+                child = node.children[symbol] = _Node(loop=symbol == '*')
+            node = child
+        node.values.add(value)
+        self.size += 1
+
+    def covered_by(self, pattern):
+        """Return values of all stored patterns covered by pattern.
+
+            A stored pattern is covered if every string it matches is also
+            matched by pattern, e.g., "ec2:*" covers "ec2:Run*" and
+            "ec2:RunInstances", but "ec2:Run*" does not cover "ec2:*".
+
+            Note
+            ----
+            Coverage is decided symbolically, where a "?" of pattern does not
+            match a "*" of a stored pattern. Therefore, coverage that depends
+            on the minimum length of a stored pattern, e.g., "?*" covering
+            "*b", is not reported. Reported coverage is always correct.
+
+            Parameters
+            ----------
+            pattern : string
+                Pattern of statement.
+
+            Returns
+            -------
+            values : set()
+                Values of covered patterns.
+            """
+        pattern = normalize(pattern)
+        end     = len(pattern)
+        result  = set()
+        stack   = [(0, self.root)]
+        visited = set()
+
+        while stack:
+            state = stack.pop()
+            if (state[0], id(state[1])) in visited:
+                continue
+            visited.add((state[0], id(state[1])))
+            i, node = state
+
+            # Pattern consumed, stored pattern ends here
+            if i == end:
+                result |= node.values
+                continue
+
+            symbol = pattern[i]
+            if symbol == '*':
+                # Match empty sequence or any symbol of stored patterns
+                stack.append((i + 1, node))
+                stack.extend((i, child) for child in node.children.values())
+            elif symbol == '?':
+                # Match any single character, but not a "*" of stored patterns
+                stack.extend(
+                    (i + 1, child) for symbol_, child in node.children.items()
+                    if symbol_ != '*'
+                )
+            else:
+                child = node.children.get(symbol)
+                if child is not None:
+                    stack.append((i + 1, child))
+
+        # Return result
+        return result
+
+    def overlapping(self, pattern):
+        """Return values of all stored patterns overlapping pattern.
+
+            Patterns overlap if there is at least one string matched by both,
+            e.g., "ec2:Run*" and "ec2:*Instances" overlap, as both match
+            "ec2:RunInstances". For a pattern without wildcards, this returns
+            the values of all stored patterns matching it.
+
+            Parameters
+            ----------
+            pattern : string
+                Pattern of statement.
+
+            Returns
+            -------
+            values : set()
+                Values of overlapping patterns.
+            """
+        pattern = normalize(pattern)
+        end     = len(pattern)
+        result  = set()
+        stack   = [(0, self.root)]
+        visited = set()
+
+        while stack:
+            state = stack.pop()
+            if (state[0], id(state[1])) in visited:
+                continue
+            visited.add((state[0], id(state[1])))
+            i, node = state
+
+            # Wildcards matching the empty sequence
+            if i < end and pattern[i] == '*':
+                stack.append((i + 1, node))
+            star = node.children.get('*')
+            if star is not None:
+                stack.append((i, star))
+
+            # Both patterns consumed
+            if i == end:
+                result |= node.values
+                continue
+
+            # Consume a single character by both patterns
+            symbol = pattern[i]
+            after  = i if symbol == '*' else i + 1
+            if symbol == '*' or symbol == '?':
+                stack.extend(
+                    (after, child) for symbol_, child in node.children.items()
+                    if symbol_ != '*'
+                )
+            else:
+                for symbol_ in (symbol, '?'):
+                    child = node.children.get(symbol_)
+                    if child is not None:
+                        stack.append((after, child))
+            # Stored pattern remains in its "*", unless both would remain
+            if node.loop and symbol != '*':
+                stack.append((after, node))
+
+        # Return result
+        return result
+
+################################################################################
+#                               Pairwise matching                              #
+################################################################################
+
+@functools.lru_cache(maxsize=2**16)
+def covers(pattern, target):
+    """Check whether pattern covers target, see PatternTrie.covered_by()."""
+    return bool(PatternTrie([(target, True)]).covered_by(pattern))
+
+
+@functools.lru_cache(maxsize=2**16)
+def overlaps(pattern, target):
+    """Check whether pattern overlaps target, see PatternTrie.overlapping()."""
+    return bool(PatternTrie([(target, True)]).overlapping(pattern))
+
+
+@functools.lru_cache(maxsize=2**16)
+def broad_resource(resource):
+    """Check whether a resource pattern grants access to all resources.
+
+        A resource is broad if it covers "*", or all resources of its service,
+        i.e., "arn:<partition>:<service>:::*" or
+        "arn:<partition>:<service>:*:*:*". For example "*", "arn:aws:s3:::*"
+        and "arn:*:ec2:*:*:*" are broad, "arn:aws:s3:::bucket/*" is not.
+
+        Parameters
+        ----------
+        resource : string
+            Resource of statement.
+
+        Returns
+        -------
+        result : boolean
+            True if resource is broad.
+        """
+    if covers(resource, '*'):
+        return True
+
+    # Use partition and service of resource, if given literally
+    parts     = resource.split(':', 5)
+    partition = parts[1] if len(parts) > 1 and '*' not in parts[1] and '?' not in parts[1] else 'aws'
+    service   = parts[2] if len(parts) > 2 and '*' not in parts[2] and '?' not in parts[2] else 'service'
+
+    # Return whether resource covers all resources of service
+    return covers(resource, 'arn:{}:{}:::*'     .format(partition, service)) or \
+           covers(resource, 'arn:{}:{}:*:*:*'   .format(partition, service))
+
+################################################################################
+#                                  Benchmark                                   #
+################################################################################
+
+# Services and verbs used to generate synthetic actions
+SERVICES = ['ec2', 's3', 'iam', 'lambda', 'kms', 'sts', 'rds', 'sns', 'sqs', 'logs']
+VERBS    = ['Get', 'Put', 'List', 'Describe', 'Create', 'Delete', 'Update', 'Run']
+
+
+def generate_patterns(n_patterns, wildcard_fraction=0.2, random_state=0):
+    """Generate synthetic IAM action patterns.
+
+        Parameters
+        ----------
+        n_patterns : int
+            Number of patterns to generate.
+
+        wildcard_fraction : float, default=0.2
+            Fraction of patterns containing a wildcard.
+
+        random_state : int, default=0
+            Seed for generating patterns.
+
+        Returns
+        -------
+        patterns : list of string
+            Generated patterns.
+        """
+    rng      = np.random.default_rng(random_state)
+    patterns = list()
+    for _ in range(n_patterns):
+        service = SERVICES[rng.integers(len(SERVICES))]
+        verb    = VERBS   [rng.integers(len(VERBS   ))]
+        action  = '{}:{}Resource{}'.format(service, verb, rng.integers(100))
+        if rng.random() < wildcard_fraction:
+            action = [
+                '{}:*'      .format(service),
+                '{}:{}*'    .format(service, verb),
+                '{}:*{}'    .format(service, action[-2:]),
+            ][rng.integers(3)]
+        patterns.append(action)
+    return patterns
+
+
+def benchmark(n_rules, n_statements, random_state=0):
+    """Compare the PatternTrie with naive pairwise fnmatch.
+
+        The naive approach only checks whether the statement pattern matches
+        each rule pattern as a string, which handles wildcards in statements
+        but not overlapping wildcards of rules.
+
+        Parameters
+        ----------
+        n_rules : int
+            Number of rule patterns.
+
+        n_statements : int
+            Number of statement patterns to query.
+
+        random_state : int, default=0
+            Seed for generating patterns.
+
+        Returns
+        -------
+        result : dict()
+            Build and query time of the trie, query time of fnmatch and the
+            number of (statement, rule) pairs found by each method.
+        """
+    rules      = generate_patterns(n_rules     , random_state=random_state)
+    statements = generate_patterns(n_statements, random_state=random_state + 1)
+
+    # Trie
+    start = time.perf_counter()
+    trie  = PatternTrie((rule, index) for index, rule in enumerate(rules))
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trie_covered = sum(len(trie.covered_by (statement)) for statement in statements)
+    trie_overlap = sum(len(trie.overlapping(statement)) for statement in statements)
+    trie_time    = time.perf_counter() - start
+
+    # Naive fnmatch
+    start = time.perf_counter()
+    naive = sum(
+        fnmatch.fnmatchcase(rule.lower(), statement.lower())
+        for statement in statements for rule in rules
+    )
+    naive_time = time.perf_counter() - start
+
+    # Return result
+    return {
+        'build_time'  : build_time,
+        'trie_time'   : trie_time,
+        'naive_time'  : naive_time,
+        'trie_covered': trie_covered,
+        'trie_overlap': trie_overlap,
+        'naive_pairs' : naive,
+    }
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Benchmark wildcard-aware matching against fnmatch",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--rules"     , nargs='+', type=int, default=[10, 100, 1000], help="numbers of rule patterns")
+    parser.add_argument("--statements", type=int, default=10000, help="number of statement patterns")
+    parser.add_argument("--seed"      , type=int, default=0, help="seed for generating patterns")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                              Benchmark                               #
+    ########################################################################
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "rules", "build", "trie", "fnmatch", "covered", "overlap", "fnmatch"))
+    for n_rules in args.rules:
+        result = benchmark(n_rules, args.statements, random_state=args.seed)
+        print("{:>8} {build_time:>9.3f}s {trie_time:>9.3f}s {naive_time:>9.3f}s "
+              "{trie_covered:>10} {trie_overlap:>10} {naive_pairs:>10}".format(
+                  n_rules, **result))
@@ -0,0 +1,170 @@
+import numpy  as np
+import pandas as pd
+
+class StatementTable(object):
+    """Compact columnar representation of statements.
+
+        All strings, i.e., policy names, effects, actions and resources, are
+        interned and stored as integer ids into a single vocabulary. Actions
+        and resources of statement i are given by ids[offsets[i]:offsets[i+1]]
+        of their respective columns. Values that are not strings are skipped,
+        as they never match a rule.
+
+        Attributes
+        ----------
+        strings : list of string
+            Vocabulary, strings[id] is the string of id.
+
+        policy : np.array of shape=(n_statements,)
+            Id of policy name of each statement.
+
+        effect : np.array of shape=(n_statements,)
+            Id of effect of each statement, -1 if not given as string.
+
+        condition : np.array of shape=(n_statements,)
+            True if statement contains a Condition.
+
+        action_offsets : np.array of shape=(n_statements + 1,)
+            Offsets of statements into action_ids.
+
+        action_ids : np.array of shape=(n_actions,)
+            Ids of actions of all statements.
+
+        resource_offsets : np.array of shape=(n_statements + 1,)
+            Offsets of statements into resource_ids.
+
+        resource_ids : np.array of shape=(n_resources,)
+            Ids of resources of all statements.
+        """
+
+    def __init__(self, strings, policy, effect, condition,
+                 action_offsets, action_ids, resource_offsets, resource_ids):
+        self.strings          = strings
+        self.policy           = policy
+        self.effect           = effect
+        self.condition        = condition
+        self.action_offsets   = action_offsets
+        self.action_ids       = action_ids
+        self.resource_offsets = resource_offsets
+        self.resource_ids     = resource_ids
+        self.index            = {string: id for id, string in enumerate(strings)}
+
+    @classmethod
+    def from_policies(cls, policies):
+        """Create table from policies.
+
+            Parameters
+            ----------
+            policies : dict()
+                Policies as returned by get_policies(data).
+
+            Returns
+            -------
+            table : StatementTable
+                Table containing all statements of policies.
+            """
+        # Initialise columns of raw strings
+        policy    = list()
+        effect    = list()
+        condition = list()
+        actions   = list()
+        resources = list()
+        action_offsets   = [0]
+        resource_offsets = [0]
+
+        # Loop over all statements
+        for name, statements in policies.items():
+            for statement in statements:
+                if not isinstance(statement, dict):
+                    continue
+                effect_ = statement.get('Effect')
+                policy   .append(name)
+                effect   .append(effect_ if isinstance(effect_, str) else None)
+                condition.append('Condition' in statement)
+
+                # Add list-valued fields
+                action = statement.get('Action')
+                if isinstance(action, str):
+                    actions.append(action)
+                elif isinstance(action, list):
+                    actions.extend([a for a in action if isinstance(a, str)])
+                action_offsets.append(len(actions))
+
+                resource = statement.get('Resource')
+                if isinstance(resource, str):
+                    resources.append(resource)
+                elif isinstance(resource, list):
+                    resources.extend([r for r in resource if isinstance(r, str)])
+                resource_offsets.append(len(resources))
+
+        # Intern all strings at once, missing effects are given id -1
+        ids, strings = pd.factorize(np.asarray(
+            policy + effect + actions + resources, dtype=object))
+        ids  = ids.astype(np.int32)
+        ends = np.cumsum([len(policy), len(effect), len(actions)])
+
+        # Return table
+        return cls(
+            strings          = strings.tolist(),
+            policy           = ids[:ends[0]],
+            effect           = ids[ends[0]:ends[1]],
+            condition        = np.asarray(condition       , dtype=bool    ),
+            action_offsets   = np.asarray(action_offsets  , dtype=np.int64),
+            action_ids       = ids[ends[1]:ends[2]],
+            resource_offsets = np.asarray(resource_offsets, dtype=np.int64),
+            resource_ids     = ids[ends[2]:],
+        )
+
+    def __len__(self):
+        """Return number of statements."""
+        return self.policy.shape[0]
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the columns, excluding the vocabulary."""
+        return sum(column.nbytes for column in (
+            self.policy, self.effect, self.condition,
+            self.action_offsets, self.action_ids,
+            self.resource_offsets, self.resource_ids,
+        ))
+
+    def id(self, string):
+        """Return id of string, or -1 if string does not occur."""
+        return self.index.get(string, -1)
+
+    def labels(self, names):
+        """Return label of each statement, 1 if its policy is in names.
+
+            Parameters
+            ----------
+            names : iterable of string
+                Names of policies labelled 1, e.g., misconfigurations.
+
+            Returns
+            -------
+            y : np.array of shape=(n_statements,)
+                Label of each statement.
+            """
+        ids = [self.index[name] for name in names if name in self.index]
+        return np.isin(self.policy, ids).astype(int)
+
+    @staticmethod
+    def any_segment(mask, offsets):
+        """Check for each segment whether any element of mask is set.
+
+            Parameters
+            ----------
+            mask : np.array of shape=(n_elements,)
+                Boolean value of each element, e.g., each action.
+
+            offsets : np.array of shape=(n_statements + 1,)
+                Offsets of segments into mask.
+
+            Returns
+            -------
+            result : np.array of shape=(n_statements,)
+                True if any element in segment is set, False for empty
+                segments.
+            """
+        counts = np.concatenate(([0], np.cumsum(mask, dtype=np.int64)))
+        return counts[offsets[1:]] > counts[offsets[:-1]]
@@ -0,0 +1,446 @@
+# Imports
+from datetime import datetime
+from hashlib  import sha256
+import argparse
+import json
+import os
+import pandas as pd
+import re
+import sqlite3
+import zlib
+
+################################################################################
+#                                   Settings                                   #
+################################################################################
+
+# Sheets of a snapshot and the columns identifying each row, as in update_data.compare_policies()
+SHEETS = {
+    'policies': ('PolicyName', 'PolicyId'),
+    'users'   : ('UserName'  , 'UserId'  ),
+    'groups'  : ('GroupName' , 'GroupId' ),
+    'roles'   : ('RoleName'  , 'RoleId'  ),
+}
+
+# Default location of history store
+DEFAULT_STORE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'output', 'history.sqlite')
+
+# Timestamp in file names written by retrieve_policydata.file_exporter()
+FILE_TIMESTAMP = re.compile(r'(\d{4}-\d{2}-\d{2})_(\d{2}:\d{2})')
+
+################################################################################
+#                                Snapshot files                                #
+################################################################################
+
+def file_timestamp(path):
+    """Return the time at which a snapshot file was collected.
+
+        Parameters
+        ----------
+        path : string
+            Path of snapshot file.
+
+        Returns
+        -------
+        timestamp : datetime
+            Time in the file name as written by the collector, or the
+            modification time of the file if its name contains no time.
+        """
+    match = FILE_TIMESTAMP.search(os.path.basename(path))
+    if match:
+        return datetime.fromisoformat('{} {}'.format(*match.groups()))
+    return datetime.fromtimestamp(os.path.getmtime(path)).replace(microsecond=0)
+
+
+def read_snapshot(path):
+    """Read the sheets of a snapshot file.
+
+        Parameters
+        ----------
+        path : string
+            Path of snapshot file.
+
+        Returns
+        -------
+        sheets : dict()
+            Dictionary of sheet name -> pd.DataFrame for each of SHEETS.
+        """
+    return pd.read_excel(path, sheet_name=list(SHEETS), index_col=0)
+
+
+def write_snapshot(sheets, path):
+    """Write sheets to a snapshot file in the format of the collector.
+
+        Parameters
+        ----------
+        sheets : dict()
+            Dictionary of sheet name -> pd.DataFrame.
+
+        path : string
+            Path of snapshot file to write.
+        """
+    with pd.ExcelWriter(path) as writer:
+        for sheet, frame in sheets.items():
+            frame.to_excel(writer, sheet_name=sheet)
+
+################################################################################
+#                                History store                                 #
+################################################################################
+
+def _encode(record):
+    """Encode a row as compressed JSON, returns its digest and data."""
+    data = json.dumps(record, sort_keys=True, default=str).encode('utf-8')
+    return sha256(data).hexdigest(), zlib.compress(data)
+
+
+def _decode(data):
+    """Decode a row encoded by _encode()."""
+    return json.loads(zlib.decompress(data))
+
+
+class HistoryStore(object):
+    """Delta-encoded history of snapshots.
+
+        The first snapshot is stored completely, each later snapshot only
+        stores the rows that were added or changed since the previous
+        snapshot, and a deletion marker for each removed row. Rows are
+        identified per sheet by their name and id, see SHEETS. Therefore,
+        storage grows with the number of changed rows instead of with the
+        number of snapshots.
+
+        A snapshot at time T is reconstructed by taking, for each row, its
+        latest version stored at or before T, see snapshot().
+
+        Parameters
+        ----------
+        path : string
+            Path of SQLite database file, created if it does not exist.
+        """
+
+    def __init__(self, path):
+        self.path       = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "    id        INTEGER PRIMARY KEY,"
+            "    timestamp TEXT    NOT NULL,"
+            "    source    TEXT,"
+            "    columns   TEXT    NOT NULL"
+            ")"
+        )
+        # Rows are clustered by key, such that versions of a row are adjacent
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            "    sheet    TEXT    NOT NULL,"
+            "    name     TEXT    NOT NULL,"
+            "    id       TEXT    NOT NULL,"
+            "    snapshot INTEGER NOT NULL,"
+            "    digest   TEXT,"
+            "    data     BLOB,"
+            "    PRIMARY KEY (sheet, name, id, snapshot)"
+            ") WITHOUT ROWID"
+        )
+        self.connection.commit()
+
+    ########################################################################
+    #                               Snapshots                              #
+    ########################################################################
+
+    def runs(self):
+        """List stored snapshots.
+
+            Returns
+            -------
+            runs : pd.DataFrame
+                DataFrame with the 'id', 'timestamp' and 'source' of each
+                snapshot and the number of 'changes' stored for it.
+            """
+        return pd.read_sql_query(
+            "SELECT s.id, s.timestamp, s.source, count(r.snapshot) AS changes "
+            "FROM snapshots s LEFT JOIN rows r ON r.snapshot = s.id "
+            "GROUP BY s.id ORDER BY s.id",
+            self.connection,
+        )
+
+    def resolve(self, at=None):
+        """Return the id of the snapshot at a given time.
+
+            Parameters
+            ----------
+            at : datetime or string, optional
+                Time, or ISO formatted time, e.g., '2021-03-26 14:11'. If
+                None, the latest snapshot is returned.
+
+            Returns
+            -------
+            snapshot : int
+                Id of latest snapshot stored at or before at.
+            """
+        if at is None:
+            at = datetime.max
+        elif isinstance(at, str):
+            at = datetime.fromisoformat(at)
+
+        snapshot, = self.connection.execute(
+            "SELECT max(id) FROM snapshots WHERE timestamp <= ?", (at.isoformat(sep=' '),)
+        ).fetchone()
+
+        if snapshot is None:
+            raise ValueError("No snapshot stored at or before {}, the history may have been compacted".format(at))
+
+        # Return result
+        return snapshot
+
+    def _state(self, sheet, snapshot, data=True):
+        """Return the latest version of each row of sheet at snapshot.
+
+            Returns a dictionary of (name, id) -> data if data is True, or
+            (name, id) -> digest otherwise, without deleted rows.
+            """
+        # SQLite returns the bare columns of the row for which max() is reached
+        cursor = self.connection.execute(
+            "SELECT name, id, {}, max(snapshot) FROM rows "
+            "WHERE sheet = ? AND snapshot <= ? GROUP BY name, id ORDER BY name, id".format(
+                'data' if data else 'digest'),
+            (sheet, snapshot),
+        )
+        return {(name, id): value for name, id, value, _ in cursor if value is not None}
+
+    def add(self, sheets, timestamp, source=None):
+        """Add a snapshot, storing only its differences with the latest snapshot.
+
+            Parameters
+            ----------
+            sheets : dict()
+                Dictionary of sheet name -> pd.DataFrame, see read_snapshot().
+
+            timestamp : datetime
+                Time of snapshot, must not precede the latest snapshot.
+
+            source : string, optional
+                Description of snapshot, e.g., its file name.
+
+            Returns
+            -------
+            changes : int
+                Number of added, changed or deleted rows.
+            """
+        latest = self.connection.execute(
+            "SELECT id, timestamp FROM snapshots ORDER BY id DESC LIMIT 1").fetchone()
+        if latest is not None and timestamp.isoformat(sep=' ') < latest[1]:
+            raise ValueError("Snapshot at {} precedes latest snapshot at {}".format(timestamp, latest[1]))
+
+        with self.connection:
+            snapshot = self.connection.execute(
+                "INSERT INTO snapshots (timestamp, source, columns) VALUES (?, ?, ?)",
+                (timestamp.isoformat(sep=' '), source, json.dumps({
+                    sheet: list(frame.columns) for sheet, frame in sheets.items()
+                })),
+            ).lastrowid
+
+            changes = list()
+            for sheet, frame in sheets.items():
+                name, id = SHEETS[sheet]
+                current  = self._state(sheet, latest[0], data=False) if latest is not None else dict()
+
+                # Added or changed rows
+                keys = set()
+                for record in frame.astype(object).where(frame.notna(), None).to_dict('records'):
+                    key = (str(record[name]), str(record[id]))
+                    digest, data = _encode(record)
+                    keys.add(key)
+                    if current.get(key) != digest:
+                        changes.append((sheet, *key, snapshot, digest, data))
+
+                # Deleted rows
+                for key in current.keys() - keys:
+                    changes.append((sheet, *key, snapshot, None, None))
+
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO rows (sheet, name, id, snapshot, digest, data) VALUES (?, ?, ?, ?, ?, ?)",
+                changes,
+            )
+
+        # Return result
+        return len(changes)
+
+    def add_file(self, path):
+        """Add a snapshot file, see add() and file_timestamp().
+
+            Parameters
+            ----------
+            path : string
+                Path of snapshot file.
+
+            Returns
+            -------
+            changes : int
+                Number of added, changed or deleted rows.
+            """
+        return self.add(read_snapshot(path), file_timestamp(path), source=os.path.basename(path))
+
+    def snapshot(self, at=None):
+        """Reconstruct the snapshot at a given time.
+
+            Parameters
+            ----------
+            at : datetime or string, optional
+                Time of snapshot, see resolve(). If None, the latest snapshot
+                is reconstructed.
+
+            Returns
+            -------
+            sheets : dict()
+                Dictionary of sheet name -> pd.DataFrame, with rows ordered
+                by name and id.
+            """
+        snapshot = self.resolve(at)
+        columns, = self.connection.execute(
+            "SELECT columns FROM snapshots WHERE id = ?", (snapshot,)).fetchone()
+
+        # Return result
+        return {
+            sheet: pd.DataFrame(
+                [_decode(data) for data in self._state(sheet, snapshot).values()],
+                columns = columns,
+            ) for sheet, columns in json.loads(columns).items()
+        }
+
+    def export(self, path, at=None):
+        """Write the snapshot at a given time to a file in the format of the
+            collector, such that it can be used by all other scripts.
+
+            Parameters
+            ----------
+            path : string
+                Path of snapshot file to write.
+
+            at : datetime or string, optional
+                Time of snapshot, see resolve().
+            """
+        write_snapshot(self.snapshot(at), path)
+
+    def row(self, sheet, name, at=None):
+        """Return a single row as it was at a given time, e.g., a policy.
+
+            Parameters
+            ----------
+            sheet : string
+                Sheet of row, see SHEETS.
+
+            name : string
+                Name of row, e.g., the PolicyName of a policy.
+
+            at : datetime or string, optional
+                Time, see resolve().
+
+            Returns
+            -------
+            row : dict() or None
+                Row at time at, None if it did not exist.
+            """
+        cursor = self.connection.execute(
+            "SELECT data, max(snapshot) FROM rows "
+            "WHERE sheet = ? AND name = ? AND snapshot <= ? GROUP BY id",
+            (sheet, name, self.resolve(at)),
+        )
+        for data, _ in cursor:
+            if data is not None:
+                return _decode(data)
+        return None
+
+    def compact(self, before):
+        """Merge all snapshots up to a given time into a single base snapshot.
+
+            Snapshots before the base can no longer be reconstructed, all
+            snapshots from the base onwards are unaffected.
+
+            Parameters
+            ----------
+            before : datetime or string
+                Time of base snapshot, see resolve().
+
+            Returns
+            -------
+            removed : int
+                Number of removed snapshots.
+            """
+        base = self.resolve(before)
+
+        with self.connection:
+            # Keep only the latest version of each row up to the base, and only if it exists
+            self.connection.execute(
+                "DELETE FROM rows WHERE snapshot <= ?1 AND (sheet, name, id, snapshot) NOT IN ("
+                "    SELECT sheet, name, id, max(snapshot) FROM rows WHERE snapshot <= ?1 GROUP BY sheet, name, id"
+                ")", (base,))
+            self.connection.execute("DELETE FROM rows WHERE snapshot <= ? AND data IS NULL", (base,))
+            self.connection.execute("UPDATE rows SET snapshot = ?1 WHERE snapshot < ?1", (base,))
+            removed = self.connection.execute("DELETE FROM snapshots WHERE id < ?", (base,)).rowcount
+
+        self.connection.execute("VACUUM")
+
+        # Return result
+        return removed
+
+    def close(self):
+        """Close the store."""
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser, only the standard library argparse is used to keep the requirements of the collector minimal
+    parser = argparse.ArgumentParser(description="Store snapshots as deltas and reconstruct them at any time")
+    parser.add_argument("--store", default=DEFAULT_STORE, help="path of history store (default: output/history.sqlite)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # Add commands
+    add = commands.add_parser("add", help="add snapshot files in chronological order")
+    add.add_argument("files", nargs='+', help="snapshot files to add")
+    add.add_argument("--remove", action='store_true', help="remove snapshot files once added")
+
+    commands.add_parser("list", help="list stored snapshots")
+
+    export = commands.add_parser("export", help="reconstruct the snapshot at a given time")
+    export.add_argument("output", help="snapshot file to write")
+    export.add_argument("--at", help="time of snapshot, e.g., '2021-03-26 14:11' (default: latest)")
+
+    show = commands.add_parser("show", help="show a single row at a given time")
+    show.add_argument("sheet", choices=list(SHEETS), help="sheet of row")
+    show.add_argument("name", help="name of row, e.g., the name of a policy")
+    show.add_argument("--at", help="time of row, e.g., '2021-03-26 14:11' (default: latest)")
+
+    compact = commands.add_parser("compact", help="merge all snapshots up to a given time into a single base snapshot")
+    compact.add_argument("before", help="time of base snapshot, e.g., '2021-03-26 14:11'")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                             Run command                              #
+    ########################################################################
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.store)), exist_ok=True)
+    store = HistoryStore(args.store)
+
+    if args.command == "add":
+        for path in sorted(args.files, key=file_timestamp):
+            print("{}: {} changes".format(path, store.add_file(path)))
+            if args.remove:
+                os.remove(path)
+
+    elif args.command == "list":
+        print(store.runs().to_string(index=False))
+
+    elif args.command == "export":
+        store.export(args.output, args.at)
+
+    elif args.command == "show":
+        print(json.dumps(store.row(args.sheet, args.name, args.at), indent=4))
+
+    elif args.command == "compact":
+        print("Removed {} snapshots".format(store.compact(args.before)))
+
+    store.close()
@@ -1,5 +1,7 @@
 # Imports
 from hashlib import sha256
+from history import DEFAULT_STORE, HistoryStore
+import argparse
 import json
 import os
 import pandas as pd
@@ -7,18 +9,26 @@ import subprocess
 import sys
 import time
 
+# Shared instrumentation layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import metrics
+
 ################################################################################
 #                                Data retrieval                                #
 ################################################################################
 
+def aws(command):
+    """Run an aws command line tool command and return its JSON output."""
+    metrics.aws_call()
+    return json.loads(subprocess.check_output(command, shell=True))
+
+
+@metrics.timed('collect.policies')
 def retrieve_iam_policies():
     """Retrieve IAM policies using aws iam command line tool."""
 
     # Run command to list all the IAM policies in the environment
-    policies = subprocess.check_output('aws iam list-policies', shell=True)
-
-    # Gather policies as json data
-    json_policies = json.loads(policies)
+    json_policies = aws('aws iam list-policies')
 
     # Load the IAM policies into a pandas dataframe
     df_policies = pd.json_normalize(json_policies['Policies'])
@@ -30,10 +40,8 @@ def retrieve_iam_policies():
 
     # Loop through the list of collected policy names and retrieve the actual policy document
     for index, row in df_policies.iterrows():
-        policy_object = subprocess.check_output(
-            'aws iam get-policy-version --policy-arn ' + row.Arn + ' --version-id ' + row.DefaultVersionId,
-            shell=True)
-        json_policy_object = json.loads(policy_object)
+        json_policy_object = aws(
+            'aws iam get-policy-version --policy-arn ' + row.Arn + ' --version-id ' + row.DefaultVersionId)
         policy_statement = json_policy_object['PolicyVersion']['Document']['Statement']
 
         # Check whether the policy object fits in an excel cell, if not split it.
@@ -45,25 +53,23 @@ def retrieve_iam_policies():
         df_policies.at[index, 'PolicyObject'] = policy_statement
 
     # Return collected policies
+    metrics.rows(df_policies.shape[0])
     return df_policies
 
 
 # Retrieve all the users and the policies that are attached to them in the environment
+@metrics.timed('collect.users')
 def retrieve_users():
     """Retrieve IAM users using aws iam command line tool."""
     # Run command to retrieve all the users in the environment
-    users = subprocess.check_output('aws iam list-users', shell=True)
-
-    # Gather users as json data
-    json_users = json.loads(users)
+    json_users = aws('aws iam list-users')
 
     # Create a new dataframe to hold the users and retrieve the attached policies
     df_users = pd.json_normalize(json_users['Users'])
     df_users['AttachedPolicies'] = '-'
 
     for index, row in df_users.iterrows():
-        attached_user_policies = json.loads(
-            subprocess.check_output('aws iam list-attached-user-policies --user-name ' + row.UserName, shell=True))
+        attached_user_policies = aws('aws iam list-attached-user-policies --user-name ' + row.UserName)
         df_users.at[index, 'AttachedPolicies'] = attached_user_policies['AttachedPolicies']
 
         # Cryptographically hash identifiable data for some level of anonymization
@@ -72,12 +78,14 @@ def retrieve_users():
         df_users.at[index, 'Arn'] = sha256(row.Arn.encode('utf-8')).hexdigest()
 
     # Return collected users
+    metrics.rows(df_users.shape[0])
     return df_users
 
 
 # Run a CLI command to retrieve all the groups in the environment and the attached policies
+@metrics.timed('collect.groups')
 def retrieve_groups():
-    json_groups = json.loads(subprocess.check_output('aws iam list-groups', shell=True))
+    json_groups = aws('aws iam list-groups')
 
     # Create a new dataframe to hold the group data, attached policies, and the users that are part of the group
     df_groups = pd.json_normalize(json_groups['Groups'])
@@ -87,15 +95,11 @@ def retrieve_groups():
     for index, row in df_groups.iterrows():
 
         # Retrieve the attached policies to the group
-        attached_group_policies = json.loads(
-            subprocess.check_output('aws iam list-attached-group-policies --group-name ' + row.GroupName,
-                                    shell=True))
+        attached_group_policies = aws('aws iam list-attached-group-policies --group-name ' + row.GroupName)
 
         # Retrieve the users that are part of the group
         df_groups.at[index, 'AttachedPolicies'] = attached_group_policies['AttachedPolicies']
-        users_in_group = \
-            json.loads(subprocess.check_output('aws iam get-group --group-name ' + row.GroupName, shell=True))[
-                'Users']
+        users_in_group = aws('aws iam get-group --group-name ' + row.GroupName)['Users']
 
         # Cryptographically hash the users in the group for anonymization
         anonymized_users = []
@@ -114,20 +118,21 @@ def retrieve_groups():
         df_groups.at[index, 'GroupId'] = sha256(row.GroupId.encode('utf-8')).hexdigest()
         df_groups.at[index, 'Arn'] = sha256(row.Arn.encode('utf-8')).hexdigest()
 
+    metrics.rows(df_groups.shape[0])
     return df_groups
 
 
 # Run a CLI command to retrieve all the roles in the environment and the attached policies
+@metrics.timed('collect.roles')
 def retrieve_roles():
-    json_roles = json.loads(subprocess.check_output('aws iam list-roles', shell=True))
+    json_roles = aws('aws iam list-roles')
 
     df_roles = pd.json_normalize(json_roles['Roles'])
     df_roles['AttachedPolicies'] = '-'
 
     for index, row in df_roles.iterrows():
         # Retrieve the attached role policies
-        attached_roles_policies = json.loads(
-            subprocess.check_output('aws iam list-attached-role-policies --role-name ' + row.RoleName, shell=True))
+        attached_roles_policies = aws('aws iam list-attached-role-policies --role-name ' + row.RoleName)
         df_roles.at[index, 'AttachedPolicies'] = attached_roles_policies['AttachedPolicies']
 
         # Cryptographically hash identifiable data for some level of anonymization
@@ -135,6 +140,7 @@ def retrieve_roles():
         df_roles.at[index, 'RoleId'] = sha256(row.RoleId.encode('utf-8')).hexdigest()
         df_roles.at[index, 'Arn'] = sha256(row.Arn.encode('utf-8')).hexdigest()
 
+    metrics.rows(df_roles.shape[0])
     return df_roles
 
 
@@ -147,7 +153,7 @@ def file_exporter(policies, users, groups, roles):
         os.mkdir(absolute_dir_path + outdir)
 
     # Write data to excel file.
-    with pd.ExcelWriter(
+    path = (
             absolute_dir_path +
             outdir +
             '/iam_policy_data_' +
@@ -155,14 +161,18 @@ def file_exporter(policies, users, groups, roles):
             '_' +
             time.strftime("%H:%M")
             + '.xlsx'
-        ) as writer:
+    )
+    with pd.ExcelWriter(path) as writer:
         policies.to_excel(writer, sheet_name="policies")
         users   .to_excel(writer, sheet_name="users")
         groups  .to_excel(writer, sheet_name="groups")
         roles   .to_excel(writer, sheet_name="roles")
 
+    return path
+
 
 # Simple method to bundle the data collection methods and return the needed dataframes
+@metrics.timed('collect')
 def collect_data():
     # Collect policy data
     print('Collecting policy data...')
@@ -188,10 +198,10 @@ def collect_data():
     print('Finished role retrieval')
 
     # Export retrieved data to output file
-    file_exporter(policies, users, groups, roles)
+    return file_exporter(policies, users, groups, roles)
 
 
-def timer(hours):
+def timer(hours, history=None):
     """Perform a multiple rounds of data collection every given hours.
 
         Parameters
@@ -199,9 +209,12 @@ def timer(hours):
         hours : int
             Interval in hours, each interval will collect data via the
             collect_single() method.
+
+        history : string, optional
+            Path of history store, see collect_single().
         """
     while True:
-        collect_single()
+        collect_single(history)
         print('--------------------------------------------------')
         print('Next collection in ' + hours + ' hours')
         print('Do not terminate this program')
@@ -211,29 +224,48 @@ def timer(hours):
         time.sleep(int(hours) * 3600)
 
 
-def collect_single():
+def collect_single(history=None):
     """Perform a single round of data collection.
 
         Output will be saved in the ./output directory.
+
+        Parameters
+        ----------
+        history : string, optional
+            If given, the output is added to the history store at this path
+            instead, see history.py.
         """
     print('Data retrieval in progress....')
-    collect_data()
+    path = collect_data()
     print('--------------------------------------------------')
     print('Data retrieval successful')
-    print('CSV file saved in:')
-    print(os.getcwd() + '/output')
+
+    if history is not None:
+        store = HistoryStore(history)
+        print('Stored {} changes in: {}'.format(store.add_file(path), history))
+        store.close()
+        os.remove(path)
+    else:
+        print('CSV file saved in:')
+        print(os.path.dirname(path))
 
 
 if __name__ == '__main__':
+    # Parse arguments, only the standard library argparse is used to keep the requirements of the collector minimal
+    parser = argparse.ArgumentParser(description="Retrieve IAM policies and their attached entities from the AWS environment")
+    parser.add_argument("hours", nargs='?', help="if given, repeat the data collection every given number of hours")
+    parser.add_argument("--history", nargs='?', const=DEFAULT_STORE, help="add each snapshot to a history store instead of keeping its xlsx file (default: output/history.sqlite)")
+    args = parser.parse_args()
+
     print('--------------------------------------------------')
     print(' Starting data retrieval from the AWS environment ')
     print('--------------------------------------------------')
 
     # If an argument is passed for the frequency start the timer, otherwise 'single shot collection
-    if len(sys.argv) == 2:
-        timer(sys.argv[1])
+    if args.hours is not None:
+        timer(args.hours, args.history)
 
     else:
-        collect_single()
+        collect_single(args.history)
 
     print('--------------------------------------------------')
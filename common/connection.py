@@ -0,0 +1,170 @@
+import atexit
+import functools
+import metrics
+import os
+
+################################################################################
+#                                   Settings                                   #
+################################################################################
+
+# Default connection settings, overridden by the environment variables below
+DEFAULTS = {
+    'uri'      : "bolt://localhost:7687",
+    'user'     : "neo4j",
+    'password' : "password",
+    'pool_size': 16,
+}
+
+ENVIRONMENT = {
+    'uri'      : 'NEO4J_URI',
+    'user'     : 'NEO4J_USER',
+    'password' : 'NEO4J_PASSWORD',
+    'pool_size': 'NEO4J_POOL_SIZE',
+}
+
+
+def settings(uri=None, user=None, password=None, pool_size=None):
+    """Resolve connection settings.
+
+        Each setting is taken from the given argument, or from its environment
+        variable (NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD or NEO4J_POOL_SIZE),
+        or from DEFAULTS, in that order.
+
+        Parameters
+        ----------
+        uri : string, optional
+            Neo4j database URI.
+
+        user : string, optional
+            Neo4j user.
+
+        password : string, optional
+            Neo4j password.
+
+        pool_size : int, optional
+            Maximum number of pooled connections.
+
+        Returns
+        -------
+        settings : dict()
+            Dictionary containing 'uri', 'user', 'password' and 'pool_size'.
+        """
+    result = dict()
+    for key, value in (('uri', uri), ('user', user), ('password', password), ('pool_size', pool_size)):
+        if value is None:
+            value = os.environ.get(ENVIRONMENT[key], DEFAULTS[key])
+        result[key] = value
+    result['pool_size'] = int(result['pool_size'])
+
+    # Return result
+    return result
+
+
+def add_arguments(parser):
+    """Add --uri, --user, --password and --pool-size arguments to parser.
+
+        Arguments that are not given are resolved by settings(), such that
+        they can be configured using environment variables.
+
+        Parameters
+        ----------
+        parser : argparse.ArgumentParser
+            Parser to which to add arguments.
+        """
+    parser.add_argument("--uri"      , help="Neo4j database URI (default: $NEO4J_URI or {})".format(DEFAULTS['uri']))
+    parser.add_argument("--user"     , help="Neo4j user (default: $NEO4J_USER or {})".format(DEFAULTS['user']))
+    parser.add_argument("--password" , help="Neo4j password (default: $NEO4J_PASSWORD or {})".format(DEFAULTS['password']))
+    parser.add_argument("--pool-size", type=int, help="maximum number of pooled connections (default: $NEO4J_POOL_SIZE or {})".format(DEFAULTS['pool_size']))
+
+################################################################################
+#                                 Connections                                  #
+################################################################################
+
+@functools.lru_cache(maxsize=None)
+def _driver(uri, user, password, pool_size):
+    """Create a pooled neo4j driver, closed when the interpreter exits."""
+    from neo4j import GraphDatabase
+    metrics.instrument_neo4j()
+    driver = GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=pool_size)
+    atexit.register(driver.close)
+    return driver
+
+
+@functools.lru_cache(maxsize=None)
+def _graph(uri, user, password, pool_size):
+    """Create a pooled py2neo graph."""
+    from py2neo import Graph
+    metrics.instrument_py2neo()
+    return Graph(uri, user=user, password=password, max_size=pool_size)
+
+
+def get_driver(uri=None, user=None, password=None, pool_size=None):
+    """Return the shared neo4j driver for the given settings.
+
+        Drivers are created once per process and setting, such that all
+        sessions reuse the connections of a single pool. Shared drivers are
+        closed when the interpreter exits and must not be closed by callers.
+
+        Parameters
+        ----------
+        uri : string, optional
+            Neo4j database URI, see settings().
+
+        user : string, optional
+            Neo4j user, see settings().
+
+        password : string, optional
+            Neo4j password, see settings().
+
+        pool_size : int, optional
+            Maximum number of pooled connections, see settings().
+
+        Returns
+        -------
+        driver : neo4j.Driver
+            Shared driver.
+        """
+    config = settings(uri, user, password, pool_size)
+    return _driver(config['uri'], config['user'], config['password'], config['pool_size'])
+
+
+def get_graph(uri=None, user=None, password=None, pool_size=None):
+    """Return the shared py2neo graph for the given settings, see get_driver()."""
+    config = settings(uri, user, password, pool_size)
+    return _graph(config['uri'], config['user'], config['password'], config['pool_size'])
+
+
+def get_async_driver(uri=None, user=None, password=None, pool_size=None):
+    """Create an asyncio neo4j driver for the given settings.
+
+        Asyncio drivers are bound to the event loop in which they are used
+        and are therefore not shared, callers must close them using
+        ``await driver.close()``.
+
+        Parameters
+        ----------
+        uri : string, optional
+            Neo4j database URI, see settings().
+
+        user : string, optional
+            Neo4j user, see settings().
+
+        password : string, optional
+            Neo4j password, see settings().
+
+        pool_size : int, optional
+            Maximum number of pooled connections, see settings().
+
+        Returns
+        -------
+        driver : neo4j.AsyncDriver
+            Asyncio driver.
+        """
+    from neo4j import AsyncGraphDatabase
+    metrics.instrument_neo4j()
+    config = settings(uri, user, password, pool_size)
+    return AsyncGraphDatabase.driver(
+        config['uri'],
+        auth                     = (config['user'], config['password']),
+        max_connection_pool_size = config['pool_size'],
+    )
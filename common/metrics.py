@@ -0,0 +1,519 @@
+import atexit
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # pragma: no cover, not available on Windows
+    resource = None
+
+################################################################################
+#                                  Settings                                    #
+################################################################################
+
+# Metrics are enabled by setting any of the following environment variables
+JSON_PATH       = os.environ.get('MISDET_METRICS_JSON')
+PROMETHEUS_PATH = os.environ.get('MISDET_METRICS_PROM')
+PROFILE_PATH    = os.environ.get('MISDET_PROFILE')
+
+ENABLED   = bool(os.environ.get('MISDET_METRICS') or JSON_PATH or PROMETHEUS_PATH)
+PROFILING = bool(PROFILE_PATH)
+
+# Counters reported for each stage
+COUNTERS = ('rows', 'aws_calls', 'cypher_queries', 'cypher_server_seconds', 'cypher_client_seconds')
+
+
+def enable(profiling=False):
+    """Enable recording of metrics, and optionally sampling profiles."""
+    global ENABLED, PROFILING
+    ENABLED   = True
+    PROFILING = PROFILING or profiling
+
+
+def disable():
+    """Disable recording of metrics and sampling profiles."""
+    global ENABLED, PROFILING
+    ENABLED   = False
+    PROFILING = False
+
+################################################################################
+#                                   Registry                                   #
+################################################################################
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, 0 if unknown."""
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class StageMetrics(object):
+    """Aggregated metrics of all runs of a stage.
+
+        Attributes
+        ----------
+        runs : int
+            Number of times the stage was run.
+
+        wall : float
+            Total wall time in seconds.
+
+        cpu : float
+            Total CPU time of the process in seconds, including other threads
+            running concurrently.
+
+        peak_rss : int
+            Peak resident set size of the process in bytes at the end of the
+            stage.
+
+        counters : dict()
+            Dictionary of counter -> value, e.g., 'rows' or 'cypher_queries',
+            including the counts of nested stages.
+        """
+
+    def __init__(self):
+        self.runs     = 0
+        self.wall     = 0.
+        self.cpu      = 0.
+        self.peak_rss = 0
+        self.counters = collections.defaultdict(int)
+
+    def to_dict(self):
+        """Return metrics as a JSON serializable dictionary."""
+        return dict({
+            'runs'    : self.runs,
+            'wall'    : self.wall,
+            'cpu'     : self.cpu,
+            'peak_rss': self.peak_rss,
+        }, **{counter: self.counters.get(counter, 0) for counter in COUNTERS},
+           **{counter: value for counter, value in self.counters.items() if counter not in COUNTERS})
+
+
+_lock     = threading.Lock()
+_local    = threading.local()
+_stages   = collections.OrderedDict()
+_totals   = collections.defaultdict(int)
+_profiles = collections.defaultdict(collections.Counter)
+_started  = time.time()
+
+
+def _stack():
+    """Return the stack of active stages of the current thread."""
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = list()
+    return stack
+
+
+def count(name, value=1):
+    """Add value to a counter of all active stages of the current thread.
+
+        Parameters
+        ----------
+        name : string
+            Name of counter, e.g., 'rows', see COUNTERS.
+
+        value : float, default=1
+            Value to add.
+        """
+    if not ENABLED:
+        return
+    with _lock:
+        _totals[name] += value
+        for stage in _stack():
+            _stages[stage].counters[name] += value
+
+
+def rows(n):
+    """Count n processed rows, see count()."""
+    if ENABLED:
+        count('rows', n)
+
+
+def aws_call():
+    """Count a single AWS call, see count()."""
+    if ENABLED:
+        count('aws_calls')
+
+
+def query(server_seconds=None, client_seconds=None):
+    """Count a single Cypher query with its server and client time, see count()."""
+    if not ENABLED:
+        return
+    count('cypher_queries')
+    if server_seconds is not None:
+        count('cypher_server_seconds', server_seconds)
+    if client_seconds is not None:
+        count('cypher_client_seconds', client_seconds)
+
+################################################################################
+#                                    Stages                                    #
+################################################################################
+
+class _NullContext(object):
+    """Context that does nothing, returned when metrics are disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL = _NullContext()
+
+
+class _Stage(object):
+    """Context recording the metrics of a stage, see stage()."""
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        with _lock:
+            if self.name not in _stages:
+                _stages[self.name] = StageMetrics()
+        _stack().append(self.name)
+        self.wall = time.perf_counter()
+        self.cpu  = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self.wall
+        cpu  = time.process_time()  - self.cpu
+        _stack().pop()
+        with _lock:
+            metrics = _stages[self.name]
+            metrics.runs    += 1
+            metrics.wall    += wall
+            metrics.cpu     += cpu
+            metrics.peak_rss = max(metrics.peak_rss, peak_rss())
+        return False
+
+
+def stage(name):
+    """Return a context recording the metrics of a stage.
+
+        Stages may be nested, the counters of a nested stage are also added
+        to all enclosing stages of the same thread. When metrics are
+        disabled, returns a context that does nothing.
+
+        Parameters
+        ----------
+        name : string
+            Name of stage, e.g., 'load.actions'.
+
+        Returns
+        -------
+        context : object
+            Context manager recording the stage.
+        """
+    return _Stage(name) if ENABLED else NULL
+
+
+def timed(name):
+    """Decorator recording each call of a function as stage name, see stage()."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+################################################################################
+#                                  Profiling                                   #
+################################################################################
+
+class _Sampler(object):
+    """Context sampling the stack of the current thread, see sample()."""
+
+    def __init__(self, name, interval):
+        self.name     = name
+        self.interval = interval
+        self.thread   = threading.get_ident()
+        self.stopped  = threading.Event()
+        self.samples  = collections.Counter()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}:{}'.format(
+                    os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.sampler = threading.Thread(target=self._run, daemon=True)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.sampler.join()
+        with _lock:
+            _profiles[self.name].update(self.samples)
+        return False
+
+
+def sample(name, interval=0.005):
+    """Return a context sampling the stack of the current thread.
+
+        Intended for hot loops, a background thread records the stack of the
+        current thread every interval seconds. Samples are exported as folded
+        stacks, see write_profile(). When profiling is disabled, i.e.,
+        MISDET_PROFILE is not set and enable(profiling=True) was not called,
+        returns a context that does nothing.
+
+        Parameters
+        ----------
+        name : string
+            Name of profiled section.
+
+        interval : float, default=0.005
+            Sampling interval in seconds.
+
+        Returns
+        -------
+        context : object
+            Context manager sampling the section.
+        """
+    return _Sampler(name, interval) if PROFILING else NULL
+
+################################################################################
+#                                 Instrumenting                                #
+################################################################################
+
+def _wrap_run(run):
+    """Wrap a neo4j run method to count queries."""
+    @functools.wraps(run)
+    def wrapper(*args, **kwargs):
+        query()
+        return run(*args, **kwargs)
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _wrap_consume(consume, asynchronous):
+    """Wrap a neo4j consume method to record the server time of its result."""
+    def record(summary):
+        server = (summary.result_available_after or 0) + (summary.result_consumed_after or 0)
+        count('cypher_server_seconds', server / 1000)
+
+    if asynchronous:
+        @functools.wraps(consume)
+        async def wrapper(*args, **kwargs):
+            summary = await consume(*args, **kwargs)
+            record(summary)
+            return summary
+    else:
+        @functools.wraps(consume)
+        def wrapper(*args, **kwargs):
+            summary = consume(*args, **kwargs)
+            record(summary)
+            return summary
+    wrapper._instrumented = True
+    return wrapper
+
+
+def instrument_neo4j():
+    """Count the Cypher queries issued through the neo4j driver.
+
+        Server time is recorded for results that are consumed, i.e., for
+        which result.consume() is called. Does nothing if metrics are
+        disabled or the driver is already instrumented.
+        """
+    if not ENABLED:
+        return
+    import neo4j
+    with _lock:
+        for name in ('Session', 'Transaction', 'ManagedTransaction',
+                     'AsyncSession', 'AsyncTransaction', 'AsyncManagedTransaction'):
+            cls = getattr(neo4j, name, None)
+            if cls is not None and not getattr(cls.run, '_instrumented', False):
+                cls.run = _wrap_run(cls.run)
+        for name, asynchronous in (('Result', False), ('AsyncResult', True)):
+            cls = getattr(neo4j, name, None)
+            if cls is not None and not getattr(cls.consume, '_instrumented', False):
+                cls.consume = _wrap_consume(cls.consume, asynchronous)
+
+
+def instrument_py2neo():
+    """Count the Cypher queries issued through py2neo with their server time.
+
+        Server time is taken from the t_first and t_last metadata of the
+        result, as far as received when the query returns. Does nothing if
+        metrics are disabled or py2neo is already instrumented.
+        """
+    if not ENABLED:
+        return
+    from py2neo import Transaction
+    with _lock:
+        if getattr(Transaction.run, '_instrumented', False):
+            return
+        run = Transaction.run
+
+        @functools.wraps(run)
+        def wrapper(*args, **kwargs):
+            start   = time.perf_counter()
+            cursor  = run(*args, **kwargs)
+            summary = cursor.summary()
+            query(
+                server_seconds = (summary.get('t_first', 0) + summary.get('t_last', 0)) / 1000,
+                client_seconds = time.perf_counter() - start,
+            )
+            return cursor
+
+        wrapper._instrumented = True
+        Transaction.run = wrapper
+
+################################################################################
+#                                    Export                                    #
+################################################################################
+
+def report():
+    """Return the metrics of this run.
+
+        Returns
+        -------
+        report : dict()
+            JSON serializable dictionary containing the 'started' and
+            'finished' timestamps, the 'argv', 'pid' and 'peak_rss' of the
+            process, the 'totals' of all counters, the metrics of each stage
+            in 'stages' and the 20 most frequent stacks of each profiled
+            section in 'profiles'.
+        """
+    with _lock:
+        return {
+            'started' : _started,
+            'finished': time.time(),
+            'argv'    : sys.argv,
+            'pid'     : os.getpid(),
+            'peak_rss': peak_rss(),
+            'totals'  : dict(_totals),
+            'stages'  : {name: metrics.to_dict() for name, metrics in _stages.items()},
+            'profiles': {
+                name: [{'stack': stack, 'samples': n} for stack, n in samples.most_common(20)]
+                for name, samples in _profiles.items()
+            },
+        }
+
+
+def _atomic_write(path, text):
+    """Write text to path, such that readers never observe a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w') as outfile:
+        outfile.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def write_json(path):
+    """Write the report() of this run as JSON to path."""
+    _atomic_write(path, json.dumps(report(), indent=2, default=str))
+
+
+def _escape(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_prometheus(path, prefix='misdet'):
+    """Write the metrics of this run to path in the Prometheus textfile format.
+
+        The file is intended for the textfile collector of the node exporter
+        and is replaced atomically.
+
+        Parameters
+        ----------
+        path : string
+            Path of .prom file.
+
+        prefix : string, default='misdet'
+            Prefix of all metric names.
+        """
+    result  = report()
+    metrics = [
+        ('stage_runs_total'               , 'runs'    , 'counter', "Number of runs of stage."),
+        ('stage_wall_seconds_total'       , 'wall'    , 'counter', "Wall time of stage in seconds."),
+        ('stage_cpu_seconds_total'        , 'cpu'     , 'counter', "CPU time of process during stage in seconds."),
+        ('stage_peak_rss_bytes'           , 'peak_rss', 'gauge'  , "Peak resident set size of process after stage in bytes."),
+        ('stage_rows_total'               , 'rows'    , 'counter', "Rows processed by stage."),
+        ('stage_aws_calls_total'          , 'aws_calls', 'counter', "AWS calls issued by stage."),
+        ('stage_cypher_queries_total'     , 'cypher_queries', 'counter', "Cypher queries issued by stage."),
+        ('stage_cypher_server_seconds_total', 'cypher_server_seconds', 'counter', "Server time of Cypher queries of stage in seconds."),
+        ('stage_cypher_client_seconds_total', 'cypher_client_seconds', 'counter', "Client time of Cypher queries of stage in seconds."),
+    ]
+
+    lines = list()
+    for name, key, kind, description in metrics:
+        lines.append('# HELP {}_{} {}'.format(prefix, name, description))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for stage, values in result['stages'].items():
+            lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, name, _escape(stage), values[key]))
+
+    lines.append('# HELP {}_last_run_timestamp_seconds Time at which the run finished.'.format(prefix))
+    lines.append('# TYPE {}_last_run_timestamp_seconds gauge'.format(prefix))
+    lines.append('{}_last_run_timestamp_seconds {}'.format(prefix, result['finished']))
+
+    _atomic_write(path, '\n'.join(lines) + '\n')
+
+
+def write_profile(path):
+    """Write all sampled stacks to path as folded stacks.
+
+        Each line contains a stack of semicolon separated frames, prefixed by
+        the name of its profiled section, and its number of samples, which is
+        the input format of flame graph tools such as flamegraph.pl.
+        """
+    with _lock:
+        lines = [
+            '{};{} {}'.format(name, stack, n)
+            for name, samples in _profiles.items() for stack, n in samples.items()
+        ]
+    _atomic_write(path, '\n'.join(lines) + '\n')
+
+
+def export(json_path=None, prometheus_path=None, profile_path=None):
+    """Write all configured outputs, by default those of the environment.
+
+        Parameters
+        ----------
+        json_path : string, optional
+            Path of JSON run report, by default MISDET_METRICS_JSON.
+
+        prometheus_path : string, optional
+            Path of Prometheus textfile, by default MISDET_METRICS_PROM.
+
+        profile_path : string, optional
+            Path of folded stacks, by default MISDET_PROFILE.
+        """
+    json_path       = json_path       or JSON_PATH
+    prometheus_path = prometheus_path or PROMETHEUS_PATH
+    profile_path    = profile_path    or PROFILE_PATH
+
+    if json_path:
+        write_json(json_path)
+    if prometheus_path:
+        write_prometheus(prometheus_path)
+    if profile_path:
+        write_profile(profile_path)
+
+
+# Write outputs configured by the environment when the process exits
+if JSON_PATH or PROMETHEUS_PATH or PROFILE_PATH:
+    atexit.register(export)
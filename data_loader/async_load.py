@@ -0,0 +1,354 @@
+from load_data   import (
+    GROUP_POLICY_QUERY, GROUP_QUERY, MEMBERSHIP_QUERY,
+    action_records, group_records, load_excel, resource_records, user_records,
+)
+from permissions import INDEX_QUERY, PERMISSION_QUERY, effective_permissions, permission_rows
+from tqdm      import tqdm
+import argformat
+import argparse
+import asyncio
+import json
+import os
+import sys
+import warnings
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_async_driver
+import metrics
+
+################################################################################
+#                                   Queries                                    #
+################################################################################
+
+# Batched variants of the queries of load_data.py, each creating all rows of a batch
+POLICY_QUERY = '''
+    UNWIND $rows AS row
+    CREATE (policy:Policy {name: row.name, id: row.id, arn: row.arn, policyObject: row.policyObject})
+'''
+
+RESOURCE_QUERY = '''
+    UNWIND $rows AS row
+    MERGE (resource:{label} {{name: row.name, forPolicy: row.policy}})
+'''
+
+ACTION_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (p:Policy), (res:{resource_label})
+    WHERE p.name = row.policyName AND res.name = row.resourceName AND res.forPolicy = row.policy
+    CREATE (p)-[:CONTAINS]->(action:{label} {{name: row.name, effect: row.effect, condition: row.condition}})-[:{relation}]->(res)
+'''
+
+ROLE_QUERY = '''
+    UNWIND $rows AS row
+    CREATE (role:Role {name: row.name, id: row.id, arn: row.arn, attachedPolicies: row.attachedPolicies, assumeRolePolicyDocumentVersion: row.assumeRolePolicyDocumentVersion, assumeRolePolicyDocumentStatement: row.assumeRolePolicyDocumentStatement})
+'''
+
+ROLE_POLICY_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (r:Role), (p:Policy)
+    WHERE r.name = row.roleName AND p.name = row.policyName
+    CREATE (p)-[:IS_ATTACHED_TO]->(r)
+'''
+
+USER_QUERY = '''
+    UNWIND $rows AS row
+    CREATE (user:User {name: row.name, id: row.id, arn: row.arn, attachedPolicies: row.attachedPolicies})
+'''
+
+USER_POLICY_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (u:User), (p:Policy)
+    WHERE u.name = row.userName AND p.name = row.policyName
+    CREATE (p)-[:IS_ATTACHED_TO]->(u)
+'''
+
+# Groups, their attached policies and members are created by the batched queries of load_data.py
+
+################################################################################
+#                                   Records                                    #
+################################################################################
+
+def group_by_labels(records, keys):
+    """Group records by the labels used to format their query.
+
+        Parameters
+        ----------
+        records : iterable of dict()
+            Records as returned by resource_records() or action_records().
+
+        keys : tuple of string
+            Keys of labels used to format the query of a record.
+
+        Returns
+        -------
+        groups : dict()
+            Dictionary of labels -> list of records, in their original order.
+        """
+    groups = dict()
+    for record in records:
+        groups.setdefault(tuple(record[key] for key in keys), []).append(record)
+    return groups
+
+
+def role_records(roles):
+    """Return the Role nodes and their attached policies, as in create_role_nodes().
+
+        Parameters
+        ----------
+        roles : pd.DataFrame
+            Roles for which to create records.
+
+        Returns
+        -------
+        nodes : list of dict()
+            Parameters of each Role node.
+
+        attachments : list of dict()
+            'roleName' and 'policyName' of each attached policy.
+        """
+    nodes       = list()
+    attachments = list()
+
+    for index, row in roles.iterrows():
+        try:
+            version   = row.AssumeRolePolicyDocumentStatement
+            statement = row.AssumeRolePolicyDocumentStatement
+        except AttributeError as e:
+            # Print warning
+            warnings.warn("Error in row '{}': '{}', trying to load as json...".format(row.RoleName, e))
+
+            policy_document = json.loads(row.AssumeRolePolicyDocument)
+            version         = policy_document.get('Version', 'N/A')
+            statement       = str(policy_document.get('Statement', 'N/A'))
+
+        nodes.append({
+            'name'                             : row.RoleName,
+            'id'                               : row.RoleId,
+            'arn'                              : row.Arn,
+            'attachedPolicies'                 : row.AttachedPolicies,
+            'assumeRolePolicyDocumentVersion'  : version,
+            'assumeRolePolicyDocumentStatement': statement,
+        })
+
+        for policy in json.loads(row.AttachedPolicies.replace("\'", "\"")):
+            attachments.append({'roleName': row.RoleName, 'policyName': policy['PolicyName']})
+
+    # Return result
+    return nodes, attachments
+
+################################################################################
+#                                    Loader                                    #
+################################################################################
+
+async def _write(tx, query, rows):
+    """Run query for rows within a write transaction."""
+    result = await tx.run(query, rows=rows)
+    await result.consume()
+
+
+class AsyncLoader(object):
+    """Load data using multiple concurrent batched write transactions.
+
+        Instead of creating each node in a separate round trip of a single
+        transaction, rows are written in batches using UNWIND, and up to
+        concurrency batches are in flight at once, each in its own session
+        of the connection pool of driver. Transient errors, e.g., deadlocks
+        between concurrent batches, are retried by the driver.
+
+        Parameters
+        ----------
+        driver : neo4j.AsyncDriver
+            Driver for database connection, see connection.get_async_driver().
+
+        batch_size : int, default=1000
+            Number of rows written per transaction.
+
+        concurrency : int, default=8
+            Maximum number of transactions in flight, should not exceed the
+            pool size of driver.
+
+        database : string, default="neo4j"
+            Database to write to.
+        """
+
+    def __init__(self, driver, batch_size=1000, concurrency=8, database="neo4j"):
+        self.driver      = driver
+        self.batch_size  = batch_size
+        self.concurrency = concurrency
+        self.database    = database
+        self.semaphore   = None
+
+    async def write(self, query, rows, desc=None):
+        """Write rows in concurrent batches.
+
+            Parameters
+            ----------
+            query : string
+                Query writing the batch of rows given as $rows.
+
+            rows : list of dict()
+                Rows to write.
+
+            desc : string, optional
+                Description shown in progress bar.
+            """
+        # Semaphore limiting transactions in flight over all concurrent writes
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        progress = tqdm(total=len(rows), desc=desc)
+        metrics.rows(len(rows))
+
+        async def write_batch(batch):
+            async with self.semaphore:
+                async with self.driver.session(database=self.database) as session:
+                    await session.execute_write(_write, query, batch)
+            progress.update(len(batch))
+
+        try:
+            await asyncio.gather(*[
+                write_batch(rows[start:start+self.batch_size])
+                for start in range(0, len(rows), self.batch_size)
+            ])
+        finally:
+            progress.close()
+
+    async def create_indexes(self):
+        """Create indexes on the names of nodes, see load_data.create_indexes(),
+            and on the principals of the effective-permission index."""
+        async with self.driver.session(database=self.database) as session:
+            for label in ('Policy', 'Action', 'Resource'):
+                result = await session.run('CREATE INDEX {0}_name IF NOT EXISTS FOR (n:{1}) ON (n.name)'.format(
+                    label.lower(), label))
+                await result.consume()
+            result = await session.run(INDEX_QUERY)
+            await result.consume()
+
+    async def load(self, policies, roles, users=None, groups=None):
+        """Load policies, roles, users and groups, creating the same graph as load_data.py.
+
+            Nodes that do not depend on each other are written concurrently,
+            i.e., first all policies, resources, roles, users, groups and
+            effective permissions, then all actions, attached policies and
+            group memberships.
+
+            Parameters
+            ----------
+            policies : pd.DataFrame
+                Policies for which to create nodes.
+
+            roles : pd.DataFrame
+                Roles for which to create nodes.
+
+            users : pd.DataFrame, optional
+                Users for which to create nodes and index the effective
+                permissions.
+
+            groups : pd.DataFrame, optional
+                Groups for which to create nodes and index the effective
+                permissions.
+            """
+        await self.create_indexes()
+
+        # Prepare rows, resources are merged and therefore written only once
+        resources = group_by_labels(
+            {(r['label'], r['name'], r['policy']): r for r in resource_records(policies)}.values(),
+            ('label',),
+        )
+        actions = group_by_labels(action_records(policies), ('label', 'resource_label', 'relation'))
+        role_nodes, role_policies = role_records(roles)
+        user_nodes, user_policies = user_records(users) if users is not None else ([], [])
+        group_nodes, group_policies, memberships = group_records(groups) if groups is not None else ([], [], [])
+        permissions = permission_rows(effective_permissions(policies, users, groups, roles))
+
+        # Create nodes
+        await asyncio.gather(
+            self.write(POLICY_QUERY, [{
+                'name'        : row.PolicyName,
+                'id'          : row.PolicyId,
+                'arn'         : row.Arn,
+                'policyObject': row.PolicyObject,
+            } for index, row in policies.iterrows()], desc="Loading policies"),
+            *[
+                self.write(RESOURCE_QUERY.format(label=label), rows, desc="Loading {}s".format(label))
+                for (label,), rows in resources.items()
+            ],
+            self.write(ROLE_QUERY, role_nodes, desc="Loading roles"),
+            self.write(USER_QUERY, user_nodes, desc="Loading users"),
+            self.write(GROUP_QUERY, group_nodes, desc="Loading groups"),
+            self.write(PERMISSION_QUERY, permissions, desc="Indexing permissions"),
+        )
+
+        # Create nodes and relations depending on the created nodes
+        await asyncio.gather(
+            *[
+                self.write(ACTION_QUERY.format(label=label, resource_label=resource_label, relation=relation),
+                           rows, desc="Loading {}s".format(label))
+                for (label, resource_label, relation), rows in actions.items()
+            ],
+            self.write(ROLE_POLICY_QUERY , role_policies , desc="Attaching role policies" ),
+            self.write(USER_POLICY_QUERY , user_policies , desc="Attaching user policies" ),
+            self.write(GROUP_POLICY_QUERY, group_policies, desc="Attaching group policies"),
+            self.write(MEMBERSHIP_QUERY  , memberships   , desc="Adding group members"    ),
+        )
+
+
+async def load_async(path, batch_size=1000, concurrency=8, **settings):
+    """Load the data of an Excel file using an AsyncLoader.
+
+        Parameters
+        ----------
+        path : string
+            File path from which to load data.
+
+        batch_size : int, default=1000
+            Number of rows written per transaction.
+
+        concurrency : int, default=8
+            Maximum number of transactions in flight.
+
+        **settings : optional
+            Connection settings, see connection.settings().
+        """
+    policies, users, groups, roles = load_excel(path)
+
+    driver = get_async_driver(**settings)
+    try:
+        with metrics.stage('load.async'):
+            await AsyncLoader(driver, batch_size=batch_size, concurrency=concurrency).load(policies, roles, users, groups)
+    finally:
+        await driver.close()
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Load data into the graph using concurrent batched transactions",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("file", nargs='?', default="../collector/example/iam_policy_data_2021-03-26_14:11.xlsx", help="file from which to load data")
+    parser.add_argument("--batch-size" , type=int, default=1000, help="number of rows written per transaction")
+    parser.add_argument("--concurrency", type=int, default=8   , help="maximum number of transactions in flight")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                              Load data                               #
+    ########################################################################
+
+    asyncio.run(load_async(
+        args.file,
+        batch_size  = args.batch_size,
+        concurrency = args.concurrency,
+        uri         = args.uri,
+        user        = args.user,
+        password    = args.password,
+        pool_size   = args.pool_size,
+    ))
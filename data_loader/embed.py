@@ -0,0 +1,242 @@
+import argformat
+import argparse
+import numpy as np
+import os
+import sys
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_graph
+import metrics
+
+################################################################################
+#                            Node2vec configuration                            #
+################################################################################
+
+# Configuration of node2vec, as described in README.md
+NODE2VEC_CONFIG = {
+    'embeddingDimension': 128,
+    'iterations'        : 100,
+    'walkLength'        : 5000,
+}
+
+# Both the full and the incremental embedding walk the policy subgraphs, i.e.,
+# policies, their actions and the resources these work on, such that the
+# embeddings of both live in the same feature space
+NODE_LABELS        = ["Policy", "Action", "NotAction", "notAction", "Resource", "NotResource"]
+RELATIONSHIP_TYPES = ["CONTAINS", "WORKS_ON", "WORKS_NOT_ON"]
+
+# Nodes in the neighborhood of given policies, i.e., the policy subgraphs
+NEIGHBORHOOD_NODE_QUERY = '''
+    MATCH (p:Policy) WHERE p.name IN $names
+    OPTIONAL MATCH (p)-[:CONTAINS]->(a)
+    OPTIONAL MATCH (a)-[:WORKS_ON|WORKS_NOT_ON]->(r)
+    WITH collect(p) + collect(a) + collect(r) AS nodes
+    UNWIND nodes AS n
+    RETURN DISTINCT id(n) AS id
+'''
+
+# Relationships in the neighborhood of given policies
+NEIGHBORHOOD_RELATIONSHIP_QUERY = '''
+    MATCH (p:Policy)-[c:CONTAINS]->(a)
+    WHERE p.name IN $names
+    OPTIONAL MATCH (a)-[w:WORKS_ON|WORKS_NOT_ON]->(r)
+    WITH collect([id(p), id(a)]) + collect(CASE WHEN r IS NULL THEN NULL ELSE [id(a), id(r)] END) AS pairs
+    UNWIND pairs AS pair
+    RETURN pair[0] AS source, pair[1] AS target
+'''
+
+################################################################################
+#                               Full embedding                                 #
+################################################################################
+
+@metrics.timed('embed.graph')
+def embed_graph(gr):
+    """Compute the node2vec embedding of all policies in the graph.
+
+        Note
+        ----
+        This is the same call as described in README.md, writing the
+        embedding to the embeddingNode2vec property of each Policy node.
+        The projection contains the policy subgraphs, see NODE_LABELS and
+        RELATIONSHIP_TYPES, as walked by embed_policies().
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph for which to compute the embedding.
+        """
+    gr.run('''
+        CALL gds.beta.node2vec.write({
+          nodeProjection: $nodeLabels,
+          relationshipProjection: $relationshipTypes,
+          embeddingDimension: $embeddingDimension,
+          iterations: $iterations,
+          walkLength: $walkLength,
+          writeProperty: "embeddingNode2vec"
+        })
+    ''', parameters={
+        'nodeLabels'       : NODE_LABELS,
+        'relationshipTypes': RELATIONSHIP_TYPES,
+        **NODE2VEC_CONFIG,
+    })
+
+################################################################################
+#                            Incremental embedding                             #
+################################################################################
+
+@metrics.timed('embed.policies')
+def embed_policies(gr, policies, n_anchors=256):
+    """Recompute the embedding of only the given (changed) policies.
+
+        Only the neighborhood of the given policies is walked, together with
+        the neighborhood of a sample of unchanged anchor policies. As node2vec
+        embeddings of separate runs live in different coordinate systems, the
+        new embeddings are aligned to the existing ones using the anchors, see
+        align_embeddings(). The embedding of all other policies is unchanged.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph for which to update the embedding.
+
+        policies : iterable of string
+            Names of policies that were added or changed.
+
+        n_anchors : int, default=256
+            Maximum number of unchanged policies used to align embeddings.
+
+        Returns
+        -------
+        updated : int
+            Number of policies for which the embedding was updated.
+        """
+    policies = sorted(set(policies))
+    if not policies:
+        return 0
+
+    # Sample anchors with an existing embedding
+    anchors = {
+        record['name']: record['embedding'] for record in gr.run('''
+            MATCH (p:Policy)
+            WHERE NOT p.name IN $names AND p.embeddingNode2vec IS NOT NULL
+            WITH p, rand() AS r ORDER BY r LIMIT $limit
+            RETURN p.name AS name, p.embeddingNode2vec AS embedding
+        ''', parameters={'names': policies, 'limit': n_anchors}).data()
+    }
+
+    # Without existing embeddings there is nothing to align with
+    if len(anchors) < 2:
+        embed_graph(gr)
+        return gr.evaluate('MATCH (p:Policy) RETURN count(p)')
+
+    # Walk only the neighborhood of changed policies and anchors
+    embedding = {
+        record['name']: record['embedding'] for record in gr.run('''
+            CALL gds.beta.node2vec.stream({
+              nodeQuery: $nodeQuery,
+              relationshipQuery: $relationshipQuery,
+              parameters: {names: $names},
+              embeddingDimension: $embeddingDimension,
+              iterations: $iterations,
+              walkLength: $walkLength
+            })
+            YIELD nodeId, embedding
+            WITH gds.util.asNode(nodeId) AS node, embedding
+            WHERE node:Policy
+            RETURN node.name AS name, embedding
+        ''', parameters={
+            'nodeQuery'        : NEIGHBORHOOD_NODE_QUERY,
+            'relationshipQuery': NEIGHBORHOOD_RELATIONSHIP_QUERY,
+            'names'            : policies + list(anchors),
+            **NODE2VEC_CONFIG,
+        }).data()
+    }
+
+    # Align new embedding to the existing one using the anchors
+    names = [name for name in anchors if name in embedding]
+    transform = align_embeddings(
+        source = np.asarray([embedding[name] for name in names]),
+        target = np.asarray([anchors  [name] for name in names]),
+    )
+
+    # Write aligned embedding of changed policies only
+    rows = [
+        {'name': name, 'embedding': transform(np.asarray(embedding[name])).tolist()}
+        for name in policies if name in embedding
+    ]
+    tx = gr.begin()
+    tx.evaluate('''
+        UNWIND $rows AS row
+        MATCH (p:Policy {name: row.name})
+        SET p.embeddingNode2vec = row.embedding
+    ''', parameters={'rows': rows})
+    gr.commit(tx)
+
+    # Return number of updated policies
+    return len(rows)
+
+
+def align_embeddings(source, target):
+    """Find the similarity transform (rotation, scaling and translation) that
+        maps source onto target in the least squares sense (Procrustes).
+
+        Parameters
+        ----------
+        source : np.array of shape=(n_samples, n_dimensions)
+            Embedding of anchors in the new coordinate system.
+
+        target : np.array of shape=(n_samples, n_dimensions)
+            Embedding of anchors in the existing coordinate system.
+
+        Returns
+        -------
+        transform : callable
+            Function mapping vectors from the new to the existing coordinate
+            system.
+        """
+    # Center both sets
+    source_mean = source.mean(axis=0)
+    target_mean = target.mean(axis=0)
+    source_ = source - source_mean
+    target_ = target - target_mean
+
+    # Compute optimal rotation and scale
+    U, S, Vt = np.linalg.svd(source_.T @ target_)
+    rotation = U @ Vt
+    norm     = (source_ ** 2).sum()
+    scale    = S.sum() / norm if norm > 0 else 1.
+
+    # Return transform
+    return lambda X: (X - source_mean) @ rotation * scale + target_mean
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Embed the graph, or only the given policies",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("policies", nargs='*', help="names of policies to embed, by default the full graph is embedded")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                                Embed                                 #
+    ########################################################################
+
+    # Create connection with Graph
+    graph = get_graph(uri=args.uri, user=args.user, password=args.password, pool_size=args.pool_size)
+
+    # Embed given policies only, or the full graph if no policies are given
+    if args.policies:
+        print("Updated embedding of {} policies".format(embed_policies(graph, args.policies)))
+    else:
+        embed_graph(graph)
@@ -1,10 +1,17 @@
-from py2neo import Graph
 from tqdm import tqdm
+import argformat
+import argparse
 import json
+import os
 import pandas as pd
 import sys
 import warnings
 
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_graph
+import metrics
+
 def load_excel(file_path):
     """Load pandas dataframes from stored Excel files.
 
@@ -49,6 +56,23 @@ def load_excel(file_path):
     return df_policies, df_users, df_groups, df_roles
 
 
+def create_indexes(gr):
+    """Create indexes on the names of nodes for given graph.
+
+        Used by the MATCH clauses when loading data and by the rule checks of
+        cloud_custodian/graph_rules.py.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph for which to create indexes.
+        """
+    for label in ('Policy', 'Action', 'Resource'):
+        gr.run('CREATE INDEX {0}_name IF NOT EXISTS FOR (n:{1}) ON (n.name)'.format(
+            label.lower(), label))
+
+
+@metrics.timed('load.policies')
 def create_policy_nodes(gr, policies):
     """Create policy nodes for given graph.
 
@@ -60,6 +84,7 @@ def create_policy_nodes(gr, policies):
         policies : pd.DataFrame
             Policies for which to create nodes.
         """
+    metrics.rows(policies.shape[0])
     tx = gr.begin()
 
     for index, row in tqdm(policies.iterrows(), desc="Loading policies"):
@@ -74,64 +99,181 @@ def create_policy_nodes(gr, policies):
     gr.commit(tx)
 
 
-def create_resource_nodes(gr, resources):
-    """Create resource nodes for given graph.
+def policy_statements(policies):
+    """Parse the statements of the policy object of each policy.
 
         Parameters
         ----------
-        gr : Graph
-            Graph for which to create nodes.
+        policies : pd.DataFrame
+            Policies of which to parse statements.
 
-        resources : pd.DataFrame
-            Resources for which to create nodes.
-        """
-    tx = gr.begin()
+        Yields
+        ------
+        name : string
+            Name of policy.
 
-    for index, row in tqdm(resources.iterrows(), desc="Loading resources"):
+        statement : object
+            Statement of policy, policies that cannot be parsed are skipped
+            with a warning.
+        """
+    for index, row in policies.iterrows():
+        # Replace single quote with double quote for json parsing
         policy_object = row.PolicyObject.replace("\'", "\"")
         policy_object = policy_object.replace("True", "true")
         policy_object = policy_object.replace("False", "false")
 
         try:
             policy_list = json.loads(policy_object)
+        except json.decoder.JSONDecodeError as e:
+            warnings.warn("Error in row '{}': '{}', skipping row...".format(row.PolicyName, e))
+            continue
 
-            if not isinstance(policy_list, list):
-                tmp = [policy_list]
-                policy_list = tmp
+        if not isinstance(policy_list, list):
+            policy_list = [policy_list]
 
-            for policy in policy_list:
+        for policy in policy_list:
+            yield row.PolicyName, policy
 
-                # Check whether the policy actually contains resources
-                if 'Resource' in policy:
-                    resource_list = policy['Resource']
 
-                    if not isinstance(resource_list, list):
-                        tmp = [resource_list]
-                        resource_list = tmp
+def resource_records(policies):
+    """Yield the Resource and NotResource nodes of given policies.
 
-                    for resource in resource_list:
-                        tx.evaluate('''
-                            MERGE (resource:Resource {name: $name, forPolicy: $policy})
-                            ''', parameters={'name': resource, 'policy': row.PolicyName})
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            Policies for which to yield resources.
 
-                elif 'NotResource' in policy:
-                    not_resource_list = policy['NotResource']
+        Yields
+        ------
+        record : dict()
+            Dictionary containing the 'label', 'name' and 'policy' of a node.
+        """
+    for name, policy in policy_statements(policies):
+        # Check whether the policy actually contains resources
+        if 'Resource' in policy:
+            label, resource_list = 'Resource', policy['Resource']
+        elif 'NotResource' in policy:
+            label, resource_list = 'NotResource', policy['NotResource']
+        else:
+            continue
 
-                    if not isinstance(not_resource_list, list):
-                        tmp = [not_resource_list]
-                        not_resource_list = tmp
+        if not isinstance(resource_list, list):
+            resource_list = [resource_list]
 
-                    for not_resource in not_resource_list:
-                        tx.evaluate('''
-                            MERGE (notresource:NotResource {name: $name, forPolicy: $policy})
-                            ''', parameters={'name': not_resource, 'policy': row.PolicyName})
+        for resource in resource_list:
+            yield {'label': label, 'name': resource, 'policy': name}
 
-        except json.decoder.JSONDecodeError as e:
-            warnings.warn("Error in row '{}': '{}', skipping row...".format(row.PolicyName, e))
+
+def action_records(policies):
+    """Yield the Action, NotAction and notAction nodes of given policies.
+
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            Policies for which to yield actions.
+
+        Yields
+        ------
+        record : dict()
+            Dictionary containing the 'label', 'relation' and
+            'resource_label' of the node and its relation to its resource,
+            and the parameters 'policyName', 'resourceName', 'name', 'policy',
+            'effect' and 'condition' of ACTION_QUERY.
+        """
+    for name, policy in policy_statements(policies):
+        resource_list = []
+        not_resource_list = []
+        action_list = []
+        not_action_list = []
+
+        # Effect and presence of a condition, used for rule checks in the graph
+        effect    = policy.get('Effect') if isinstance(policy, dict) else None
+        condition = 'Condition' in policy
+
+        if 'Resource' in policy:
+            resource_list = policy['Resource']
+        elif 'NotResource' in policy:
+            resource_list = policy['NotResource']
+
+        if not isinstance(resource_list, list):
+            resource_list = [resource_list]
+
+        if not isinstance(not_resource_list, list):
+            not_resource_list = [not_resource_list]
+
+        if 'Action' in policy:
+            action_list = policy['Action']
+        elif 'NotAction' in policy:
+            not_action_list = policy['NotAction']
+
+        if not isinstance(action_list, list):
+            action_list = [action_list]
+
+        if not isinstance(not_action_list, list):
+            not_action_list = [not_action_list]
+
+        # Combinations of (actions, resources) with their labels and relation
+        for actions, resources, label, resource_label, relation in (
+                (action_list    , resource_list    , 'Action'   , 'Resource'   , 'WORKS_ON'    ),
+                (action_list    , not_resource_list, 'NotAction', 'NotResource', 'WORKS_NOT_ON'),
+                (not_action_list, not_resource_list, 'notAction', 'NotResource', 'WORKS_NOT_ON'),
+                (not_action_list, resource_list    , 'NotAction', 'Resource'   , 'WORKS_NOT_ON'),
+            ):
+            if not (actions and resources):
+                continue
+            for resource in resources:
+                for action in actions:
+                    yield {
+                        'label'         : label,
+                        'resource_label': resource_label,
+                        'relation'      : relation,
+                        'policyName'    : name,
+                        'resourceName'  : resource,
+                        'name'          : action,
+                        'policy'        : name,
+                        'effect'        : effect,
+                        'condition'     : condition,
+                    }
+
+
+# Queries creating a single resource and action, formatted with the labels of a record
+RESOURCE_QUERY = '''
+    MERGE (resource:{label} {{name: $name, forPolicy: $policy}})
+'''
+
+ACTION_QUERY = '''
+    MATCH (p:Policy), (res:{resource_label})
+    WHERE p.name = $policyName AND res.name = $resourceName AND res.forPolicy = $policy
+    CREATE (p)-[:CONTAINS]->(action:{label} {{name: $name, effect: $effect, condition: $condition}})-[:{relation}]->(res)
+    RETURN action
+'''
+
+
+@metrics.timed('load.resources')
+def create_resource_nodes(gr, resources):
+    """Create resource nodes for given graph.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph for which to create nodes.
+
+        resources : pd.DataFrame
+            Resources for which to create nodes.
+        """
+    metrics.rows(resources.shape[0])
+    tx = gr.begin()
+
+    for record in tqdm(resource_records(resources), desc="Loading resources"):
+        tx.evaluate(RESOURCE_QUERY.format(**record), parameters={
+            'name'  : record['name'],
+            'policy': record['policy'],
+        })
 
     gr.commit(tx)
 
 
+@metrics.timed('load.actions')
 def create_action_nodes(gr, actions):
     """Create action nodes for given graph.
 
@@ -143,103 +285,19 @@ def create_action_nodes(gr, actions):
         actions : pd.DataFrame
             Actions for which to create nodes.
         """
+    metrics.rows(actions.shape[0])
     tx = gr.begin()
 
-    for index, row in tqdm(actions.iterrows(), desc="Loading actions"):
-        # Replace single quote with double quote for json parsing
-        policy_object = row.PolicyObject.replace("\'", "\"")
-        policy_object = policy_object.replace("True", "true")
-        policy_object = policy_object.replace("False", "false")
-
-        try:
-            policy_list = json.loads(policy_object)
-
-            if not isinstance(policy_list, list):
-                tmp = [policy_list]
-                policy_list = tmp
-
-            for policy in policy_list:
-                resource_list = []
-                not_resource_list = []
-                action_list = []
-                not_action_list = []
-
-                if 'Resource' in policy:
-                    resource_list = policy['Resource']
-                elif 'NotResource' in policy:
-                    resource_list = policy['NotResource']
-
-                if not isinstance(resource_list, list):
-                    tmp = [resource_list]
-                    resource_list = tmp
-
-                if not isinstance(not_resource_list, list):
-                    tmp = [not_resource_list]
-                    not_resource_list = tmp
-
-                if 'Action' in policy:
-                    action_list = policy['Action']
-                elif 'NotAction' in policy:
-                    not_action_list = policy['NotAction']
-
-                if not isinstance(action_list, list):
-                    tmp = [action_list]
-                    action_list = tmp
-
-                if not isinstance(not_action_list, list):
-                    tmp = [not_action_list]
-                    not_action_list = tmp
-
-                if resource_list and action_list:
-                    for resource in resource_list:
-                        for action in action_list:
-                            tx.evaluate('''
-                                MATCH (p:Policy), (res:Resource)
-                                WHERE p.name = $policyName AND res.name = $resourceName AND res.forPolicy = $policy
-                                CREATE (p)-[:CONTAINS]->(action:Action {name: $name})-[:WORKS_ON]->(res)
-                                RETURN action
-                               ''', parameters={'policyName': row.PolicyName, 'resourceName': resource, 'name': action,
-                                                'policy': row.PolicyName})
-
-                if not_resource_list and action_list:
-                    for resource in not_resource_list:
-                        for action in action_list:
-                            tx.evaluate('''
-                                MATCH (p:Policy), (res:NotResource)
-                                WHERE p.name = $policyName AND res.name = $resourceName AND res.forPolicy = $policy
-                                CREATE (p)-[:CONTAINS]->(action:NotAction {name: $name})-[:WORKS_NOT_ON]->(res)
-                                RETURN action
-                               ''', parameters={'policyName': row.PolicyName, 'resourceName': resource, 'name': action,
-                                                'policy': row.PolicyName})
-
-                if not_resource_list and not_action_list:
-                    for resource in not_resource_list:
-                        for action in not_action_list:
-                            tx.evaluate('''
-                                MATCH (p:Policy), (res:NotResource)
-                                WHERE p.name = $policyName AND res.name = $resourceName AND res.forPolicy = $policy
-                                CREATE (p)-[:CONTAINS]->(action:notAction {name: $name})-[:WORKS_NOT_ON]->(res)
-                                RETURN action
-                               ''', parameters={'policyName': row.PolicyName, 'resourceName': resource, 'name': action,
-                                                'policy': row.PolicyName})
-
-                if resource_list and not_action_list:
-                    for resource in resource_list:
-                        for action in not_action_list:
-                            tx.evaluate('''
-                                MATCH (p:Policy), (res:Resource)
-                                WHERE p.name = $policyName AND res.name = $resourceName AND res.forPolicy = $policy
-                                CREATE (p)-[:CONTAINS]->(action:NotAction {name: $name})-[:WORKS_NOT_ON]->(res)
-                                RETURN action
-                               ''', parameters={'policyName': row.PolicyName, 'resourceName': resource, 'name': action,
-                                                'policy': row.PolicyName})
-
-        except json.decoder.JSONDecodeError as e:
-            warnings.warn("Error in row '{}': '{}', skipping row...".format(row.PolicyName, e))
+    for record in tqdm(action_records(actions), desc="Loading actions"):
+        tx.evaluate(ACTION_QUERY.format(**record), parameters={
+            key: record[key] for key in
+            ('policyName', 'resourceName', 'name', 'policy', 'effect', 'condition')
+        })
 
     gr.commit(tx)
 
 
+@metrics.timed('load.users')
 def create_user_nodes(gr, users):
     """Create user nodes for given graph.
 
@@ -251,6 +309,7 @@ def create_user_nodes(gr, users):
         users : pd.DataFrame
             Users for which to create nodes.
         """
+    metrics.rows(users.shape[0])
     tx = gr.begin()
 
     for index, row in tqdm(users.iterrows(), desc="Loading users"):
@@ -273,9 +332,107 @@ def create_user_nodes(gr, users):
     gr.commit(tx)
 
 
-def create_group_nodes(gr, groups):
+def user_records(users):
+    """Return the User nodes and their attached policies, as in create_user_nodes().
+
+        Parameters
+        ----------
+        users : pd.DataFrame
+            Users for which to create records.
+
+        Returns
+        -------
+        nodes : list of dict()
+            Parameters of each User node.
+
+        attachments : list of dict()
+            'userName' and 'policyName' of each attached policy.
+        """
+    nodes       = list()
+    attachments = list()
+
+    for index, row in users.iterrows():
+        nodes.append({
+            'name'            : row.UserName,
+            'id'              : row.UserId,
+            'arn'             : row.Arn,
+            'attachedPolicies': row.AttachedPolicies,
+        })
+        for policy in json.loads(row.AttachedPolicies.replace("\'", "\"")):
+            attachments.append({'userName': row.UserName, 'policyName': policy['PolicyName']})
+
+    # Return result
+    return nodes, attachments
+
+
+def group_records(groups):
+    """Return the Group nodes, their attached policies and their members.
+
+        Parameters
+        ----------
+        groups : pd.DataFrame
+            Groups for which to create records.
+
+        Returns
+        -------
+        nodes : list of dict()
+            Parameters of each Group node.
+
+        attachments : list of dict()
+            'groupName' and 'policyName' of each attached policy.
+
+        memberships : list of dict()
+            'userName' and 'groupName' of each user that is PART_OF a group.
+        """
+    nodes       = list()
+    attachments = list()
+    memberships = list()
+
+    for index, row in groups.iterrows():
+        nodes.append({
+            'name'            : row.GroupName,
+            'id'              : row.GroupId,
+            'arn'             : row.Arn,
+            'attachedPolicies': row.AttachedPolicies,
+            'users'           : row.Users,
+        })
+        for policy in json.loads(row.AttachedPolicies.replace("\'", "\"")):
+            attachments.append({'groupName': row.GroupName, 'policyName': policy['PolicyName']})
+        for user in json.loads(row.Users.replace("\'", "\"")):
+            memberships.append({'userName': user['UserName'], 'groupName': row.GroupName})
+
+    # Return result
+    return nodes, attachments, memberships
+
+
+# Queries creating a batch of groups, their attached policies and members, given as $rows
+GROUP_QUERY = '''
+    UNWIND $rows AS row
+    CREATE (group:Group {name: row.name, id: row.id, arn: row.arn, attachedPolicies: row.attachedPolicies, user: row.users})
+'''
+
+GROUP_POLICY_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (g:Group), (p:Policy)
+    WHERE g.name = row.groupName AND p.name = row.policyName
+    CREATE (p)-[:IS_ATTACHED_TO]->(g)
+'''
+
+MEMBERSHIP_QUERY = '''
+    UNWIND $rows AS row
+    MATCH (u:User), (g:Group)
+    WHERE u.name = row.userName AND g.name = row.groupName
+    CREATE (u)-[:PART_OF]->(g)
+'''
+
+
+@metrics.timed('load.groups')
+def create_group_nodes(gr, groups, batch_size=1000):
     """Create group nodes for given graph.
 
+        Groups, their attached policies and their members are each created
+        in batches of rows within a single transaction.
+
         Parameters
         ----------
         gr : Graph
@@ -283,39 +440,26 @@ def create_group_nodes(gr, groups):
 
         groups : pd.DataFrame
             Groups for which to create nodes.
+
+        batch_size : int, default=1000
+            Number of rows created per query.
         """
+    metrics.rows(groups.shape[0])
+    nodes, attachments, memberships = group_records(groups)
     tx = gr.begin()
 
-    for index, row in tqdm(groups.iterrows(), desc="Loading groups"):
-        tx.evaluate('''
-            CREATE (group:Group {name: $name, id: $id, arn: $arn, attachedPolicies: $attachedPolicies, user: $users}) RETURN group
-            ''', parameters={'name': row.GroupName, 'id': row.GroupId, 'arn': row.Arn,
-                             'attachedPolicies': row.AttachedPolicies, 'users': row.Users})
-    gr.commit(tx)
+    for query, rows, desc in (
+            (GROUP_QUERY       , nodes      , "Loading groups"          ),
+            (GROUP_POLICY_QUERY, attachments, "Attaching group policies"),
+            (MEMBERSHIP_QUERY  , memberships, "Adding group members"    ),
+        ):
+        for start in tqdm(range(0, len(rows), batch_size), desc=desc):
+            tx.evaluate(query, parameters={'rows': rows[start:start+batch_size]})
 
-    tx = gr.begin()
-    for index, row in tqdm(groups.iterrows(), desc="Attaching group policies"):
-        attached_policies = row.AttachedPolicies.replace("\'", "\"")
-        attached_policies_list = json.loads(attached_policies)
-        for policy in attached_policies_list:
-            tx.evaluate('''
-                MATCH (g:Group), (p:Policy)
-                WHERE g.name = $groupName AND p.name = $policyName
-                CREATE (p)-[:IS_ATTACHED_TO]->(g)
-                ''', parameters={'groupName': row.GroupName, 'policyName': policy['PolicyName']})
-        gr.commit(tx)
-        tx = gr.begin()
-        users = row.Users.replace("\'", "\"")
-        users_list = json.loads(users)
-        for user in users_list:
-            tx.evaluate('''
-                MATCH (u:User), (g:Group)
-                WHERE u.name = $userName AND g.name = $groupName
-                CREATE (u)-[:PART_OF]->(g)
-                ''', parameters={'userName': user['UserName'], 'groupName': row.GroupName})
-        gr.commit(tx)
+    gr.commit(tx)
 
 
+@metrics.timed('load.roles')
 def create_role_nodes(gr, roles):
     """Create role nodes for given graph.
 
@@ -327,6 +471,7 @@ def create_role_nodes(gr, roles):
         roles : pd.DataFrame
             Roles for which to create nodes.
         """
+    metrics.rows(roles.shape[0])
     tx = gr.begin()
 
     for index, row in tqdm(roles.iterrows(), desc="Loading roles"):
@@ -367,14 +512,38 @@ def create_role_nodes(gr, roles):
 
 
 if __name__ == "__main__":
-    # Create connection with Graph
-    graph = Graph("bolt://localhost:7687", user="neo4j", password="password")
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Load data into the graph",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("file", nargs='?', default="../collector/example/iam_policy_data_2021-03-26_14:11.xlsx", help="file from which to load data")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
 
-    # Load data from stored files
-    df_policies, df_users, df_groups, df_roles = load_excel("../collector/example/iam_policy_data_2021-03-26_14:11.xlsx")
+    ########################################################################
+    #                              Load data                               #
+    ########################################################################
+
+    # Create connection with Graph, configured by arguments or NEO4J_URI, NEO4J_USER and NEO4J_PASSWORD
+    graph = get_graph(uri=args.uri, user=args.user, password=args.password, pool_size=args.pool_size)
+
+    df_policies, df_users, df_groups, df_roles = load_excel(args.file)
 
     # Create relevant nodes
+    create_indexes       (graph)
     create_policy_nodes  (graph, df_policies)
     create_resource_nodes(graph, df_policies)
     create_action_nodes  (graph, df_policies)
     create_role_nodes    (graph, df_roles)
+
+    # Materialize effective permissions of all principals, imported here as permissions imports this module
+    from permissions import create_permission_index
+    create_permission_index(graph, df_policies, df_users, df_groups, df_roles)
@@ -0,0 +1,493 @@
+from load_data import policy_statements
+import argformat
+import argparse
+import json
+import os
+import pandas as pd
+import re
+import sys
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_graph
+import metrics
+
+################################################################################
+#                                   Queries                                    #
+################################################################################
+
+# Columns identifying a single effective permission of a principal
+PERMISSION_COLUMNS = [
+    'principalType', 'principal', 'action', 'resource',
+    'effect', 'notAction', 'notResource', 'condition',
+]
+
+INDEX_QUERY = '''
+    CREATE INDEX effective_permission_principal IF NOT EXISTS
+    FOR (e:EffectivePermission) ON (e.principalType, e.principal)
+'''
+
+PERMISSION_QUERY = '''
+    UNWIND $rows AS row
+    CREATE (e:EffectivePermission)
+    SET e = row
+'''
+
+DELETE_QUERY = '''
+    UNWIND $principals AS principal
+    MATCH (e:EffectivePermission)
+    WHERE e.principalType = principal.principalType AND e.principal = principal.principal
+    DELETE e
+'''
+
+DELETE_ALL_QUERY = '''
+    MATCH (e:EffectivePermission)
+    DELETE e
+'''
+
+PRINCIPAL_QUERY = '''
+    MATCH (e:EffectivePermission)
+    WHERE e.principalType = $principalType AND e.principal = $principal
+    RETURN e.action AS action, e.resource AS resource, e.effect AS effect,
+           e.notAction AS notAction, e.notResource AS notResource,
+           e.condition AS condition, e.policies AS policies
+'''
+
+READ_QUERY = '''
+    MATCH (e:EffectivePermission)
+    RETURN e.principalType AS principalType, e.principal AS principal,
+           e.action AS action, e.resource AS resource, e.effect AS effect,
+           e.notAction AS notAction, e.notResource AS notResource,
+           e.condition AS condition, e.policies AS policies
+'''
+
+################################################################################
+#                                   Records                                    #
+################################################################################
+
+def _as_list(value):
+    """Return value as list, IAM allows single values instead of lists."""
+    return value if isinstance(value, list) else [value]
+
+
+def statement_records(policies):
+    """Return the (action, resource) pairs of each statement of given policies.
+
+        Unlike the Action nodes of the graph, each pair keeps whether its
+        statement used NotAction and/or NotResource, such that negated pairs
+        can be evaluated correctly, see allowed().
+
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            Policies of which to extract statements.
+
+        Returns
+        -------
+        statements : pd.DataFrame
+            DataFrame with the columns 'policy', 'action', 'resource',
+            'effect', 'notAction', 'notResource' and 'condition'.
+        """
+    records = list()
+
+    for name, statement in policy_statements(policies):
+        if not isinstance(statement, dict):
+            continue
+
+        # Statements without actions or resources, e.g., trust policies, grant no permissions
+        not_action   = 'NotAction'   in statement
+        not_resource = 'NotResource' in statement
+        actions   = statement.get('NotAction'   if not_action   else 'Action')
+        resources = statement.get('NotResource' if not_resource else 'Resource')
+        if actions is None or resources is None:
+            continue
+
+        for action in _as_list(actions):
+            for resource in _as_list(resources):
+                records.append((
+                    name, str(action), str(resource), statement.get('Effect', 'Allow'),
+                    not_action, not_resource, 'Condition' in statement,
+                ))
+
+    # Return result
+    return pd.DataFrame(records, columns=[
+        'policy', 'action', 'resource', 'effect', 'notAction', 'notResource', 'condition',
+    ]).drop_duplicates()
+
+
+def _attached(frame, principal_type, name_column):
+    """Return the policies attached to each principal of frame."""
+    records = list()
+    if frame is not None:
+        for name, attached in zip(frame[name_column], frame['AttachedPolicies']):
+            for policy in json.loads(attached.replace("\'", "\"")):
+                records.append((principal_type, name, policy['PolicyName']))
+    return records
+
+
+def attachment_records(users=None, groups=None, roles=None):
+    """Return the policies that apply to each principal.
+
+        Users are granted the policies attached to them and the policies
+        attached to the groups they are PART_OF.
+
+        Parameters
+        ----------
+        users : pd.DataFrame, optional
+            Users as returned by load_data.load_excel().
+
+        groups : pd.DataFrame, optional
+            Groups as returned by load_data.load_excel().
+
+        roles : pd.DataFrame, optional
+            Roles as returned by load_data.load_excel().
+
+        Returns
+        -------
+        attachments : pd.DataFrame
+            DataFrame with the columns 'principalType', 'principal' and
+            'policy', without duplicates.
+        """
+    columns = ['principalType', 'principal', 'policy']
+
+    direct = pd.DataFrame(
+        _attached(users , 'User' , 'UserName' ) +
+        _attached(groups, 'Group', 'GroupName') +
+        _attached(roles , 'Role' , 'RoleName' ),
+        columns = columns,
+    )
+
+    # Policies inherited by users through their groups
+    memberships = pd.DataFrame([
+        (user['UserName'], name)
+        for name, members in zip(groups['GroupName'], groups['Users'])
+        for user in json.loads(members.replace("\'", "\""))
+    ] if groups is not None else [], columns=['principal', 'group'])
+
+    inherited = memberships.merge(
+        direct[direct['principalType'] == 'Group'],
+        left_on  = 'group',
+        right_on = 'principal',
+        suffixes = ('', '_group'),
+    )
+    inherited['principalType'] = 'User'
+
+    # Return result
+    return pd.concat([direct, inherited[columns]], ignore_index=True).drop_duplicates()
+
+
+@metrics.timed('load.permissions.compute')
+def effective_permissions(policies, users=None, groups=None, roles=None, principals=None):
+    """Compute the effective-permission index of principals.
+
+        Parameters
+        ----------
+        policies : pd.DataFrame
+            Policies as returned by load_data.load_excel().
+
+        users : pd.DataFrame, optional
+            Users as returned by load_data.load_excel().
+
+        groups : pd.DataFrame, optional
+            Groups as returned by load_data.load_excel().
+
+        roles : pd.DataFrame, optional
+            Roles as returned by load_data.load_excel().
+
+        principals : pd.DataFrame, optional
+            If given, only compute the permissions of the principals in its
+            'principalType' and 'principal' columns.
+
+        Returns
+        -------
+        permissions : pd.DataFrame
+            DataFrame with the PERMISSION_COLUMNS and 'policies', i.e., the
+            sorted names of the policies granting each permission.
+        """
+    attachments = attachment_records(users, groups, roles)
+    if principals is not None:
+        attachments = attachments.merge(principals[['principalType', 'principal']].drop_duplicates())
+
+    # Only parse the statements of attached policies
+    statements = statement_records(policies[policies['PolicyName'].isin(attachments['policy'])])
+
+    permissions = (
+        attachments.merge(statements, on='policy')
+        .groupby(PERMISSION_COLUMNS, sort=False)['policy']
+        .agg(lambda names: sorted(set(names)))
+        .rename('policies')
+        .reset_index()
+    )
+    metrics.rows(permissions.shape[0])
+
+    # Return result
+    return permissions
+
+
+def affected_principals(old, new):
+    """Return the principals whose effective permissions may differ between snapshots.
+
+        These are the principals of which the applying policies changed, i.e.,
+        through changed attachments or group memberships, and the principals
+        to which a policy applies whose document was added, changed or removed.
+
+        Parameters
+        ----------
+        old : tuple
+            Tuple of (policies, users, groups, roles) of previous snapshot.
+
+        new : tuple
+            Tuple of (policies, users, groups, roles) of new snapshot.
+
+        Returns
+        -------
+        principals : pd.DataFrame
+            DataFrame with the columns 'principalType' and 'principal'.
+        """
+    old_attachments = attachment_records(*old[1:])
+    new_attachments = attachment_records(*new[1:])
+
+    # Principals of which the applying policies changed
+    attachments = old_attachments.merge(new_attachments, how='outer', indicator=True)
+    changed     = attachments[attachments['_merge'] != 'both']
+
+    # Principals to which an added, changed or removed policy applies
+    documents = old[0][['PolicyName', 'PolicyObject']].merge(
+        new[0][['PolicyName', 'PolicyObject']],
+        on       = 'PolicyName',
+        how      = 'outer',
+        suffixes = ('_old', '_new'),
+    )
+    documents = documents.loc[documents['PolicyObject_old'] != documents['PolicyObject_new'], 'PolicyName']
+    attachments = attachments[attachments['policy'].isin(documents)]
+
+    # Return result
+    return pd.concat([changed, attachments])[['principalType', 'principal']].drop_duplicates()
+
+################################################################################
+#                                    Graph                                     #
+################################################################################
+
+def permission_rows(permissions):
+    """Return the rows of permissions as parameters of PERMISSION_QUERY."""
+    return [{
+        'principalType': row.principalType,
+        'principal'    : row.principal,
+        'action'       : row.action,
+        'resource'     : row.resource,
+        'effect'       : row.effect,
+        'notAction'    : bool(row.notAction),
+        'notResource'  : bool(row.notResource),
+        'condition'    : bool(row.condition),
+        'policies'     : list(row.policies),
+    } for row in permissions.itertuples(index=False)]
+
+
+@metrics.timed('load.permissions.write')
+def write_permissions(gr, permissions, batch_size=1000):
+    """Write permissions as EffectivePermission nodes.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph to which to write permissions.
+
+        permissions : pd.DataFrame
+            Permissions as returned by effective_permissions().
+
+        batch_size : int, default=1000
+            Number of nodes created per query.
+        """
+    gr.run(INDEX_QUERY)
+    rows = permission_rows(permissions)
+    for start in range(0, len(rows), batch_size):
+        gr.run(PERMISSION_QUERY, rows=rows[start:start+batch_size])
+
+
+def create_permission_index(gr, policies, users=None, groups=None, roles=None):
+    """Materialize the effective-permission index of all principals.
+
+        Existing EffectivePermission nodes are replaced.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph in which to create the index.
+
+        policies : pd.DataFrame
+            Policies as returned by load_data.load_excel().
+
+        users : pd.DataFrame, optional
+            Users as returned by load_data.load_excel().
+
+        groups : pd.DataFrame, optional
+            Groups as returned by load_data.load_excel().
+
+        roles : pd.DataFrame, optional
+            Roles as returned by load_data.load_excel().
+        """
+    gr.run(DELETE_ALL_QUERY)
+    write_permissions(gr, effective_permissions(policies, users, groups, roles))
+
+
+@metrics.timed('update.permissions')
+def update_permission_index(gr, old, new):
+    """Update the effective-permission index of the principals affected by a snapshot change.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph in which to update the index.
+
+        old : tuple
+            Tuple of (policies, users, groups, roles) of previously loaded snapshot.
+
+        new : tuple
+            Tuple of (policies, users, groups, roles) of new snapshot.
+
+        Returns
+        -------
+        updated : int
+            Number of principals of which the permissions were recomputed.
+        """
+    principals = affected_principals(old, new)
+    if principals.empty:
+        return 0
+
+    gr.run(DELETE_QUERY, principals=principals.to_dict('records'))
+    write_permissions(gr, effective_permissions(*new, principals=principals))
+
+    # Return result
+    return principals.shape[0]
+
+
+def principal_permissions(gr, principal_type, principal):
+    """Read the effective permissions of a single principal using the index.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph from which to read permissions.
+
+        principal_type : string
+            Label of principal, i.e., 'User', 'Group' or 'Role'.
+
+        principal : string
+            Name of principal.
+
+        Returns
+        -------
+        permissions : pd.DataFrame
+            Permissions of principal, see effective_permissions().
+        """
+    return gr.run(PRINCIPAL_QUERY, principalType=principal_type, principal=principal).to_data_frame(
+        columns = ['action', 'resource', 'effect', 'notAction', 'notResource', 'condition', 'policies'])
+
+
+def read_permissions(gr):
+    """Read the effective permissions of all principals.
+
+        Parameters
+        ----------
+        gr : Graph
+            Graph from which to read permissions.
+
+        Returns
+        -------
+        permissions : pd.DataFrame
+            Permissions of all principals, see effective_permissions().
+        """
+    return gr.run(READ_QUERY).to_data_frame(columns=PERMISSION_COLUMNS + ['policies'])
+
+################################################################################
+#                                  Evaluation                                  #
+################################################################################
+
+def _matches(patterns, value, case_sensitive):
+    """Return whether value matches each IAM pattern, "*" and "?" are wildcards."""
+    if not case_sensitive:
+        value = value.lower()
+    return patterns.map(lambda pattern: re.fullmatch(
+        re.escape(pattern if case_sensitive else pattern.lower()).replace(r'\*', '.*').replace(r'\?', '.'),
+        value,
+        re.DOTALL,
+    ) is not None).astype(bool)
+
+
+def allowed(permissions, action, resource):
+    """Evaluate whether permissions allow action on resource.
+
+        An explicit Deny overrides any Allow. Conditions cannot be evaluated
+        without a request context, therefore conditional Allows are assumed to
+        apply and conditional Denies are assumed not to apply, i.e., the
+        result overestimates rather than underestimates what is allowed.
+
+        Parameters
+        ----------
+        permissions : pd.DataFrame
+            Permissions of a principal, see principal_permissions().
+
+        action : string
+            Action to evaluate, e.g., 's3:GetObject', matched case-insensitively.
+
+        resource : string
+            Resource to evaluate, e.g., 'arn:aws:s3:::bucket/key'.
+
+        Returns
+        -------
+        allowed : boolean
+            True if action on resource is allowed.
+        """
+    if permissions.empty:
+        return False
+
+    # Statements apply if their (Not)Action and (Not)Resource patterns (do not) match
+    applies = (
+        (_matches(permissions['action'  ], action  , False) != permissions['notAction'  ].astype(bool)) &
+        (_matches(permissions['resource'], resource, True ) != permissions['notResource'].astype(bool))
+    )
+
+    denied = applies & (permissions['effect'] == 'Deny') & ~permissions['condition'].astype(bool)
+    return bool((applies & (permissions['effect'] == 'Allow')).any() and not denied.any())
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Query or rebuild the effective-permission index",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("principals", nargs='*', help="principals to show as <Type>:<name>, e.g., Role:admin")
+    parser.add_argument("--rebuild" , help="rebuild the index from given snapshot file")
+    parser.add_argument("--check"   , nargs=2, metavar=('ACTION', 'RESOURCE'), help="only show whether principals are allowed ACTION on RESOURCE")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                             Query index                              #
+    ########################################################################
+
+    graph = get_graph(uri=args.uri, user=args.user, password=args.password, pool_size=args.pool_size)
+
+    # Rebuild index
+    if args.rebuild:
+        from load_data import load_excel
+        create_permission_index(graph, *load_excel(args.rebuild))
+
+    # Show permissions of principals
+    for principal in args.principals:
+        principal_type, _, name = principal.partition(':')
+        permissions = principal_permissions(graph, principal_type, name)
+
+        if args.check:
+            print("{}: {}".format(principal, "allowed" if allowed(permissions, *args.check) else "denied"))
+        else:
+            print(principal)
+            print(permissions.to_string(index=False))
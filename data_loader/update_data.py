@@ -1,4 +1,19 @@
-from load_data import *
+from embed      import embed_policies
+from load_data  import (
+    create_action_nodes, create_group_nodes, create_policy_nodes, create_resource_nodes,
+    create_role_nodes, create_user_nodes, load_excel,
+)
+from permissions import update_permission_index
+import argformat
+import argparse
+import os
+import pandas as pd
+import sys
+
+# Shared connection layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+from connection import add_arguments, get_graph
+import metrics
 
 ################################################################################
 #                          Auxiliary graph functions                           #
@@ -33,20 +48,24 @@ def delete_groups(gr):
     gr.commit(tx)
 
 
+@metrics.timed('update.delete')
 def delete_policy_nodes(gr, policies):
     """Delete all the policies and the attached relationships in the graph."""
     tx = gr.begin()
 
     for index, row in policies.iterrows():
         tx.evaluate('''
-            MATCH (p:Policy)-[r]->(a)-[re]->(res)
+            MATCH (p:Policy)
             WHERE p.name = $policyName and p.id = $policyId
+            OPTIONAL MATCH (p)-[:CONTAINS]->(a)
+            OPTIONAL MATCH (a)-[:WORKS_ON|WORKS_NOT_ON]->(res)
             DETACH DELETE res, a, p
         ''', parameters={'policyName': row.PolicyName, 'policyId': row.PolicyId})
 
     gr.commit(tx)
 
 
+@metrics.timed('update.entities')
 def update_entities(gr, users, groups, roles):
     """Update the entities (users, groups and roles) in the graph."""
     # First delete all the entities in the graph
@@ -67,38 +86,104 @@ def create_updated_policy_nodes(gr, policies):
     create_action_nodes  (gr, policies)
 
 
+# Columns containing the policy document, PolicyDocument is kept as an alias of PolicyObject
+DOCUMENT_COLUMNS = ('PolicyObject', 'PolicyDocument')
+
+
+@metrics.timed('update.policies')
 def update_policy_node(gr, policies, new_policies):
     tx = gr.begin()
 
+    # Differences are indexed by (PolicyName, PolicyId), see compare_policies()
+    keyed = new_policies.set_index(['PolicyName', 'PolicyId'])
+
     for index, row in policies.iterrows():
-        for i, r in row.iteritems():
-            # If the policy change is not to the policyDocumen, simple update the property of the node
-            if (not pd.isnull(r)) & (i[0] != 'PolicyDocument') & (i[1] == 'other'):
-                # Set the property name and lower the first letter
-                property_name = i[0][0].lower() + i[0][1:]
-                tx.evaluate('''
-                    MATCH (p:Policy)
-                    WHERE p.name = $policyName AND p.id = $policyId
-                    SET p.''' + property_name + ''' = $propertyValue
-                    RETURN p.name
-                ''', parameters={'policyName': new_policies.iloc[index].PolicyName,
-                                 'policyId': new_policies.iloc[index].PolicyId, 'propertyValue': r})
-
-            # If a change has been made to the policyDocument:
-            # Delete the node and all the attached entities
-            # Recreate the whole subgraph based on the new data
-            if (not pd.isnull(r)) & (i[0] == 'PolicyDocument') & (i[1] == 'other'):
-                updated_row = (new_policies.iloc[index]).to_frame().T
-                delete_policy_nodes(gr, updated_row)
-                create_updated_policy_nodes(gr, updated_row)
+        changes = {i[0]: r for i, r in row.items() if (not pd.isnull(r)) & (i[1] == 'other')}
+
+        # If a change has been made to the policy document:
+        # Delete the node and all the attached entities
+        # Recreate the whole subgraph based on the new data, once per policy
+        if any(column in changes for column in DOCUMENT_COLUMNS):
+            updated_row = keyed.loc[[index]].reset_index()
+            delete_policy_nodes(gr, updated_row)
+            create_updated_policy_nodes(gr, updated_row)
+            continue
+
+        # If the policy change is not to the policy document, simple update the property of the node
+        for column, r in changes.items():
+            # Set the property name and lower the first letter
+            property_name = column[0].lower() + column[1:]
+            tx.evaluate('''
+                MATCH (p:Policy)
+                WHERE p.name = $policyName AND p.id = $policyId
+                SET p.''' + property_name + ''' = $propertyValue
+                RETURN p.name
+            ''', parameters={'policyName': index[0], 'policyId': index[1], 'propertyValue': r})
 
     gr.commit(tx)
 
 
-# Compare the policies and return a new dataframe with updated policies that need to be changed in the graph
+def changed_policies(added, difference):
+    """Return the names of policies whose policy document was added or changed.
+
+        Parameters
+        ----------
+        added : pd.DataFrame
+            Added policies as returned by compare_policies().
+
+        difference : pd.DataFrame
+            Differences as returned by compare_policies().
+
+        Returns
+        -------
+        result : set()
+            Names of policies for which the embedding must be updated.
+        """
+    # Added policies
+    result = set(added['PolicyName'])
+
+    # Policies of which the document changed
+    columns = [
+        column for column in difference.columns
+        if column[0] in DOCUMENT_COLUMNS and column[1] == 'other'
+    ]
+    if columns:
+        changed = difference[columns].notna().any(axis=1)
+        result |= set(difference.index[changed].get_level_values('PolicyName'))
+
+    # Return result
+    return result
+
+
+@metrics.timed('update.compare')
 def compare_policies(old_policies, new_policies):
-    old_policies.fillna('', inplace=True)
-    new_policies.fillna('', inplace=True)
+    """Compare the policies and return the policies that need to be changed in the graph.
+
+        The given dataframes are not modified, such that they can still be
+        used afterwards, e.g., to update the effective-permission index.
+
+        Parameters
+        ----------
+        old_policies : pd.DataFrame
+            Previously loaded policies as returned by load_data.load_excel().
+
+        new_policies : pd.DataFrame
+            New policies as returned by load_data.load_excel().
+
+        Returns
+        -------
+        delete : pd.DataFrame
+            Policies only in old_policies.
+
+        add : pd.DataFrame
+            Policies only in new_policies.
+
+        difference : pd.DataFrame
+            Differences between the policies in both, as returned by
+            pd.DataFrame.compare() and indexed by (PolicyName, PolicyId).
+        """
+    old_policies = old_policies.fillna('')
+    new_policies = new_policies.fillna('')
 
     cols = ['PolicyName', 'PolicyId']
 
@@ -107,46 +192,19 @@ def compare_policies(old_policies, new_policies):
 
     df_to_delete = df_merge[df_merge['_merge'] == 'left_only']
 
-    df_to_add = df_merge[df_merge['_merge'] == 'right_only']
-
-    temp_add_df = pd.DataFrame(columns=list(new_policies.columns))
-    for index, row in df_to_add.iterrows():
-        temp_add_df = temp_add_df.append(new_policies.loc[
-                                     (new_policies.PolicyName == row.PolicyName) & (
-                                                 new_policies.PolicyId == row.PolicyId)])
-
-    # Concat the to be deleted and to added policies (to perform the compare later)
-    df_to_do = pd.concat([df_to_delete, df_to_add])
-
-    for index, row in df_to_do.iterrows():
-        old_policies.drop(
-            old_policies.loc[
-                (old_policies.PolicyName == row.PolicyName) & (old_policies.PolicyId == row.PolicyId)].index,
-            inplace=True)
-        new_policies.drop(
-            new_policies.loc[
-                (new_policies.PolicyName == row.PolicyName) & (new_policies.PolicyId == row.PolicyId)].index,
-            inplace=True)
-
-    # Sort the policies and reset the pandas index
-    old_policies.sort_values(by=['PolicyName'], inplace=True)
-    new_policies.sort_values(by=['PolicyName'], inplace=True)
-    old_policies.reset_index(drop=True, inplace=True)
-    new_policies.reset_index(drop=True, inplace=True)
-
-    # Concat the extra policy space to the policyDocument
-    # and remove the ExtraPolicySpace column from both old and new dataframe
-    if 'ExtraPolicySpace' in old_policies.columns:
-        for index, row in old_policies.iterrows():
-            if row.ExtraPolicySpace != '':
-                old_policies.at[index, 'PolicyObject'] = row.PolicyObject + row.ExtraPolicySpace
-        old_policies.drop('ExtraPolicySpace', 1, inplace=True)
-
-    if 'ExtraPolicySpace' in new_policies.columns:
-        for index, row in new_policies.iterrows():
-            if row.ExtraPolicySpace != '':
-                new_policies.at[index, 'PolicyObject'] = row.PolicyObject + row.ExtraPolicySpace
-        new_df_policies.drop('ExtraPolicySpace', 1, inplace=True)
+    # Policies only in the new policies, with the columns of the new policies
+    old_keys = pd.MultiIndex.from_frame(old_policies[cols])
+    new_keys = pd.MultiIndex.from_frame(new_policies[cols])
+    temp_add_df = new_policies[~new_keys.isin(old_keys)]
+
+    # Select the policies in both (to perform the compare later), sorted by their key
+    old_policies = old_policies[old_keys.isin(new_keys)].set_index(cols).sort_index()
+    new_policies = new_policies[new_keys.isin(old_keys)].set_index(cols).sort_index()
+
+    # The extra policy space is already concatenated to the policyDocument by load_excel()
+    # remove the ExtraPolicySpace column from both old and new dataframe
+    old_policies = old_policies.drop(columns='ExtraPolicySpace', errors='ignore')
+    new_policies = new_policies.drop(columns='ExtraPolicySpace', errors='ignore')
 
     # Use pd.compare to look for differences between the old and new policies
     diff = old_policies.compare(new_policies)
@@ -155,19 +213,51 @@ def compare_policies(old_policies, new_policies):
 
 
 if __name__ == "__main__":
-    graph = Graph("bolt://localhost:7687", user="neo4j", password="password")
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Update the graph from the previously loaded data to new data",
+        formatter_class = argformat.StructuredFormatter,
+    )
 
-    df_policies, df_users, df_groups, df_roles = load_excel('../collector/example/iam_policy_data_2021-03-26_14:11.xlsx')
-    new_df_policies, new_df_users, new_df_groups, new_df_roles = load_excel('../collector/example/iam_policy_data_2021-03-26_14:11.xlsx')
+    # Add arguments
+    parser.add_argument("old", nargs='?', default='../collector/example/iam_policy_data_2021-03-26_14:11.xlsx', help="file of previously loaded data")
+    parser.add_argument("new", nargs='?', default='../collector/example/iam_policy_data_2021-03-26_14:11.xlsx', help="file of new data")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                             Update data                              #
+    ########################################################################
+
+    graph = get_graph(uri=args.uri, user=args.user, password=args.password, pool_size=args.pool_size)
+
+    df_policies, df_users, df_groups, df_roles = load_excel(args.old)
+    new_df_policies, new_df_users, new_df_groups, new_df_roles = load_excel(args.new)
 
     delete, add, difference = compare_policies(df_policies, new_df_policies)
 
     print('Updating policies...')
     delete_policy_nodes(graph, delete)
-    create_policy_nodes(graph, add)
+    create_updated_policy_nodes(graph, add)
 
     update_policy_node(graph, difference, new_df_policies)
 
+    print('Updating embeddings...')
+    changed = changed_policies(add, difference)
+    print('Updated embedding of {} policies'.format(embed_policies(graph, changed)))
+
     print('Updating entities...')
     update_entities(graph, new_df_users, new_df_groups, new_df_roles)
     print('Entities successfully updated')
+
+    print('Updating effective permissions...')
+    print('Updated permissions of {} principals'.format(update_permission_index(
+        graph,
+        (df_policies, df_users, df_groups, df_roles),
+        (new_df_policies, new_df_users, new_df_groups, new_df_roles),
+    )))
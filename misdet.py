@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Imports, only lightweight modules are imported before dispatching a command
+import argformat
+import argparse
+import os
+import sys
+
+# Root directory of repository
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Commands and the script implementing each command
+COMMANDS = {
+    'collect'    : ('collector/retrieve_policydata.py'  , "collect a snapshot of the AWS environment"),
+    'load'       : ('data_loader/load_data.py'          , "load a snapshot into the graph"),
+    'load-async' : ('data_loader/async_load.py'         , "load a snapshot using concurrent batched transactions"),
+    'update'     : ('data_loader/update_data.py'        , "update the graph from an old to a new snapshot"),
+    'embed'      : ('data_loader/embed.py'              , "embed the graph or the given policies"),
+    'detect'     : ('anomaly_detection/run_detectors.py', "fit and evaluate anomaly detectors"),
+    'score'      : ('anomaly_detection/score.py'        , "score policies using a stored detector"),
+    'duplicates' : ('anomaly_detection/lsh.py'          , "find near-duplicate policies and their deltas"),
+    'principals' : ('anomaly_detection/principals.py'  , "detect anomalous users, groups and roles"),
+    'rules'      : ('cloud_custodian/cloud_custodian.py', "check snapshots against the Cloud Custodian rules"),
+    'rules-graph': ('cloud_custodian/graph_rules.py'    , "check the Cloud Custodian rules in the graph"),
+    'pipeline'   : ('pipeline/pipeline.py'              , "run all steps, skipping unchanged steps"),
+}
+
+
+def run(command, args):
+    """Run the script of command with args, replacing the current process.
+
+        The script runs as if it was started directly, such that only the
+        modules required by that script are imported.
+
+        Parameters
+        ----------
+        command : string
+            Name of command, see COMMANDS.
+
+        args : list of string
+            Command line arguments passed to the script.
+        """
+    argv = [sys.executable, os.path.join(ROOT, COMMANDS[command][0])] + list(args)
+
+    # Windows does not replace the process on exec, run as child instead
+    if os.name == 'nt':
+        import subprocess
+        sys.exit(subprocess.call(argv))
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, argv)
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Automatic detection of misconfigurations of AWS IAM policies",
+        formatter_class = argformat.StructuredFormatter,
+        epilog          = "commands:\n" + "\n".join(
+            "  {:<12} {}".format(name, description) for name, (_, description) in COMMANDS.items()
+        ) + "\n\nUse 'misdet.py <command> -h' for the arguments of each command.",
+    )
+
+    # Add arguments
+    parser.add_argument("command", choices=list(COMMANDS), help="command to run")
+    parser.add_argument("args"   , nargs=argparse.REMAINDER, help="arguments of command")
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                             Run command                              #
+    ########################################################################
+
+    run(args.command, args.args)
@@ -0,0 +1,446 @@
+# Imports
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hashlib            import sha256
+import argformat
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+# Scripts of each component import their sibling modules by name
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for component in ('common', 'collector', 'data_loader', 'anomaly_detection', 'cloud_custodian'):
+    if os.path.join(ROOT, component) not in sys.path:
+        sys.path.append(os.path.join(ROOT, component))
+
+from connection import add_arguments, get_async_driver, get_driver, get_graph, settings
+import metrics
+
+################################################################################
+#                                   Pipeline                                   #
+################################################################################
+
+def fingerprint(*values):
+    """Compute fingerprint of JSON serializable values."""
+    return sha256(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Stage(object):
+    """A single stage of a Pipeline.
+
+        Parameters
+        ----------
+        name : string
+            Name of stage.
+
+        function : callable
+            Function function(outputs, config, previous) running the stage,
+            where outputs maps the name of each dependency to its output and
+            previous is the output of the last run of this stage, if any.
+            Returns a JSON serializable output.
+
+        dependencies : iterable of string, default=()
+            Names of stages of which the output is required.
+
+        config : dict(), optional
+            Configuration of stage, part of its fingerprint.
+
+        volatile : boolean, default=False
+            If True, always run the stage, e.g., because it depends on an
+            external source. Its dependents are still skipped if its output
+            did not change.
+
+        output_fingerprint : callable, optional
+            Function computing the fingerprint of an output, by default the
+            fingerprint of the complete output.
+        """
+
+    def __init__(self, name, function, dependencies=(), config=None,
+                 volatile=False, output_fingerprint=None):
+        self.name               = name
+        self.function           = function
+        self.dependencies       = tuple(dependencies)
+        self.config             = config or dict()
+        self.volatile           = volatile
+        self.output_fingerprint = output_fingerprint or fingerprint
+
+
+class Pipeline(object):
+    """DAG of stages that only runs stages of which the inputs changed.
+
+        The fingerprint of a stage combines its name, its configuration and
+        the output fingerprints of its dependencies. A stage is skipped if its
+        fingerprint equals the fingerprint of its last run, stored in a state
+        file, in which case its previous output is reused. Stages of which all
+        dependencies are done run concurrently.
+
+        Parameters
+        ----------
+        stages : iterable of Stage
+            Stages of pipeline.
+
+        state : string
+            Path of JSON file storing the fingerprint and output of each stage.
+        """
+
+    def __init__(self, stages, state):
+        self.stages = {stage.name: stage for stage in stages}
+        self.path   = state
+
+        # Check dependencies
+        for stage in self.stages.values():
+            for dependency in stage.dependencies:
+                if dependency not in self.stages:
+                    raise ValueError("Stage '{}' depends on unknown stage '{}'".format(
+                        stage.name, dependency))
+
+        # Load state of previous runs
+        self.state = dict()
+        if os.path.exists(state):
+            with open(state) as infile:
+                self.state = json.load(infile)
+
+    def save(self):
+        """Atomically store the state of all stages."""
+        with open(self.path + '.tmp', 'w') as outfile:
+            json.dump(self.state, outfile, indent=2, default=str)
+        os.replace(self.path + '.tmp', self.path)
+
+    def _run_stage(self, stage, outputs, key, force):
+        """Run or skip a single stage.
+
+            Returns
+            -------
+            skipped : boolean
+                True if the stage was skipped.
+
+            output : object
+                Output of stage.
+
+            output_fingerprint : string
+                Fingerprint of output.
+            """
+        previous = self.state.get(stage.name)
+        if previous is not None and previous['key'] == key and \
+                not stage.volatile and stage.name not in force:
+            return True, previous['output'], previous['fingerprint']
+
+        with metrics.stage('pipeline.{}'.format(stage.name)):
+            output = stage.function(
+                {dependency: outputs[dependency] for dependency in stage.dependencies},
+                stage.config,
+                None if previous is None else previous['output'],
+            )
+        return False, output, stage.output_fingerprint(output)
+
+    def run(self, force=(), max_workers=4):
+        """Run all stages in order of their dependencies.
+
+            Parameters
+            ----------
+            force : iterable of string, default=()
+                Names of stages to run, even if unchanged.
+
+            max_workers : int, default=4
+                Maximum number of stages to run concurrently.
+
+            Returns
+            -------
+            outputs : dict()
+                Dictionary of stage name -> output.
+            """
+        force        = set(force)
+        outputs      = dict()
+        fingerprints = dict()
+        pending      = dict(self.stages)
+        running      = dict()
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                # Start stages of which all dependencies are done
+                for name, stage in list(pending.items()):
+                    if all(dependency in outputs for dependency in stage.dependencies):
+                        key = fingerprint(stage.name, stage.config, [
+                            fingerprints[dependency] for dependency in stage.dependencies
+                        ])
+                        future = executor.submit(self._run_stage, stage, outputs, key, force)
+                        running[future] = (stage, key, time.perf_counter())
+                        del pending[name]
+
+                if not running:
+                    raise ValueError("Cyclic dependencies between stages: {}".format(
+                        ', '.join(pending)))
+
+                # Record finished stages
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key, start = running.pop(future)
+                    skipped, output, output_fingerprint = future.result()
+                    outputs     [stage.name] = output
+                    fingerprints[stage.name] = output_fingerprint
+                    self.state  [stage.name] = {
+                        'key'        : key,
+                        'output'     : output,
+                        'fingerprint': output_fingerprint,
+                    }
+                    self.save()
+                    print("[{}] {}".format(stage.name, "unchanged, skipped" if skipped else
+                        "done in {:.2f}s".format(time.perf_counter() - start)))
+
+        # Return outputs
+        return outputs
+
+################################################################################
+#                                    Stages                                    #
+################################################################################
+
+def snapshot_fingerprint(path):
+    """Compute fingerprint of the content of a snapshot, ignoring file metadata."""
+    import pandas as pd
+    sheets = pd.read_excel(path, sheet_name=None)
+    return fingerprint([
+        (name, sheet.to_csv(index=False)) for name, sheet in sorted(sheets.items())
+    ])
+
+
+def collect(outputs, config, previous):
+    """Collect a snapshot, or use the snapshot given in config."""
+    path = config.get('snapshot')
+    if path is None:
+        from retrieve_policydata import collect_data
+        collect_data()
+        path = max(glob.glob(os.path.join(ROOT, 'collector', 'output', '*.xlsx')), key=os.path.getmtime)
+
+    return {
+        'snapshot': os.path.abspath(path),
+        'content' : snapshot_fingerprint(path),
+    }
+
+
+def _graph(config):
+    """Return shared py2neo graph of config."""
+    return get_graph(config['uri'], config['user'], config['password'], config['pool_size'])
+
+
+def load(outputs, config, previous):
+    """Load snapshot into the graph, or update the graph from the previous snapshot.
+
+        Returns
+        -------
+        output : dict()
+            Loaded 'snapshot' and names of 'changed' policies, None if the
+            complete graph was loaded.
+        """
+    from async_load import AsyncLoader
+    import asyncio
+    import load_data
+    import permissions
+    import update_data
+
+    graph    = _graph(config)
+    snapshot = outputs['collect']['snapshot']
+    new_policies, new_users, new_groups, new_roles = load_data.load_excel(snapshot)
+
+    # Update graph from previous snapshot, as in update_data.py
+    if previous is not None and os.path.exists(previous['snapshot']):
+        old_policies, old_users, old_groups, old_roles = load_data.load_excel(previous['snapshot'])
+        delete, add, difference = update_data.compare_policies(old_policies, new_policies)
+        update_data.delete_policy_nodes(graph, delete)
+        update_data.create_updated_policy_nodes(graph, add)
+        update_data.update_policy_node (graph, difference, new_policies)
+        update_data.update_entities(graph, new_users, new_groups, new_roles)
+        permissions.update_permission_index(
+            graph,
+            (old_policies, old_users, old_groups, old_roles),
+            (new_policies, new_users, new_groups, new_roles),
+        )
+        changed = sorted(update_data.changed_policies(add, difference))
+        return {'snapshot': snapshot, 'changed': changed}
+
+    # Load complete graph, as in load_data.py, using concurrent batched transactions
+    driver = get_async_driver(config['uri'], config['user'], config['password'], config['pool_size'])
+
+    async def load_graph():
+        try:
+            await AsyncLoader(driver, concurrency=config['pool_size']).load(new_policies, new_roles, new_users, new_groups)
+        finally:
+            await driver.close()
+
+    asyncio.run(load_graph())
+    return {'snapshot': snapshot, 'changed': None}
+
+
+def embed(outputs, config, previous):
+    """Embed the changed policies, or the complete graph after a full load."""
+    from embed import embed_graph, embed_policies
+
+    graph   = _graph(config)
+    changed = outputs['load']['changed']
+    if changed is None:
+        embed_graph(graph)
+        return {'embedded': 'all'}
+    return {'embedded': embed_policies(graph, changed)}
+
+
+def detect(outputs, config, previous):
+    """Score all embedded policies with an anomaly detector."""
+    from detectors import create_detector
+    from utils     import embedding_matrix, retrieve_embeddings
+    import numpy  as np
+    import pandas as pd
+
+    X = retrieve_embeddings(get_driver(config['uri'], config['user'], config['password'], config['pool_size']))
+    X = X[X['embedding'].notna()].reset_index(drop=True)
+
+    # Fit detector on all policies and score them
+    matrix = embedding_matrix(X)
+    scores = create_detector(config['detector']).fit(matrix).decision_function(matrix)
+
+    # Store scores
+    path = os.path.join(config['workdir'], 'scores.csv')
+    pd.DataFrame({
+        'policy': X['policy'],
+        'score' : scores,
+        'label' : np.where(scores < 0, -1, 1),
+    }).to_csv(path, index=False)
+    return {'scores': path, 'anomalies': int((scores < 0).sum())}
+
+
+def rules(outputs, config, previous):
+    """Check the snapshot against the Cloud Custodian rules."""
+    from cloud_custodian import (
+        CloudCustodianCustomEngine, DEFAULT_RULES, custodian_rules,
+        get_policies, load_policies_cloud_custodian, preprocess_policies,
+    )
+    import numpy  as np
+    import pandas as pd
+
+    if config['rules']:
+        rules_ = custodian_rules(load_policies_cloud_custodian(config['rules']))
+    else:
+        rules_ = DEFAULT_RULES
+    engine = CloudCustodianCustomEngine(rules_)
+
+    # Evaluate statements
+    X, _ = preprocess_policies(
+        get_policies(pd.read_excel(outputs['collect']['snapshot'])), (), columnar=True)
+    loose, strict = engine.classify(X)
+
+    # Combine verdicts per policy
+    result = pd.DataFrame({
+        'policy'           : np.asarray(X.strings, dtype=object)[X.policy],
+        'overly_permissive': loose,
+        'misconfigured'    : strict,
+    }).groupby('policy').max().reset_index()
+
+    # Store result
+    path = os.path.join(config['workdir'], 'rules.csv')
+    result.to_csv(path, index=False)
+    return {'rules': path, 'flagged': int(result['misconfigured'].sum())}
+
+
+def create_pipeline(workdir, snapshot=None, detector='isolation_forest', rule_files=None,
+                    uri=None, user=None, password=None, pool_size=None):
+    """Create the pipeline collect -> load -> embed -> detect and collect -> rules.
+
+        Parameters
+        ----------
+        workdir : string
+            Directory storing the state and outputs of the pipeline.
+
+        snapshot : string, optional
+            Snapshot to use, by default a new snapshot is collected.
+
+        detector : string, default='isolation_forest'
+            Name of detector, see anomaly_detection/detectors.py.
+
+        rule_files : list of string, optional
+            Cloud Custodian rule files, by default the DEFAULT_RULES are used.
+
+        uri : string, optional
+            Neo4j database URI, see connection.settings().
+
+        user : string, optional
+            Neo4j user, see connection.settings().
+
+        password : string, optional
+            Neo4j password, see connection.settings().
+
+        pool_size : int, optional
+            Maximum number of pooled connections, see connection.settings().
+
+        Returns
+        -------
+        pipeline : Pipeline
+            Pipeline storing its state in workdir.
+        """
+    os.makedirs(workdir, exist_ok=True)
+    database = settings(uri, user, password, pool_size)
+
+    return Pipeline([
+        Stage('collect', collect,
+            config             = {'snapshot': snapshot},
+            volatile           = True,
+            output_fingerprint = lambda output: output['content'],
+        ),
+        Stage('load'  , load  , ['collect'], config=database),
+        Stage('embed' , embed , ['load'   ], config=database),
+        Stage('detect', detect, ['embed'  ], config=dict(database, detector=detector, workdir=workdir)),
+        Stage('rules' , rules , ['collect'], config={'rules': rule_files, 'workdir': workdir}),
+    ], state=os.path.join(workdir, 'state.json'))
+
+
+if __name__ == "__main__":
+    ########################################################################
+    #                           Parse arguments                            #
+    ########################################################################
+    # Create parser
+    parser = argparse.ArgumentParser(
+        description     = "Run collection, loading, embedding and detection as a single pipeline",
+        formatter_class = argformat.StructuredFormatter,
+    )
+
+    # Add arguments
+    parser.add_argument("--snapshot", help="snapshot (.xlsx) to use instead of collecting a new snapshot")
+    parser.add_argument("--workdir" , default="pipeline_output", help="directory storing state and outputs")
+    parser.add_argument("--detector", default="isolation_forest", help="anomaly detector to use")
+    parser.add_argument("--rules"   , nargs='+', help="Cloud Custodian rule files, by default DEFAULT_RULES are used")
+    parser.add_argument("--force"   , nargs='+', default=[], help="stages to run even if unchanged")
+    parser.add_argument("--workers" , type=int, default=4, help="maximum number of concurrent stages")
+    parser.add_argument("--metrics" , action='store_true', help="write metrics.json and metrics.prom to workdir")
+    add_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    ########################################################################
+    #                             Run pipeline                             #
+    ########################################################################
+
+    pipeline = create_pipeline(
+        workdir    = args.workdir,
+        snapshot   = args.snapshot,
+        detector   = args.detector,
+        rule_files = args.rules,
+        uri        = args.uri,
+        user       = args.user,
+        password   = args.password,
+        pool_size  = args.pool_size,
+    )
+    if args.metrics:
+        metrics.enable()
+    outputs = pipeline.run(force=args.force, max_workers=args.workers)
+
+    # Export metrics of run
+    if args.metrics:
+        metrics.export(
+            json_path       = os.path.join(args.workdir, 'metrics.json'),
+            prometheus_path = os.path.join(args.workdir, 'metrics.prom'),
+        )
+
+    # Print outputs
+    print()
+    for name, output in outputs.items():
+        print("{:<8} {}".format(name, json.dumps(output, default=str)))